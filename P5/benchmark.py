@@ -0,0 +1,1095 @@
+# benchmarks and stress checks for the library database
+# run against a disposable copy of the Library database, e.g.
+#   python benchmark.py checkout-stress --copies 20 --workers 64
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import date, timedelta
+
+from library_flask_app import (app, create_connection, call_procedure, has_open_loans, import_books, accrue_fees,
+                               rebuild_stats, capture_statements, normalize_sql, events_args, BOOK_LANGUAGES,
+                               BOOK_GENRES, BOOK_TYPES, EVENTS_QUERY, EVENTS_PAGE_SIZE)
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+# helpers for creating throwaway rows that each benchmark cleans up afterwards
+def create_book(cursor, copies):
+    cursor.execute("INSERT INTO LibraryItem (ItemType) VALUES ('Book')")
+    item_id = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO Books (ItemID, Language, Genre, Title, PublicationYear, NumCopies, BookType, PublisherID)
+        VALUES (%s, 'EN', 'Fiction', 'Benchmark Title', 2024, %s, 'Physical_Copy', 1)
+    """, (item_id, copies))
+    cursor.execute("""
+        INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount)
+        VALUES (%s, %s, 0)
+    """, (item_id, copies))
+    return item_id
+
+
+def create_movie(cursor, copies):
+    cursor.execute("INSERT INTO LibraryItem (ItemType) VALUES ('Movie')")
+    item_id = cursor.lastrowid
+    cursor.execute("""
+        INSERT INTO Movies (ItemID, Language, Title, PublicationYear, NumCopies, Genre, Director, MovieType)
+        VALUES (%s, 'EN', 'Benchmark Title', 2024, %s, 'Drama', 'Benchmark', 'Physical')
+    """, (item_id, copies))
+    cursor.execute("""
+        INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount)
+        VALUES (%s, %s, 0)
+    """, (item_id, copies))
+    return item_id
+
+
+def create_accounts(cursor, count):
+    card_ids = []
+    for i in range(count):
+        cursor.execute("""
+            INSERT INTO LibraryAccount (Name, NumChecked, NumReserved, OverdueFees)
+            VALUES (%s, 0, 0, 0)
+        """, (f"Benchmark {i}",))
+        card_ids.append(cursor.lastrowid)
+    return card_ids
+
+
+def delete_rows(cursor, item_ids, card_ids):
+    for card_id in card_ids:
+        cursor.execute("DELETE FROM CheckOutLibraryItem WHERE CardID = %s", (card_id,))
+        cursor.execute("DELETE FROM ReserveLibraryItem WHERE CardID = %s", (card_id,))
+    for item_id in item_ids:
+        cursor.execute("DELETE FROM LibraryItem WHERE ItemID = %s", (item_id,))
+    for card_id in card_ids:
+        cursor.execute("DELETE FROM LibraryAccount WHERE CardID = %s", (card_id,))
+
+
+# many patrons race to check out the last few copies of one item; exactly
+# `copies` checkouts may succeed and CopiesAvailable must end at zero
+def checkout_stress(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    item_id = create_book(cursor, args.copies)
+    card_ids = create_accounts(cursor, args.workers)
+    connection.commit()
+
+    results = []
+    errors = []
+    start_line = threading.Barrier(args.workers)
+
+    def worker(card_id):
+        worker_connection = create_connection()
+        try:
+            start_line.wait()
+            status, _ = call_procedure(worker_connection, 'CheckOutItem', (item_id, card_id, '2024-01-01', '2024-01-15'))
+            results.append(status)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            worker_connection.close()
+
+    threads = [threading.Thread(target=worker, args=(card_id,)) for card_id in card_ids]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    cursor.execute("SELECT CopiesAvailable FROM LibraryItemState WHERE ItemID = %s", (item_id,))
+    copies_left = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM CheckOutLibraryItem WHERE ItemID = %s", (item_id,))
+    checked_out = cursor.fetchone()[0]
+
+    delete_rows(cursor, [item_id], card_ids)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+    print(f"{args.workers} concurrent checkouts of {args.copies} copies in {elapsed:.3f}s")
+    print(f"succeeded: {results.count('OK')}, refused: {results.count('FORBIDDEN')}, errors: {len(errors)}")
+    assert not errors, errors
+    assert results.count('OK') == args.copies, "wrong number of successful checkouts"
+    assert checked_out == args.copies, f"oversold: {checked_out} checkouts for {args.copies} copies"
+    assert copies_left == 0, f"CopiesAvailable ended at {copies_left}"
+    print("no oversell")
+
+
+# enqueue and then cancel-from-the-front a deep hold queue on one item; with
+# sequence-numbered holds the per-operation cost should not grow with queue depth
+def reservation_queue(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    item_id = create_book(cursor, 1)
+    card_ids = create_accounts(cursor, 10)
+    connection.commit()
+
+    def timed(label, operations):
+        timings = []
+        for operation in operations:
+            started = time.perf_counter()
+            operation()
+            timings.append(time.perf_counter() - started)
+        bucket = max(len(timings) // 10, 1)
+        first = sum(timings[:bucket]) / bucket * 1000
+        last = sum(timings[-bucket:]) / bucket * 1000
+        print(f"{label}: first {bucket} avg {first:.3f} ms/op, last {bucket} avg {last:.3f} ms/op")
+
+    reservation_ids = []
+
+    def enqueue(card_id):
+        def operation():
+            status, reservation_id = call_procedure(connection, 'ReserveItem', (item_id, card_id))
+            reservation_ids.append(reservation_id)
+        return operation
+
+    def dequeue(reservation_id, card_id):
+        return lambda: call_procedure(connection, 'CancelReservation', (reservation_id, card_id))
+
+    timed(f"enqueue {args.holds} holds", [enqueue(card_ids[i % len(card_ids)]) for i in range(args.holds)])
+
+    cursor.execute("""
+        SELECT COUNT(*) FROM ReserveLibraryItem q
+        WHERE q.ItemID = %s AND q.QueueSeq <= (SELECT QueueSeq FROM ReserveLibraryItem WHERE ReservationID = %s)
+    """, (item_id, reservation_ids[-1]))
+    print(f"last hold is at place {cursor.fetchone()[0]}")
+
+    timed(f"dequeue {args.holds} holds", [dequeue(reservation_id, card_ids[i % len(card_ids)]) for i, reservation_id in enumerate(reservation_ids)])
+
+    delete_rows(cursor, [item_id], card_ids)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+# "does this item still have copies out" on an item with a long, fully returned
+# loan history: the old per-checkout lookup loop against the OpenLoans probe
+def open_loans(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    item_id = create_book(cursor, 1)
+    card_ids = create_accounts(cursor, 1)
+    cursor.executemany("""
+        INSERT INTO CheckOutLibraryItem (ItemID, CardID, BorrowDate, ReturnByDate)
+        VALUES (%s, %s, '2020-01-01', '2099-01-01')
+    """, [(item_id, card_ids[0])] * args.checkouts)
+    cursor.execute("""
+        INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate)
+        SELECT CheckoutID, '2020-01-02' FROM CheckOutLibraryItem WHERE ItemID = %s
+    """, (item_id,))
+    connection.commit()
+
+    def per_checkout_loop():
+        cursor.execute("""
+            SELECT CheckoutID FROM CheckOutLibraryItem
+            WHERE ItemID = %s AND ReturnByDate > %s
+        """, (item_id, '2024-01-01'))
+        for (checkout_id,) in cursor.fetchall():
+            cursor.execute("SELECT ReturnID FROM ReturnLibraryItem WHERE CheckoutID = %s", (checkout_id,))
+            if not cursor.fetchone():
+                return True
+        return False
+
+    for label, check in [("per-checkout loop", per_checkout_loop), ("OpenLoans", lambda: has_open_loans(cursor, item_id))]:
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            outstanding = check()
+        elapsed = (time.perf_counter() - started) / args.repeat * 1000
+        print(f"{label}: {elapsed:.3f} ms per check over {args.checkouts} checkouts (outstanding={outstanding})")
+
+    delete_rows(cursor, [item_id], card_ids)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+# load the same synthetic feed through add_book's one-book-per-transaction path
+# and through the batched import, and compare rows per second
+def bulk_import(args):
+    rows = [{"Language": "EN", "Genre": "Fiction", "Title": f"Imported Title {i}", "PublicationYear": 2000 + i % 25,
+             "NumCopies": 1 + i % 5, "BookType": "Physical_Copy", "PublisherID": 1 + i % 30} for i in range(args.books)]
+    connection = create_connection()
+    cursor = connection.cursor()
+    cursor.execute("SELECT COALESCE(MAX(ItemID), 0) FROM LibraryItem")
+    first_new_id = cursor.fetchone()[0] + 1
+
+    started = time.perf_counter()
+    for row in rows:
+        cursor.execute("INSERT INTO LibraryItem (ItemType) VALUES ('Book')")
+        item_id = cursor.lastrowid
+        cursor.execute("""
+            INSERT INTO Books (ItemID, Language, Genre, Title, PublicationYear, NumCopies, BookType, PublisherID)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (item_id, row["Language"], row["Genre"], row["Title"], row["PublicationYear"], row["NumCopies"],
+              row["BookType"], row["PublisherID"]))
+        cursor.execute("""
+            INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount)
+            VALUES (%s, %s, 0)
+        """, (item_id, row["NumCopies"]))
+        connection.commit()
+    single = time.perf_counter() - started
+
+    started = time.perf_counter()
+    result = import_books(connection, enumerate(rows, start=1))
+    batched = time.perf_counter() - started
+
+    print(f"one at a time: {args.books / single:,.0f} books/s ({single:.2f}s)")
+    print(f"bulk import:   {args.books / batched:,.0f} books/s ({batched:.2f}s), "
+          f"{result['inserted']} inserted, {len(result['errors'])} errors")
+
+    cursor.execute("DELETE FROM LibraryItem WHERE ItemID >= %s", (first_new_id,))
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+# check out and return the same set of items as N single calls and as one batch
+# call each way, and compare the time per item
+def batch_circulation(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    item_ids = [create_book(cursor, 2) for _ in range(args.items)]
+    card_ids = create_accounts(cursor, 1)
+    connection.commit()
+
+    client = app.test_client()
+    card_id = card_ids[0]
+    dates = {"BorrowDate": "2024-01-01", "ReturnByDate": "2024-01-15"}
+
+    def checkout_ids():
+        cursor.execute("SELECT CheckoutID FROM OpenLoans WHERE CardID = %s ORDER BY CheckoutID", (card_id,))
+        ids = [checkout_id for (checkout_id,) in cursor.fetchall()]
+        connection.commit()
+        return ids
+
+    timings = {}
+    started = time.perf_counter()
+    for item_id in item_ids:
+        response = client.post('/checkouts', json={"CardID": card_id, "ItemID": item_id, **dates})
+        assert response.status_code == 201, response.get_json()
+    timings['single checkout'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for checkout_id in checkout_ids():
+        response = client.delete(f'/checkouts/{checkout_id}', json={"ReturnDate": "2024-01-20"})
+        assert response.status_code == 200, response.get_json()
+    timings['single return'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    response = client.post('/checkouts/batch', json={"CardID": card_id, "ItemIDs": item_ids, **dates})
+    assert all(result['status'] == 201 for result in response.get_json()['results']), response.get_json()
+    timings['batch checkout'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    response = client.post('/returns/batch', json={"CheckoutIDs": checkout_ids(), "ReturnDate": "2024-01-20"})
+    assert all(result['status'] == 200 for result in response.get_json()['results']), response.get_json()
+    timings['batch return'] = time.perf_counter() - started
+
+    cursor.execute("SELECT NumChecked, OverdueFees FROM LibraryAccount WHERE CardID = %s", (card_id,))
+    num_checked, fees = cursor.fetchone()
+    delete_rows(cursor, item_ids, card_ids)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+    for label, elapsed in timings.items():
+        print(f"{label:16} {args.items} items in {elapsed * 1000:.1f} ms ({elapsed / args.items * 1000:.3f} ms/item)")
+    assert num_checked == 0, f"NumChecked ended at {num_checked}"
+    print(f"account balanced: NumChecked {num_checked}, OverdueFees {fees}")
+
+
+# accrue fees over a large synthetic set of open loans, then run the job again
+# for the same day to confirm nothing changes
+def fee_accrual(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    item_id = create_book(cursor, 1)
+    card_ids = create_accounts(cursor, args.cards)
+    connection.commit()
+
+    rng = random.Random(args.seed)
+    first = date(2023, 6, 1)
+    for start in range(0, args.loans, 10000):
+        loans = []
+        for i in range(start, min(start + 10000, args.loans)):
+            return_by = first + timedelta(days=rng.randint(0, 365))
+            loans.append((item_id, card_ids[i % len(card_ids)], return_by - timedelta(days=14), return_by))
+        cursor.executemany("""
+            INSERT INTO CheckOutLibraryItem (ItemID, CardID, BorrowDate, ReturnByDate)
+            VALUES (%s, %s, %s, %s)
+        """, loans)
+        connection.commit()
+    cursor.execute("""
+        INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+        SELECT CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate FROM CheckOutLibraryItem
+        WHERE ItemID = %s
+    """, (item_id,))
+    connection.commit()
+
+    def totals():
+        cursor.execute("SELECT SUM(AccruedFee) FROM OpenLoans WHERE ItemID = %s", (item_id,))
+        loan_total = cursor.fetchone()[0]
+        cursor.execute(f"""
+            SELECT SUM(AccruedFees) FROM LibraryAccount
+            WHERE CardID IN ({', '.join(['%s'] * len(card_ids))})
+        """, card_ids)
+        account_total = cursor.fetchone()[0]
+        connection.commit()
+        return loan_total, account_total
+
+    as_of = date(2024, 1, 1)
+    runs = []
+    for label in ("first run", "re-run"):
+        started = time.perf_counter()
+        result = accrue_fees(connection, as_of, args.chunk_size)
+        elapsed = time.perf_counter() - started
+        runs.append(totals())
+        print(f"{label}: {result['loans']:,} loans and {result['accounts']:,} accounts in {elapsed:.2f}s "
+              f"({result['loans'] / elapsed:,.0f} loans/s)")
+
+    delete_rows(cursor, [item_id], card_ids)
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+    loan_total, account_total = runs[0]
+    print(f"accrued {loan_total} across {args.loans:,} loans")
+    assert loan_total == account_total, f"accounts hold {account_total}, loans hold {loan_total}"
+    assert runs[1] == runs[0], f"re-run changed the totals: {runs[0]} -> {runs[1]}"
+    print("idempotent")
+
+
+# time GET /search for words drawn from the titles and names already in the
+# database; point it at a large generated catalog to check the latency target
+def search(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT Title FROM Books
+        UNION ALL SELECT Title FROM Movies
+        UNION ALL SELECT Name FROM Authors
+        LIMIT 5000
+    """)
+    words = sorted({word for (text,) in cursor.fetchall() for word in (text or '').split() if len(word) >= 3})
+    cursor.close()
+    connection.close()
+
+    rng = random.Random(args.seed)
+    client = app.test_client()
+    timings = []
+    for _ in range(args.queries):
+        query = ' '.join(rng.sample(words, min(rng.randint(1, 2), len(words))))
+        started = time.perf_counter()
+        response = client.get('/search', query_string={'q': query})
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.get_json()
+
+    p99 = percentile(timings, 0.99)
+    print(f"{args.queries} searches: p50 {percentile(timings, 0.5):.2f} ms, "
+          f"p95 {percentile(timings, 0.95):.2f} ms, p99 {p99:.2f} ms")
+    if p99 > args.target_ms:
+        print(f"p99 is over the {args.target_ms} ms target")
+        return 1
+    return 0
+
+
+# drive a running server (python library_flask_app.py, gunicorn or uvicorn) with
+# concurrent clients for a fixed time and report throughput and latency. run it
+# once per serving mode with the same arguments to compare them. the mix includes
+# the circulation writes, which are the routes the async pool serves natively; a
+# return picks one of the client's own earlier checkouts, or checks out instead
+# when it has none left
+LOAD_CHECKOUT = ('POST', '/checkouts', {"ItemID": '{item}', "CardID": '{card}', "BorrowDate": "2024-01-01", "ReturnByDate": "2024-01-15"})
+LOAD_REQUESTS = [
+    ('GET', '/books/{item}', None),
+    ('GET', '/accounts/person/{card}', None),
+    ('GET', '/checkouts/person/{card}', None),
+    LOAD_CHECKOUT,
+    ('DELETE', '/checkouts/{checkout}', {"ReturnDate": "2024-01-10"}),
+    ('POST', '/reservations', {"ItemID": '{item}', "CardID": '{card}'}),
+]
+
+
+def send(base_url, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read() or b'null')
+    except urllib.error.HTTPError as err:
+        return err.code, None
+
+
+def load(args):
+    timings = []
+    failures = []
+    deadline = time.perf_counter() + args.duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        checkouts = []
+        while time.perf_counter() < deadline:
+            method, path, body = rng.choice(LOAD_REQUESTS)
+            if '{checkout}' in path and not checkouts:
+                method, path, body = LOAD_CHECKOUT
+            ids = {'item': rng.randint(1, args.items), 'card': rng.randint(1, args.cards)}
+            if '{checkout}' in path:
+                ids['checkout'] = checkouts.pop(rng.randrange(len(checkouts)))
+            path = path.format(**ids)
+            if body is not None:
+                body = {key: ids[value[1:-1]] if value in ('{item}', '{card}') else value for key, value in body.items()}
+            started = time.perf_counter()
+            status, reply = send(args.url, method, path, body)
+            timings.append((time.perf_counter() - started) * 1000)
+            if status >= 500:
+                failures.append(status)
+            elif status == 201 and reply and 'CheckoutID' in reply:
+                checkouts.append(reply['CheckoutID'])
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"{args.url}: {len(timings) / args.duration:,.0f} req/s with {args.concurrency} clients, "
+          f"p50 {percentile(timings, 0.5):.2f} ms, p99 {percentile(timings, 0.99):.2f} ms, {len(failures)} errors")
+
+
+# deterministic synthetic dataset for load testing: the same arguments and seed
+# always give the same rows and IDs, so runs on different days compare like for
+# like. it replaces every row in the database, so only point it at a disposable
+# instance, e.g.
+#   mysql -u root < library_mysql_script.sql && python benchmark.py generate --yes
+GENERATED_TABLES = (
+    'ReturnLibraryItem', 'OpenLoans', 'CheckOutLibraryItem', 'ReserveLibraryItem', 'Reviews',
+    'CirculationEvents', 'Shelf_PhysicalCopy', 'Book_Author', 'ItemStats', 'ItemRatings', 'AuthorStats', 'CatalogStats',
+    'LibraryItemState', 'Books', 'Movies', 'LibraryItem', 'Authors', 'LibraryAccount', 'Publishers',
+)
+TITLE_WORDS = (
+    'shadow', 'river', 'garden', 'winter', 'secret', 'empire', 'silver', 'night', 'ocean', 'storm',
+    'lost', 'city', 'dragon', 'glass', 'house', 'queen', 'summer', 'forest', 'light', 'letters',
+    'journey', 'stone', 'fire', 'island', 'memory', 'stars', 'broken', 'crown', 'whisper', 'mountain',
+    'harbor', 'midnight', 'paper', 'wolf', 'golden', 'echo', 'last', 'road', 'iron', 'song',
+)
+FIRST_NAMES = ('Ada', 'Ben', 'Cara', 'Dev', 'Elena', 'Farid', 'Grace', 'Hiro', 'Ines', 'Jonah',
+               'Kira', 'Luis', 'Maya', 'Nils', 'Omar', 'Priya', 'Quinn', 'Rosa', 'Sam', 'Tara')
+LAST_NAMES = ('Abbott', 'Baker', 'Chen', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Haddad', 'Ito', 'Jones',
+              'Kim', 'Lopez', 'Moreau', 'Novak', 'Okafor', 'Park', 'Rossi', 'Silva', 'Tanaka', 'Weber')
+NATIONALITIES = ('American', 'British', 'Canadian', 'French', 'German', 'Japanese', 'Korean', 'Mexican', 'Nigerian')
+MOVIE_LANGUAGES = ('EN', 'ES', 'FR', 'KO', 'IT', 'CH')
+MOVIE_GENRES = ('Comedy', 'Biography', 'Mystery', 'Thriller', 'Romance', 'Documentary', 'Horror', 'Action',
+                'Sci-Fi', 'Adventure', 'Drama', 'Crime', 'Animation', 'History', 'Fantasy')
+GENERATED_TODAY = date(2024, 6, 30)
+LOAN_DAYS = 14
+
+
+def insert_rows(connection, cursor, statement, rows, chunk_size=10000):
+    for start in range(0, len(rows), chunk_size):
+        cursor.executemany(statement, rows[start:start + chunk_size])
+        connection.commit()
+
+
+def person_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def title(rng):
+    return ' '.join(rng.sample(TITLE_WORDS, rng.randint(2, 4))).title()
+
+
+def generate(args):
+    if not args.yes:
+        print("generate replaces every row in the Library database; rerun with --yes against a disposable instance")
+        return 1
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    connection = create_connection()
+    cursor = connection.cursor()
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    for table in GENERATED_TABLES:
+        cursor.execute(f"TRUNCATE TABLE {table}")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+    cursor.execute("SELECT ShelfID FROM Shelf ORDER BY ShelfID")
+    shelf_ids = [shelf_id for (shelf_id,) in cursor.fetchall()]
+
+    book_languages, book_genres, book_types = sorted(BOOK_LANGUAGES), sorted(BOOK_GENRES), sorted(BOOK_TYPES)
+    books = [(item_id, rng.choice(book_languages), rng.choice(book_genres), title(rng), rng.randint(1950, 2024),
+              rng.randint(1, 5), rng.choice(book_types), rng.randint(1, args.publishers))
+             for item_id in range(1, args.books + 1)]
+    movies = [(item_id, rng.choice(MOVIE_LANGUAGES), title(rng), rng.randint(1950, 2024), rng.randint(1, 5),
+               rng.choice(MOVIE_GENRES), person_name(rng), rng.choice(('Physical', 'Digital')))
+              for item_id in range(args.books + 1, args.books + args.movies + 1)]
+    copies = {book[0]: book[5] for book in books}
+    copies.update({movie[0]: movie[4] for movie in movies})
+    item_ids = sorted(copies)
+    physical = [book[0] for book in books if book[6] in ('Physical_Copy', 'AudioBook_Physical')] + \
+               [movie[0] for movie in movies if movie[7] == 'Physical']
+
+    # a few items get most of the traffic, as in a real catalog
+    weights = [rng.paretovariate(1.2) for _ in item_ids]
+    popular = rng.choices(item_ids, weights=weights, k=args.history + args.holds)
+    hot_items = [item_id for _, item_id in sorted(zip(weights, item_ids), reverse=True)[:max(len(item_ids) // 100, 1)]]
+
+    # loan history in date order: anything borrowed in the last four weeks may
+    # still be out if a copy was free, everything else has come back
+    checkouts, returns, open_loans = [], [], []
+    open_by_item, open_by_card = {}, {}
+    borrow_dates = sorted(GENERATED_TODAY - timedelta(days=rng.randint(0, 730)) for _ in range(args.history))
+    for checkout_id, (borrowed, item_id) in enumerate(zip(borrow_dates, popular), start=1):
+        card_id = rng.randint(1, args.accounts)
+        return_by = borrowed + timedelta(days=LOAN_DAYS)
+        checkouts.append((checkout_id, item_id, card_id, borrowed, return_by))
+        recent = (GENERATED_TODAY - borrowed).days < 28
+        if recent and open_by_item.get(item_id, 0) < copies[item_id] and rng.random() < 0.7:
+            open_by_item[item_id] = open_by_item.get(item_id, 0) + 1
+            open_by_card[card_id] = open_by_card.get(card_id, 0) + 1
+            open_loans.append((checkout_id, item_id, card_id, borrowed, return_by))
+        else:
+            returned = min(borrowed + timedelta(days=rng.randint(1, LOAN_DAYS + 7)), GENERATED_TODAY)
+            returns.append((checkout_id, returned))
+
+    # deep hold queues on the hottest items
+    holds, next_seq, holds_by_item, holds_by_card = [], {}, {}, {}
+    for reservation_id in range(1, args.holds + 1):
+        item_id = rng.choice(hot_items)
+        card_id = rng.randint(1, args.accounts)
+        next_seq[item_id] = next_seq.get(item_id, 0) + 1
+        holds.append((reservation_id, item_id, card_id, next_seq[item_id]))
+        holds_by_item[item_id] = holds_by_item.get(item_id, 0) + 1
+        holds_by_card[card_id] = holds_by_card.get(card_id, 0) + 1
+
+    reviewed = set()
+    reviews = []
+    while len(reviews) < min(args.reviews, args.accounts * len(item_ids)):
+        pair = (rng.randint(1, args.accounts), rng.choice(item_ids))
+        if pair in reviewed:
+            continue
+        reviewed.add(pair)
+        rating = rng.choices((1, 2, 3, 4, 5), weights=(5, 10, 20, 35, 30))[0]
+        reviews.append((len(reviews) + 1,) + pair + (f"{title(rng)}: {rating} stars", rating))
+
+    insert_rows(connection, cursor, "INSERT INTO Publishers (PublisherID, Name, ContactInfo) VALUES (%s, %s, %s)",
+                [(i, f"{rng.choice(LAST_NAMES)} Press {i}", f"books{i}@example.com") for i in range(1, args.publishers + 1)])
+    insert_rows(connection, cursor, "INSERT INTO Authors (AuthorID, Name, DOB, Nationality) VALUES (%s, %s, %s, %s)",
+                [(i, person_name(rng), f"{rng.randint(1920, 1995)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}",
+                  rng.choice(NATIONALITIES)) for i in range(1, args.authors + 1)])
+    insert_rows(connection, cursor, """
+        INSERT INTO LibraryAccount (CardID, Name, NumChecked, NumReserved, OverdueFees)
+        VALUES (%s, %s, %s, %s, 0)
+    """, [(card_id, person_name(rng), open_by_card.get(card_id, 0), holds_by_card.get(card_id, 0))
+          for card_id in range(1, args.accounts + 1)])
+    insert_rows(connection, cursor, "INSERT INTO LibraryItem (ItemID, ItemType) VALUES (%s, %s)",
+                [(book[0], 'Book') for book in books] + [(movie[0], 'Movie') for movie in movies])
+    insert_rows(connection, cursor, """
+        INSERT INTO Books (ItemID, Language, Genre, Title, PublicationYear, NumCopies, BookType, PublisherID)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, books)
+    insert_rows(connection, cursor, """
+        INSERT INTO Movies (ItemID, Language, Title, PublicationYear, NumCopies, Genre, Director, MovieType)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """, movies)
+    insert_rows(connection, cursor, "INSERT INTO Book_Author (ItemID, AuthorID) VALUES (%s, %s)",
+                [(book[0], author_id) for book in books
+                 for author_id in sorted(set(rng.randint(1, args.authors) for _ in range(rng.randint(1, 2))))])
+    insert_rows(connection, cursor, """
+        INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount, NextQueueSeq)
+        VALUES (%s, %s, %s, %s)
+    """, [(item_id, copies[item_id] - open_by_item.get(item_id, 0), holds_by_item.get(item_id, 0),
+           next_seq.get(item_id, 0) + 1) for item_id in item_ids])
+    if shelf_ids:
+        insert_rows(connection, cursor, "INSERT INTO Shelf_PhysicalCopy (ItemID, ShelfID) VALUES (%s, %s)",
+                    [(item_id, rng.choice(shelf_ids)) for item_id in physical])
+    insert_rows(connection, cursor, """
+        INSERT INTO CheckOutLibraryItem (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+        VALUES (%s, %s, %s, %s, %s)
+    """, checkouts)
+    insert_rows(connection, cursor, "INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate) VALUES (%s, %s)", returns)
+    insert_rows(connection, cursor, """
+        INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+        VALUES (%s, %s, %s, %s, %s)
+    """, open_loans)
+    insert_rows(connection, cursor, """
+        INSERT INTO ReserveLibraryItem (ReservationID, ItemID, CardID, QueueSeq)
+        VALUES (%s, %s, %s, %s)
+    """, holds)
+    insert_rows(connection, cursor, """
+        INSERT INTO Reviews (ReviewID, CardID, ItemID, Comments, Rating)
+        VALUES (%s, %s, %s, %s, %s)
+    """, reviews)
+
+    rebuild_stats(connection)
+    cursor.execute(f"ANALYZE TABLE {', '.join(GENERATED_TABLES)}")
+    cursor.fetchall()
+    cursor.close()
+    connection.close()
+
+    print(f"generated in {time.perf_counter() - started:.1f}s (seed {args.seed}): {args.accounts:,} accounts, "
+          f"{args.books:,} books, {args.movies:,} movies, {args.authors:,} authors, {args.publishers:,} publishers, "
+          f"{len(checkouts):,} checkouts ({len(open_loans):,} open), {len(holds):,} holds on {len(hot_items):,} items, "
+          f"{len(reviews):,} reviews")
+    return 0
+
+
+# scripted request mixes run in-process through the Flask test client, so the
+# per-route statement counts come straight from the app's /metrics. run
+# `generate` first; the mixes change the data, so regenerate between runs that
+# should be compared
+class WorkloadState:
+    def __init__(self, cursor):
+        cursor.execute("SELECT COALESCE(MAX(CardID), 0) FROM LibraryAccount")
+        self.accounts = cursor.fetchone()[0]
+        cursor.execute("SELECT ItemID FROM LibraryItem ORDER BY ItemID")
+        self.items = [item_id for (item_id,) in cursor.fetchall()]
+        cursor.execute("SELECT ItemID FROM Books ORDER BY ItemID")
+        self.books = [item_id for (item_id,) in cursor.fetchall()]
+        cursor.execute("SELECT ItemID FROM Movies ORDER BY ItemID")
+        self.movies = [item_id for (item_id,) in cursor.fetchall()]
+        cursor.execute("SELECT ItemID FROM LibraryItemState ORDER BY ReservationCount DESC, ItemID LIMIT 100")
+        self.hot_items = [item_id for (item_id,) in cursor.fetchall()]
+        cursor.execute("SELECT CheckoutID, CardID FROM OpenLoans ORDER BY CheckoutID LIMIT 10000")
+        self.open_loans = cursor.fetchall()
+        cursor.execute("SELECT ReservationID, CardID FROM ReserveLibraryItem ORDER BY ReservationID LIMIT 10000")
+        self.holds = cursor.fetchall()
+        self.lock = threading.Lock()
+
+    def card(self, rng):
+        return rng.randint(1, self.accounts)
+
+    def take(self, rng, pool):
+        with self.lock:
+            if not pool:
+                return None
+            index = rng.randrange(len(pool))
+            pool[index], pool[-1] = pool[-1], pool[index]
+            return pool.pop()
+
+    def peek(self, rng, pool):
+        with self.lock:
+            return rng.choice(pool) if pool else None
+
+    def add(self, pool, entry):
+        with self.lock:
+            pool.append(entry)
+
+
+def checkout_op(client, rng, state):
+    card_id = state.card(rng)
+    response = client.post('/checkouts', json={"CardID": card_id, "ItemID": rng.choice(state.items),
+                                               "BorrowDate": "2024-07-01", "ReturnByDate": "2024-07-15"})
+    if response.status_code == 201:
+        state.add(state.open_loans, (response.get_json()['CheckoutID'], card_id))
+    return response
+
+
+def return_op(client, rng, state):
+    loan = state.take(rng, state.open_loans)
+    if loan is None:
+        return None
+    return client.delete(f'/checkouts/{loan[0]}', json={"ReturnDate": "2024-07-20"})
+
+
+def renew_op(client, rng, state):
+    loan = state.peek(rng, state.open_loans)
+    if loan is None:
+        return None
+    return client.put(f'/checkouts/person/{loan[1]}', json={"CheckoutID": loan[0], "ReturnByDate": "2024-07-29"})
+
+
+def reserve_op(client, rng, state):
+    card_id = state.card(rng)
+    response = client.post('/reservations', json={"ItemID": rng.choice(state.hot_items), "CardID": card_id})
+    if response.status_code == 201:
+        state.add(state.holds, (response.get_json()['ReservationID'], card_id))
+    return response
+
+
+def cancel_op(client, rng, state):
+    hold = state.take(rng, state.holds)
+    if hold is None:
+        return None
+    return client.delete(f'/reservations/person/{hold[1]}', json={"ReservationID": hold[0]})
+
+
+def position_op(client, rng, state):
+    hold = state.peek(rng, state.holds)
+    if hold is None:
+        return None
+    return client.get(f'/reservations/{hold[0]}/position')
+
+
+# (weight, label, request) per mix; labels are the Flask route each request hits
+WORKLOAD_MIXES = {
+    'browse': [
+        (25, 'GET /books/<int:item_id>', lambda client, rng, state: client.get(f'/books/{rng.choice(state.books)}')),
+        (10, 'GET /movies/<int:item_id>', lambda client, rng, state: client.get(f'/movies/{rng.choice(state.movies)}')),
+        (10, 'GET /items', lambda client, rng, state: client.get(
+            '/items', query_string={'ids': ','.join(str(item_id) for item_id in rng.sample(state.items, 10))})),
+        (15, 'GET /search', lambda client, rng, state: client.get(
+            '/search', query_string={'q': ' '.join(rng.sample(TITLE_WORDS, rng.randint(1, 2)))})),
+        (15, 'GET /books', lambda client, rng, state: client.get(
+            '/books', query_string={'Genre': rng.choice(sorted(BOOK_GENRES)), 'limit': 20})),
+        (10, 'GET /reviews/item/<int:item_id>', lambda client, rng, state: client.get(
+            f'/reviews/item/{rng.choice(state.items)}', query_string={'limit': 20})),
+        (10, 'GET /items/<int:item_id>/rating', lambda client, rng, state: client.get(f'/items/{rng.choice(state.items)}/rating')),
+        (5, 'GET /items/top-rated', lambda client, rng, state: client.get(
+            '/items/top-rated', query_string={'genre': rng.choice(sorted(BOOK_GENRES))})),
+    ],
+    'circulation': [
+        (30, 'POST /checkouts', checkout_op),
+        (30, 'DELETE /checkouts/<int:checkout_id>', return_op),
+        (10, 'PUT /checkouts/person/<int:card_id>', renew_op),
+        (15, 'GET /accounts/person/<int:card_id>', lambda client, rng, state: client.get(f'/accounts/person/{state.card(rng)}')),
+        (15, 'GET /checkouts/person/<int:card_id>', lambda client, rng, state: client.get(
+            f'/checkouts/person/{state.card(rng)}', query_string={'open': 'true'})),
+    ],
+    'holds': [
+        (30, 'POST /reservations', reserve_op),
+        (25, 'DELETE /reservations/person/<int:card_id>', cancel_op),
+        (25, 'GET /reservations/person/<int:card_id>', lambda client, rng, state: client.get(f'/reservations/person/{state.card(rng)}')),
+        (20, 'GET /reservations/<int:reservation_id>/position', position_op),
+    ],
+}
+METRIC_LINE = re.compile(r'^(library_request_duration_seconds_count|library_db_statements_total|library_db_time_seconds_total'
+                         r'|library_db_rows_total)\{method="([^"]*)",route="([^"]*)"\} (\S+)$')
+
+
+# {(metric, "METHOD /route"): value} from the app's Prometheus output
+def scrape_metrics(client):
+    values = {}
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            values[(match.group(1), f"{match.group(2)} {match.group(3)}")] = float(match.group(4))
+    return values
+
+
+def workload(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    state = WorkloadState(cursor)
+    cursor.close()
+    connection.close()
+    if not state.items or not state.accounts:
+        print("no data to run against; run `python benchmark.py generate --yes` first")
+        return 1
+
+    mix = WORKLOAD_MIXES[args.mix]
+    weights = [weight for weight, _, _ in mix]
+    timings = {}
+    failures = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+    before = scrape_metrics(app.test_client())
+
+    def client_thread(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            _, label, operation = rng.choices(mix, weights=weights)[0]
+            started = time.perf_counter()
+            response = operation(client, rng, state)
+            elapsed = (time.perf_counter() - started) * 1000
+            if response is None:
+                continue
+            with lock:
+                timings.setdefault(label, []).append(elapsed)
+                if response.status_code >= 500:
+                    failures.append((label, response.status_code))
+
+    threads = [threading.Thread(target=client_thread, args=(args.seed * 1000 + i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    after = scrape_metrics(app.test_client())
+
+    def delta(metric, label):
+        return after.get((metric, label), 0) - before.get((metric, label), 0)
+
+    every = [elapsed for route_timings in timings.values() for elapsed in route_timings]
+    print(f"{args.mix} mix, {args.concurrency} clients, {args.duration:.0f}s: {len(every) / args.duration:,.0f} req/s, "
+          f"p50 {percentile(every, 0.5):.2f} ms, p95 {percentile(every, 0.95):.2f} ms, p99 {percentile(every, 0.99):.2f} ms, "
+          f"{len(failures)} errors")
+    print(f"{'route':50} {'reqs':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'stmts/req':>10} {'db ms/req':>10} {'rows/req':>9}")
+    for label, route_timings in sorted(timings.items()):
+        requests = delta('library_request_duration_seconds_count', label) or 1
+        print(f"{label:50} {len(route_timings):>7} {percentile(route_timings, 0.5):>8.2f} "
+              f"{percentile(route_timings, 0.95):>8.2f} {percentile(route_timings, 0.99):>8.2f} "
+              f"{delta('library_db_statements_total', label) / requests:>10.1f} "
+              f"{delta('library_db_time_seconds_total', label) * 1000 / requests:>10.2f} "
+              f"{delta('library_db_rows_total', label) / requests:>9.1f}")
+    return 1 if failures else 0
+
+
+# statements per GET /books?expand=authors,publisher page at several page sizes,
+# read from the app's own /metrics counters; fails if the count grows with the page
+def expand(args):
+    client = app.test_client()
+    counts = {}
+    for limit in args.page_sizes:
+        before = scrape_metrics(client)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            response = client.get('/books', query_string={'limit': limit, 'expand': 'authors,publisher'})
+            assert response.status_code == 200, response.get_json()
+        elapsed = (time.perf_counter() - started) / args.repeat
+        after = scrape_metrics(client)
+        books = len(response.get_json())
+
+        def delta(metric):
+            return after.get((metric, 'GET /books'), 0) - before.get((metric, 'GET /books'), 0)
+
+        counts[limit] = delta('library_db_statements_total') / (delta('library_request_duration_seconds_count') or 1)
+        print(f"limit {limit:>5}: {books:>5} books, {counts[limit]:.1f} statements/request, {elapsed * 1000:.2f} ms/request")
+
+    if len(set(counts.values())) > 1:
+        print("statement count depends on the page size")
+        return 1
+    print("statement count is independent of the page size")
+    return 0
+
+
+# GET each editable record and PUT it back with the GET's ETag in If-Match. the
+# PUT must apply and a replay with the same ETag must get 412, or 409 when the
+# stale version is sent in the body. an If-Match that isn't one of ours falls back
+# to the RowVersion in the body, a RowVersion that isn't a number gets 400 and a
+# PUT with no version at all gets 428
+def version_check(args):
+    connection = create_connection()
+    cursor = connection.cursor()
+    book_id = create_book(cursor, 3)
+    movie_id = create_movie(cursor, 3)
+    card_ids = create_accounts(cursor, 1)
+    card_id = card_ids[0]
+    cursor.execute("""
+        INSERT INTO Reviews (CardID, ItemID, Comments, Rating)
+        VALUES (%s, %s, 'Benchmark review', 4)
+    """, (card_id, book_id))
+    connection.commit()
+
+    client = app.test_client()
+    response = client.post('/reservations', json={"ItemID": book_id, "CardID": card_id})
+    assert response.status_code == 201, response.get_json()
+    reservation_id = response.get_json()['ReservationID']
+
+    book_fields = ('Language', 'Genre', 'Title', 'PublicationYear', 'NumCopies', 'BookType', 'PublisherID')
+    movie_fields = ('Language', 'Title', 'PublicationYear', 'NumCopies', 'Genre', 'Director', 'MovieType')
+    records = [
+        ('book', f'/books/{book_id}', f'/books/{book_id}',
+         lambda row: {field: row[field] for field in book_fields}),
+        ('movie', f'/movies/{movie_id}', f'/movies/{movie_id}',
+         lambda row: {field: row[field] for field in movie_fields}),
+        ('account', f'/accounts/person/{card_id}', f'/accounts/person/{card_id}',
+         lambda row: {"Name": row['Name'], "OverdueFees": row['OverdueFees']}),
+        ('review', f'/reviews/person/{card_id}/item/{book_id}', f'/reviews/person/{card_id}',
+         lambda row: {"ItemID": row['ItemID'], "Comments": row['Comments'], "Rating": row['Rating']}),
+        ('reservation', f'/reservations/{reservation_id}', f'/reservations/{reservation_id}',
+         lambda row: {"ItemID": row['ItemID'], "CardID": row['CardID'], "PlaceInLine": 1}),
+    ]
+
+    failures = []
+    try:
+        for name, get_path, put_path, put_body in records:
+            read = client.get(get_path)
+            etag = read.headers.get('ETag')
+            body = put_body(read.get_json())
+            statuses = {
+                "If-Match from GET": client.put(put_path, json=body, headers={'If-Match': etag}).status_code,
+                "replayed If-Match": client.put(put_path, json=body, headers={'If-Match': etag}).status_code,
+                "stale body RowVersion": client.put(put_path, json={**body, "RowVersion": read.get_json()['RowVersion']}).status_code,
+            }
+            current = client.get(get_path).get_json()['RowVersion']
+            statuses["foreign If-Match, body RowVersion"] = client.put(
+                put_path, json={**body, "RowVersion": current}, headers={'If-Match': '"unrelated"'}).status_code
+            statuses["malformed RowVersion"] = client.put(put_path, json={**body, "RowVersion": "one"}).status_code
+            statuses["no version"] = client.put(put_path, json=body).status_code
+
+            expected = {"If-Match from GET": 200, "replayed If-Match": 412, "stale body RowVersion": 409,
+                        "foreign If-Match, body RowVersion": 200, "malformed RowVersion": 400, "no version": 428}
+            for case, status in statuses.items():
+                ok = status == expected[case]
+                print(f"{name:12} {case:36} {status} {'ok' if ok else f'expected {expected[case]}'}")
+                if not ok:
+                    failures.append((name, case))
+    finally:
+        delete_rows(cursor, [book_id, movie_id], card_ids)
+        connection.commit()
+        cursor.close()
+        connection.close()
+
+    return 1 if failures else 0
+
+
+# GET routes explain leaves out: the shelf index and the catalog counts are read
+# whole on purpose, and the health and metrics routes don't touch the catalog
+EXPLAIN_SKIPPED = {
+    '/items/<int:item_id>/location', '/shelves/<int:shelf_id>/items', '/stats/catalog',
+    '/health/live', '/health/ready', '/metrics', '/cache/metrics', '/pool/metrics',
+}
+# sample values for the path parameters, and the query strings that change what
+# a route runs (each route is also requested without one)
+EXPLAIN_PATH_PARAMS = {'item_id': 1, 'card_id': 3, 'author_id': 1, 'reservation_id': 1}
+EXPLAIN_QUERY_STRINGS = {
+    '/books': ['?Genre=Mystery', '?Language=EN&year_from=1990', '?expand=authors,publisher'],
+    '/movies': ['?Language=EN', '?Genre=Drama'],
+    '/books/<int:item_id>': ['?expand=authors,publisher'],
+    '/checkouts/person/<int:card_id>': ['?open=true'],
+    '/items': ['?ids=1,2,101'],
+    '/items/top-rated': ['?genre=Mystery'],
+    '/search': ['?q=garden'],
+}
+# statements no request shows through InstrumentedCursor: the lookups inside the
+# stored procedures (EXPLAIN can't look into a CALL) and the /events poll, which
+# runs on a connection of its own
+PROCEDURE_QUERIES = [
+    ("CheckOutItem: item state", "SELECT CopiesAvailable, ReservationCount FROM LibraryItemState WHERE ItemID = %s", (1,)),
+    ("CheckOutItem: patron's hold", "SELECT ReservationID, QueueSeq FROM ReserveLibraryItem WHERE ItemID = %s AND CardID = %s ORDER BY QueueSeq LIMIT 1", (1, 3)),
+    ("CheckOutItem: holds ahead", "SELECT 1 FROM ReserveLibraryItem WHERE ItemID = %s AND QueueSeq < %s LIMIT 5", (1, 3)),
+    ("ReturnItem: checkout", "SELECT ItemID, CardID, ReturnByDate FROM CheckOutLibraryItem WHERE CheckoutID = %s", (1,)),
+    ("ReturnItem: already returned", "SELECT ReturnID FROM ReturnLibraryItem WHERE CheckoutID = %s", (1,)),
+    ("ReturnItem: accrued fee", "SELECT AccruedFee FROM OpenLoans WHERE CheckoutID = %s", (1,)),
+    ("CancelReservation: reservation", "SELECT ItemID, CardID FROM ReserveLibraryItem WHERE ReservationID = %s", (1,)),
+    ("MoveReservation: target seq", "SELECT QueueSeq FROM ReserveLibraryItem WHERE ItemID = %s AND ReservationID <> %s ORDER BY QueueSeq LIMIT 0, 1", (1, 1)),
+    ("GET /events", EVENTS_QUERY, events_args(0, EVENTS_PAGE_SIZE)),
+]
+
+
+# request every GET route and collect the distinct statements it runs
+def route_statements():
+    requests = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or rule.endpoint == 'static' or rule.rule in EXPLAIN_SKIPPED:
+            continue
+        path = rule.rule
+        for name in rule.arguments:
+            path = re.sub(rf"<(?:\w+:)?{name}>", str(EXPLAIN_PATH_PARAMS[name]), path)
+        requests += [path + query for query in [''] + EXPLAIN_QUERY_STRINGS.get(rule.rule, [])]
+
+    client = app.test_client()
+    with capture_statements() as captured:
+        for path in requests:
+            client.get(path)
+
+    statements = {}
+    for route, statement, params in captured:
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.setdefault(normalize_sql(statement), (f"GET {route}", statement, params))
+    return list(statements.values())
+
+
+# fail if the plan for any statement a route runs reads a whole table
+def explain_routes(args):
+    connection = create_connection()
+    cursor = connection.cursor(dictionary=True)
+    full_scans = []
+    for route, query, params in route_statements() + PROCEDURE_QUERIES:
+        cursor.execute("EXPLAIN " + query, params)
+        for step in cursor.fetchall():
+            print(f"{route:45} {str(step['table']):25} {str(step['type']):8} {step['key']}")
+            if step['type'] == 'ALL':
+                full_scans.append(f"{route} scans {step['table']}: {normalize_sql(query)}")
+    cursor.close()
+    connection.close()
+
+    if full_scans:
+        print("\n".join(full_scans))
+        return 1
+    print("no full table scans")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the library database")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    stress = commands.add_parser('checkout-stress', help="parallel checkouts against one ItemID")
+    stress.add_argument('--copies', type=int, default=20)
+    stress.add_argument('--workers', type=int, default=64)
+    stress.set_defaults(run=checkout_stress)
+
+    queue = commands.add_parser('reservation-queue', help="enqueue/dequeue cost on a deep hold queue")
+    queue.add_argument('--holds', type=int, default=10000)
+    queue.set_defaults(run=reservation_queue)
+
+    loans = commands.add_parser('open-loans', help="outstanding-loan check on a long loan history")
+    loans.add_argument('--checkouts', type=int, default=10000)
+    loans.add_argument('--repeat', type=int, default=5)
+    loans.set_defaults(run=open_loans)
+
+    bulk = commands.add_parser('bulk-import', help="batched catalog import against one-at-a-time inserts")
+    bulk.add_argument('--books', type=int, default=20000)
+    bulk.set_defaults(run=bulk_import)
+
+    batch = commands.add_parser('batch-circulation', help="batch checkout/return against one call per item")
+    batch.add_argument('--items', type=int, default=50)
+    batch.set_defaults(run=batch_circulation)
+
+    fees = commands.add_parser('fee-accrual', help="accrue-fees job over a large set of open loans")
+    fees.add_argument('--loans', type=int, default=1000000)
+    fees.add_argument('--cards', type=int, default=1000)
+    fees.add_argument('--chunk-size', type=int, default=10000)
+    fees.add_argument('--seed', type=int, default=1)
+    fees.set_defaults(run=fee_accrual)
+
+    search_parser = commands.add_parser('search', help="GET /search latency percentiles")
+    search_parser.add_argument('--queries', type=int, default=1000)
+    search_parser.add_argument('--target-ms', type=float, default=20)
+    search_parser.add_argument('--seed', type=int, default=1)
+    search_parser.set_defaults(run=search)
+
+    load_parser = commands.add_parser('load', help="requests/sec and latency against a running server")
+    load_parser.add_argument('--url', default='http://127.0.0.1:5000')
+    load_parser.add_argument('--concurrency', type=int, default=32)
+    load_parser.add_argument('--duration', type=float, default=30)
+    load_parser.add_argument('--items', type=int, default=40)
+    load_parser.add_argument('--cards', type=int, default=30)
+    load_parser.set_defaults(run=load)
+
+    generate_parser = commands.add_parser('generate', help="replace the database with a deterministic synthetic dataset")
+    generate_parser.add_argument('--accounts', type=int, default=20000)
+    generate_parser.add_argument('--books', type=int, default=50000)
+    generate_parser.add_argument('--movies', type=int, default=10000)
+    generate_parser.add_argument('--authors', type=int, default=10000)
+    generate_parser.add_argument('--publishers', type=int, default=200)
+    generate_parser.add_argument('--history', type=int, default=500000, help="checkouts in the loan history")
+    generate_parser.add_argument('--holds', type=int, default=20000)
+    generate_parser.add_argument('--reviews', type=int, default=50000)
+    generate_parser.add_argument('--seed', type=int, default=1)
+    generate_parser.add_argument('--yes', action='store_true', help="confirm the database is disposable")
+    generate_parser.set_defaults(run=generate)
+
+    workload_parser = commands.add_parser('workload', help="scripted request mix with per-route latency and query counts")
+    workload_parser.add_argument('--mix', choices=sorted(WORKLOAD_MIXES), default='browse')
+    workload_parser.add_argument('--concurrency', type=int, default=8)
+    workload_parser.add_argument('--duration', type=float, default=30)
+    workload_parser.add_argument('--seed', type=int, default=1)
+    workload_parser.set_defaults(run=workload)
+
+    expand_parser = commands.add_parser('expand', help="statements per expanded GET /books page at several page sizes")
+    expand_parser.add_argument('--page-sizes', type=int, nargs='+', default=[10, 100, 1000])
+    expand_parser.add_argument('--repeat', type=int, default=20)
+    expand_parser.set_defaults(run=expand)
+
+    versions = commands.add_parser('version-check', help="GET then PUT with the ETag on every versioned update route")
+    versions.set_defaults(run=version_check)
+
+    explain = commands.add_parser('explain', help="fail if a route's query falls back to a full scan")
+    explain.set_defaults(run=explain_routes)
+
+    args = parser.parse_args()
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
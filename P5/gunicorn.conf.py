@@ -0,0 +1,32 @@
+# production launch:
+#   gunicorn -c gunicorn.conf.py library_flask_app:app
+# the app is imported once in the master and forked into the workers; each worker
+# then replaces the master's (never used) pool with its own in post_fork. on
+# SIGTERM gunicorn stops accepting new requests and waits up to graceful_timeout
+# for in-flight ones (and so their transactions) to finish before the worker's
+# pool is closed
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 4))
+preload_app = True
+
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# recycle workers now and then so a slow leak can't build up
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def post_fork(server, worker):
+    import library_flask_app
+    library_flask_app.init_pool()
+
+
+def worker_exit(server, worker):
+    import library_flask_app
+    library_flask_app.pool.close(timeout=graceful_timeout)
@@ -0,0 +1,499 @@
+# ASGI serving mode for the library API, e.g.
+#   uvicorn library_async_app:asgi_app --workers 4
+# the circulation routes, the cached book/account lookups and the /events long
+# poll and stream are served natively on an aiomysql pool so a request waiting on
+# MySQL (or for the next event) doesn't hold a thread. every
+# other route is passed through to the Flask app, so the routes and JSON
+# responses are the same as the WSGI mode
+import asyncio
+import logging
+import os
+import random
+import re
+import secrets
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import aiomysql
+from starlette.applications import Starlette
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route, request_response
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+from library_flask_app import (app, cache, book_key, account_key, version_etag, log_event, route_metrics, is_lease,
+                               RequestStats, RedisCache, ENCODING_SUFFIXES, SIGNAL_EXCEPTION, COMPRESS_MIN_BYTES,
+                               LEASE_PREFIX, LEASE_TTL,
+                               MAX_RETRIES, RETRYABLE_ERRORS, MAX_PAGE_SIZE, EVENTS_PAGE_SIZE, EVENTS_MAX_WAIT,
+                               EVENTS_POLL_INTERVAL, EVENTS_STREAM_SECONDS, EVENTS_QUERY, events_args, contiguous_events)
+
+db_pool = None
+async_cache = None
+wsgi_app = WSGIMiddleware(app)
+# the RequestStats of the native request being served, the async stand-in for
+# library_flask_app.request_stats()
+request_stats = ContextVar('request_stats', default=None)
+
+
+# async twin of library_flask_app.RedisCache on a redis.asyncio client, so a cache
+# round trip doesn't block the event loop. it shares the Flask app's RedisCache
+# ttl and hit/miss counters, so /cache/metrics covers both kinds of route
+class AsyncRedisCache:
+    def __init__(self, cache, url):
+        self.cache = cache
+        self.client = aioredis.Redis.from_url(url)
+        self._fill = self.client.register_script(RedisCache.FILL_SCRIPT)
+
+    async def get(self, key):
+        data = await self.client.get(key)
+        value = app.json.loads(data) if data is not None else None
+        if value is None or is_lease(value):
+            self.cache.misses += 1
+            return None
+        self.cache.hits += 1
+        return value
+
+    async def lease(self, key):
+        token = LEASE_PREFIX + secrets.token_hex(8)
+        if await self.client.set(key, app.json.dumps(token), ex=LEASE_TTL, nx=True):
+            return token
+        return None
+
+    async def fill(self, key, token, value):
+        await self._fill(keys=[key], args=[app.json.dumps(token), app.json.dumps(value), self.cache.ttl])
+
+    async def delete(self, *keys):
+        if keys:
+            self.cache.invalidations += await self.client.delete(*keys)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# the in-process backends (LRUCache, NoCache) never wait on I/O, so the native
+# routes use the Flask app's instance directly behind the same async interface
+class AsyncLocalCache:
+    def __init__(self, cache):
+        self.cache = cache
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def lease(self, key):
+        return self.cache.lease(key)
+
+    async def fill(self, key, token, value):
+        self.cache.fill(key, token, value)
+
+    async def delete(self, *keys):
+        self.cache.delete(*keys)
+
+    async def close(self):
+        pass
+
+
+def create_async_cache():
+    if isinstance(cache, RedisCache) and aioredis is not None:
+        return AsyncRedisCache(cache, os.getenv('CACHE_REDIS_URL'))
+    return AsyncLocalCache(cache)
+
+
+# async twin of library_flask_app.invalidate
+async def invalidate(*keys):
+    if keys:
+        await async_cache.delete(*keys)
+
+
+@asynccontextmanager
+async def lifespan(asgi_app):
+    global db_pool, async_cache
+    async_cache = create_async_cache()
+    db_pool = await aiomysql.create_pool(
+        host="127.0.0.1",
+        user="root",
+        password=os.getenv('DB_PASSWORD'),
+        db="Library",
+        minsize=1,
+        maxsize=int(os.getenv('DB_POOL_SIZE', 10)),
+        pool_recycle=3600,
+        # each read sees the latest committed rows instead of the snapshot its
+        # pooled connection opened on first use; the procedures open their own
+        # transactions
+        autocommit=True,
+    )
+    yield
+    db_pool.close()
+    await db_pool.wait_closed()
+    await async_cache.close()
+
+
+# serialize with the Flask app's JSON provider so dates and decimals come out
+# exactly as jsonify() writes them
+def json_response(body, status, etag=None):
+    headers = {'ETag': f'"{etag}"'} if etag else None
+    return Response(app.json.dumps(body), status_code=status, media_type='application/json', headers=headers)
+
+
+# the request body as a JSON object, or None when it's malformed or not an object,
+# which the routes answer with 400 like Flask's get_json() does
+async def json_body(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def bad_body():
+    return json_response({"error": "Request body must be a JSON object"}, 400)
+
+
+# async twin of library_flask_app.not_modified
+def not_modified(request, etag):
+    if_none_match = parse_etags(request.headers.get('if-none-match'))
+    if any(if_none_match.contains(etag + suffix) for suffix in ENCODING_SUFFIXES):
+        return Response(status_code=304, headers={'ETag': f'"{etag}"'})
+    return None
+
+
+# a native route that hands requests using `param` (e.g. ?expand=) to the Flask
+# route, which is the only one that implements it
+class UnlessQueryParam:
+    def __init__(self, param, endpoint):
+        self.param = param
+        self.endpoint = endpoint
+
+    async def __call__(self, scope, receive, send):
+        handler = wsgi_app if self.param in Request(scope).query_params else self.endpoint
+        await handler(scope, receive, send)
+
+
+# record native requests in the same route metrics as the Flask routes, labelled
+# with the Flask rule, e.g. /books/<int:item_id>, so both modes share series
+def observed(path, endpoint):
+    route = re.sub(r"\{(\w+):(\w+)\}", r"<\2:\1>", path)
+
+    async def handler(request):
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await endpoint(request)
+            status = response.status_code
+            return response
+        finally:
+            request_stats.reset(token)
+            route_metrics.observe(request.method, route, status, time.perf_counter() - started, stats)
+    return handler
+
+
+# the async counterparts of get_db() and InstrumentedCursor: count the wait for a
+# connection and each statement against the current request
+@asynccontextmanager
+async def acquire():
+    started = time.perf_counter()
+    async with db_pool.acquire() as connection:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.acquire_time += time.perf_counter() - started
+        yield connection
+
+
+async def execute(cursor, statement, args):
+    started = time.perf_counter()
+    await cursor.execute(statement, args)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += time.perf_counter() - started
+        stats.rows += max(cursor.rowcount, 0) if cursor.description else 0
+
+
+# async twin of library_flask_app.call_procedure
+async def call_procedure(name, args):
+    statement = f"CALL {name}({', '.join(['%s'] * len(args))})"
+    async with acquire() as connection:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with connection.cursor() as cursor:
+                    await execute(cursor, statement, args)
+                    row = await cursor.fetchone()
+                    while await cursor.nextset():
+                        pass
+                await connection.commit()
+                return row
+            except aiomysql.Error as err:
+                await connection.rollback()
+                if err.args[0] not in RETRYABLE_ERRORS or attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+
+async def fetch_one(query, args):
+    async with acquire() as connection:
+        async with connection.cursor(aiomysql.DictCursor) as cursor:
+            await execute(cursor, query, args)
+            return await cursor.fetchone()
+
+
+# endpoints for CheckoutLibraryItem
+async def checkout_item(request):
+    data = await json_body(request)
+    if data is None:
+        return bad_body()
+    card_id = data.get('CardID')
+    item_id = data.get('ItemID')
+    borrow_date = data.get('BorrowDate')
+    return_by_date = data.get('ReturnByDate')
+
+    if not card_id or not item_id or not borrow_date or not return_by_date:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        status, checkout_id = await call_procedure('CheckOutItem', (item_id, card_id, borrow_date, return_by_date))
+        await invalidate(account_key(card_id))
+
+        if status == 'NOT_FOUND':
+            return json_response({"message": "Item not found"}, 404)
+        if status == 'FORBIDDEN':
+            return json_response({"message": "Item is not available for checkout, please place a reservation if you wish to obtain a copy"}, 403)
+
+        return json_response({"message": "Item checked out successfully", "CheckoutID": checkout_id}, 201)
+    except aiomysql.Error as err:
+        return json_response({"error": str(err)}, 500)
+
+
+async def renew_item(request):
+    card_id = request.path_params['card_id']
+    data = await json_body(request)
+    if data is None:
+        return bad_body()
+    checkout_id = data.get('CheckoutID')
+    return_by_date = data.get('ReturnByDate')
+
+    if not checkout_id or not card_id or not return_by_date:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        status, _ = await call_procedure('RenewItem', (checkout_id, card_id, return_by_date))
+
+        if status == 'NOT_FOUND':
+            return json_response({"message": f"Checkout with CheckoutID {checkout_id} not found"}, 404)
+        if status == 'FORBIDDEN':
+            return json_response({"message": f"Checkout {checkout_id} was not authored by CardID {card_id}, you cannot renew this checkout"}, 403)
+
+        await invalidate(account_key(card_id))
+        return json_response({"message": "Checkout renewed successfully"}, 201)
+    except aiomysql.Error as err:
+        if err.args[0] == SIGNAL_EXCEPTION:
+            return json_response({"message": f"Checkout {checkout_id} already returned"}, 403)
+        return json_response({"error": str(err)}, 500)
+
+
+async def return_checked_out_item(request):
+    checkout_id = request.path_params['checkout_id']
+    data = await json_body(request)
+    if data is None:
+        return bad_body()
+    return_date = data.get('ReturnDate')
+
+    if not checkout_id or not return_date:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        status, _, borrower_id = await call_procedure('ReturnItem', (checkout_id, return_date))
+        await invalidate(account_key(borrower_id))
+
+        if status == 'NOT_FOUND':
+            return json_response({"message": f"Checkout record with CheckoutID {checkout_id} not found"}, 404)
+        if status == 'FORBIDDEN':
+            return json_response({"message": f"Checkout {checkout_id} already returned"}, 403)
+
+        return json_response({"message": "Item returned successfully"}, 200)
+    except aiomysql.Error as err:
+        return json_response({"error": str(err)}, 500)
+
+
+# async twin of library_flask_app.versioned_get
+async def versioned_get(request, cache_key, table, key_column, key_value, columns, not_found):
+    row = await async_cache.get(cache_key)
+    if row is None:
+        token = await async_cache.lease(cache_key)
+        try:
+            row = await fetch_one(f"SELECT {columns} FROM {table} WHERE {key_column} = %s", (key_value,))
+        except aiomysql.Error as err:
+            return json_response({"error": str(err)}, 500)
+        if not row:
+            return json_response({"message": not_found}, 404)
+        if token:
+            await async_cache.fill(cache_key, token, row)
+
+    etag = version_etag(row['RowVersion'])
+    return not_modified(request, etag) or json_response(row, 200, etag)
+
+
+# endpoints for Books and LibraryAccounts
+async def get_book_by_id(request):
+    item_id = request.path_params['item_id']
+    return await versioned_get(request, book_key(item_id), 'Books', 'ItemID', item_id, '*', f"No book found with ItemID {item_id}")
+
+
+async def get_account_by_person(request):
+    card_id = request.path_params['card_id']
+    return await versioned_get(request, account_key(card_id), 'LibraryAccount', 'CardID', card_id,
+                               '*, OverdueFees + AccruedFees AS Balance', f"No account found for CardID {card_id}")
+
+
+# endpoints for ReserveLibraryItem
+async def add_reservation(request):
+    data = await json_body(request)
+    if data is None:
+        return bad_body()
+    item_id = data.get('ItemID')
+    card_id = data.get('CardID')
+
+    if not item_id or not card_id:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        status, reservation_id = await call_procedure('ReserveItem', (item_id, card_id))
+        await invalidate(account_key(card_id))
+
+        if status == 'NOT_FOUND':
+            return json_response({"message": "Item not found"}, 404)
+
+        return json_response({
+            "message": "Reservation added successfully",
+            "ReservationID": reservation_id
+        }, 201)
+    except aiomysql.Error as err:
+        return json_response({"error": str(err)}, 500)
+
+
+async def delete_reservation(request):
+    card_id = request.path_params['card_id']
+    data = await json_body(request)
+    if data is None:
+        return bad_body()
+    reservation_id = data.get('ReservationID')
+
+    if not reservation_id or not card_id:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        status, _ = await call_procedure('CancelReservation', (reservation_id, card_id))
+        await invalidate(account_key(card_id))
+
+        if status == 'NOT_FOUND':
+            return json_response({"message": f"No reservation found for ReservationID {reservation_id}"}, 404)
+        if status == 'FORBIDDEN':
+            return json_response({"message": f"Reservation {reservation_id} was not authored by CardID {card_id}, you cannot delete this reservation"}, 403)
+
+        return json_response({"message": "Reservation deleted successfully"}, 200)
+    except aiomysql.Error as err:
+        return json_response({"error": str(err)}, 500)
+
+
+# endpoints for CirculationEvents, async twins of the ones in library_flask_app.
+# waiting listeners cost a coroutine each, so there is no listener cap here
+async def fetch_events(after, limit):
+    async with acquire() as connection:
+        async with connection.cursor(aiomysql.DictCursor) as cursor:
+            await execute(cursor, EVENTS_QUERY, events_args(after, limit))
+            rows = await cursor.fetchall()
+    return contiguous_events(rows, after)
+
+
+async def poll_events(after, limit, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        events = await fetch_events(after, limit)
+        if events or time.monotonic() >= deadline:
+            return events
+        await asyncio.sleep(min(EVENTS_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+
+async def event_stream(after, limit):
+    deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+    yield f"retry: {int(EVENTS_POLL_INTERVAL * 1000)}\n\n"
+    while time.monotonic() < deadline:
+        try:
+            events = await poll_events(after, limit, min(EVENTS_MAX_WAIT, deadline - time.monotonic()))
+        except aiomysql.Error as e:
+            # the client reconnects with Last-Event-ID and carries on from there
+            log_event(logging.WARNING, "event_stream_failed", error=str(e), after=after)
+            return
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event in events:
+            yield f"id: {event['EventID']}\nevent: {event['EventType']}\ndata: {app.json.dumps(event)}\n\n"
+        after = events[-1]['EventID']
+
+
+# the value of a query parameter or header, or `default` when it's missing or malformed
+def parse_number(value, default, type=int):
+    try:
+        return type(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+async def get_events(request):
+    after = parse_number(request.query_params.get('after'), 0)
+    limit = max(1, min(parse_number(request.query_params.get('limit'), EVENTS_PAGE_SIZE), MAX_PAGE_SIZE))
+
+    if parse_accept_header(request.headers.get('accept'), MIMEAccept).best == 'text/event-stream':
+        after = parse_number(request.headers.get('last-event-id'), after)
+        return StreamingResponse(event_stream(after, limit), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    wait = max(0.0, min(parse_number(request.query_params.get('wait'), 0, float), EVENTS_MAX_WAIT))
+    try:
+        events = await poll_events(after, limit, wait)
+    except aiomysql.Error as err:
+        return json_response({"error": str(err)}, 500)
+
+    next_after = events[-1]['EventID'] if events else after
+    response = json_response({"events": events, "next_after": next_after}, 200)
+    response.headers['X-Next-After'] = str(next_after)
+    return response
+
+
+# native responses are gzipped here, as compress_response() does for the Flask
+# routes (which compress their own, so requests handed to Flask skip this). /events
+# opts out so stream frames aren't held back in the compressor
+def native_route(path, endpoint, method, unless_param=None, compress=True):
+    endpoint = request_response(observed(path, endpoint))
+    if compress:
+        endpoint = GZipMiddleware(endpoint, minimum_size=COMPRESS_MIN_BYTES)
+    if unless_param:
+        endpoint = UnlessQueryParam(unless_param, endpoint)
+    return Route(path, endpoint, methods=[method])
+
+
+asgi_app = Starlette(
+    routes=[
+        native_route('/checkouts', checkout_item, 'POST'),
+        native_route('/checkouts/person/{card_id:int}', renew_item, 'PUT'),
+        native_route('/checkouts/{checkout_id:int}', return_checked_out_item, 'DELETE'),
+        native_route('/books/{item_id:int}', get_book_by_id, 'GET', unless_param='expand'),
+        native_route('/accounts/person/{card_id:int}', get_account_by_person, 'GET'),
+        native_route('/reservations', add_reservation, 'POST'),
+        native_route('/reservations/person/{card_id:int}', delete_reservation, 'DELETE'),
+        native_route('/events', get_events, 'GET', compress=False),
+        # everything else, including other methods on the paths above
+        Mount('/', app=wsgi_app),
+    ],
+    lifespan=lifespan,
+)
@@ -1,14 +1,48 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_request_context
+import click
 import mysql.connector
 from mysql.connector import Error
 from dotenv import load_dotenv
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+from decimal import Decimal
+import csv
+import gzip
+import hashlib
+import io
+import json
+import logging
 import os
+import random
+import re
+import secrets
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Create the Flask app
 app = Flask(__name__)
 
 load_dotenv()
+
+# structured logging: each message is one JSON object so the log can be filtered by field
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger('library')
+
+
+def log_event(level, event, **fields):
+    logger.log(level, json.dumps({"event": event, **fields}, default=str))
+
 # connect to the database
 def create_connection():
     try:
@@ -17,38 +51,1055 @@ def create_connection():
             user="root",
             password=os.getenv('DB_PASSWORD'),
             database="Library",
+            buffered=True,
         )
         if connection.is_connected():
-            print("Connected to the database")
+            log_event(logging.INFO, "db_connected")
         return connection
     except Error as e:
-        print(f"Error: {e}")
+        log_event(logging.ERROR, "db_connect_failed", error=str(e))
+        return None
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# fixed-size pool of reusable connections so requests don't pay for a new
+# TCP/auth handshake each time. a connection that has sat idle for longer than
+# ping_after seconds is pinged before being handed out; one returned moments ago
+# is lent as is, and a failure on it surfaces as an ordinary query error
+class ConnectionPool:
+    def __init__(self, size, timeout, ping_after=30):
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        # (connection, time.monotonic() when it was returned)
+        self._idle = []
+        self._opened = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._lock = threading.Condition()
+        self.closed = False
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._lock:
+            if self.closed:
+                raise Error("Connection pool is closed")
+            while not self._idle and self._opened >= self.size:
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._record_wait(time.monotonic() - start)
+                    raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+                self._waiters += 1
+                self._lock.wait(remaining)
+                self._waiters -= 1
+            connection, released_at = self._idle.pop() if self._idle else (None, None)
+            if connection is None:
+                self._opened += 1
+            self._in_use += 1
+            self._checkouts += 1
+            self._record_wait(time.monotonic() - start)
+
+        # health check on borrow for connections idle long enough to have been
+        # dropped by the server or a proxy, replacing the connection if it has gone away
+        if (connection is not None and time.monotonic() - released_at > self.ping_after
+                and not self._is_healthy(connection)):
+            connection = None
+        if connection is None:
+            connection = create_connection()
+        if connection is None:
+            self._discard()
+            raise Error("Failed to connect to the database")
+        return connection
+
+    def release(self, connection):
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except Error:
+            self._discard(connection)
+            return
+        with self._lock:
+            if not self.closed:
+                self._in_use -= 1
+                self._idle.append((connection, time.monotonic()))
+                self._lock.notify()
+                return
+        self._discard(connection)
+
+    # stop lending connections, give the ones in use up to `timeout` seconds to
+    # come back so their transactions can finish, then close everything
+    def close(self, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self.closed = True
+            while self._in_use and time.monotonic() < deadline:
+                self._lock.wait(deadline - time.monotonic())
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        for connection, _ in idle:
+            try:
+                connection.close()
+            except Error:
+                pass
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._opened,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiters": self._waiters,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "total_wait_seconds": round(self._wait_time, 6),
+                "avg_wait_seconds": round(self._wait_time / (self._checkouts + self._timeouts), 6)
+                if self._checkouts + self._timeouts else 0.0,
+                "max_wait_seconds": round(self._max_wait_time, 6),
+            }
+
+    # every acquire counts, including the ones that time out, which are the longest
+    # waits of all; called with the lock held
+    def _record_wait(self, waited):
+        self._wait_time += waited
+        self._max_wait_time = max(self._max_wait_time, waited)
+
+    def _is_healthy(self, connection):
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Error:
+            try:
+                connection.close()
+            except Error:
+                pass
+            return False
+
+    def _discard(self, connection=None):
+        if connection is not None:
+            try:
+                connection.close()
+            except Error:
+                pass
+        with self._lock:
+            self._opened -= 1
+            self._in_use -= 1
+            self._lock.notify_all()
+
+
+# each process needs its own pool; connections must never be shared across a
+# fork, so forking servers call init_pool() again in every worker. the pool opens
+# connections on demand, so the one built at import in gunicorn's master stays empty
+def init_pool():
+    global pool
+    pool = ConnectionPool(
+        size=int(os.getenv('DB_POOL_SIZE', 10)),
+        timeout=float(os.getenv('DB_POOL_TIMEOUT', 5)),
+        ping_after=float(os.getenv('DB_POOL_PING_AFTER', 30)),
+    )
+
+
+init_pool()
+
+
+# query instrumentation. get_db() hands routes an InstrumentedConnection whose
+# cursors time every statement into the current request's RequestStats; statements
+# slower than SLOW_QUERY_MS are logged with their SQL normalized
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+
+
+class RequestStats:
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.acquire_time = 0.0
+
+
+def request_stats():
+    if 'query_stats' not in g:
+        g.query_stats = RequestStats()
+    return g.query_stats
+
+
+# one shape per statement: whitespace collapsed, literals and placeholders made ?,
+# and IN lists of any length folded together
+def normalize_sql(statement):
+    statement = re.sub(r"\s+", ' ', statement).strip()
+    statement = re.sub(r"'(?:[^'\\]|\\.)*'", '?', statement)
+    statement = re.sub(r"\b\d+(?:\.\d+)?\b", '?', statement)
+    statement = statement.replace('%s', '?')
+    return re.sub(r"\(\?(?:, \?)+\)", '(?, ...)', statement)
+
+
+# while capture_statements() is active, every statement a route executes is
+# appended here as (route rule, statement, params); `benchmark.py explain` uses
+# it to EXPLAIN exactly what the routes run
+captured_statements = None
+
+
+@contextmanager
+def capture_statements():
+    global captured_statements
+    captured_statements = []
+    try:
+        yield captured_statements
+    finally:
+        captured_statements = None
+
+
+class InstrumentedCursor:
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, operation, params=None, multi=False):
+        if captured_statements is not None:
+            captured_statements.append((request.url_rule.rule if has_request_context() and request.url_rule else None,
+                                        operation, params))
+        started = time.perf_counter()
+        if multi:
+            return self._timed_results(operation, self._cursor.execute(operation, params, multi=True), started)
+        self._cursor.execute(operation, params)
+        self._record(operation, time.perf_counter() - started, self._cursor.rowcount if self._cursor.with_rows else 0)
+
+    def executemany(self, operation, seq_params):
+        started = time.perf_counter()
+        self._cursor.executemany(operation, seq_params)
+        self._record(operation, time.perf_counter() - started, 0)
+
+    # multi=True results arrive as the caller iterates, so the clock stops when they're done
+    def _timed_results(self, operation, results, started):
+        rows = 0
+        try:
+            for result in results:
+                if result.with_rows:
+                    rows += result.rowcount
+                yield result
+        finally:
+            self._record(operation, time.perf_counter() - started, rows)
+
+    def _record(self, operation, elapsed, rows):
+        self._stats.statements += 1
+        self._stats.db_time += elapsed
+        self._stats.rows += max(rows, 0)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            route_metrics.count_slow_query()
+            log_event(logging.WARNING, "slow_query", duration_ms=round(elapsed * 1000, 3), rows=rows,
+                      route=request.url_rule.rule if has_request_context() and request.url_rule else None,
+                      statement=normalize_sql(operation))
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    def __init__(self, connection, stats):
+        self.raw = connection
+        self._stats = stats
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self.raw.cursor(*args, **kwargs), self._stats)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+# borrow one pooled connection per request; it is given back in teardown_db
+# no matter how the route exits
+def get_db():
+    if 'db' not in g:
+        started = time.perf_counter()
+        try:
+            connection = pool.acquire()
+        except (Error, PoolTimeout) as e:
+            log_event(logging.ERROR, "db_acquire_failed", error=str(e))
+            return None
+        stats = request_stats()
+        stats.acquire_time += time.perf_counter() - started
+        g.db = InstrumentedConnection(connection, stats)
+    return g.db
+
+
+# MySQL error codes that mean the transaction was rolled back and can simply be retried
+RETRYABLE_ERRORS = (1205, 1213)  # lock wait timeout, deadlock
+DUPLICATE_ENTRY = 1062
+SIGNAL_EXCEPTION = 1644  # SIGNAL SQLSTATE '45000' from a stored procedure
+MAX_RETRIES = int(os.getenv('DB_MAX_RETRIES', 5))
+
+
+# run work(cursor) as one transaction and commit it. deadlocks and lock wait
+# timeouts roll back and are retried with jittered exponential backoff
+def run_transaction(connection, work, dictionary=False):
+    for attempt in range(MAX_RETRIES + 1):
+        cursor = connection.cursor(dictionary=dictionary)
+        try:
+            result = work(cursor)
+            connection.commit()
+            return result
+        except Error as err:
+            connection.rollback()
+            if err.errno not in RETRYABLE_ERRORS or attempt == MAX_RETRIES:
+                raise
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+        finally:
+            cursor.close()
+
+
+# run one of the circulation procedures from library_mysql_script.sql in a single
+# round trip and commit it; each one answers with a (Status, ResultID) row
+def call_procedure(connection, name, args):
+    statement = f"CALL {name}({', '.join(['%s'] * len(args))})"
+
+    def work(cursor):
+        row = None
+        for result in cursor.execute(statement, args, multi=True):
+            if result.with_rows and row is None:
+                row = result.fetchone()
+        return row
+
+    return run_transaction(connection, work)
+
+
+# a loan is outstanding until it has a row in ReturnLibraryItem, whether or not
+# its ReturnByDate has passed. the circulation procedures keep those loans in
+# OpenLoans, so this is one index probe instead of a lookup per historical loan
+def has_open_loans(cursor, item_id):
+    cursor.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM OpenLoans
+            WHERE ItemID = %s
+        )
+    """, (item_id,))
+    return cursor.fetchone()[0] == 1
+
+
+# rebuild OpenLoans from the loan history and report how far it had drifted
+@app.cli.command('reconcile-open-loans')
+@click.option('--dry-run', is_flag=True, help="Report drift without fixing it.")
+def reconcile_open_loans(dry_run):
+    connection = create_connection()
+    if connection is None:
+        raise click.ClickException("Failed to connect to the database")
+
+    cursor = connection.cursor()
+    try:
+        # loans that were never returned but are missing from OpenLoans
+        cursor.execute("""
+            INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+            SELECT c.CheckoutID, c.ItemID, c.CardID, c.BorrowDate, c.ReturnByDate
+            FROM CheckOutLibraryItem c
+            LEFT JOIN OpenLoans o ON o.CheckoutID = c.CheckoutID
+            WHERE o.CheckoutID IS NULL
+            AND NOT EXISTS (SELECT 1 FROM ReturnLibraryItem r WHERE r.CheckoutID = c.CheckoutID)
+        """)
+        missing = cursor.rowcount
+
+        # loans that have been returned but are still listed as open
+        cursor.execute("""
+            DELETE o FROM OpenLoans o
+            JOIN ReturnLibraryItem r ON r.CheckoutID = o.CheckoutID
+        """)
+        stale = cursor.rowcount
+
+        # loans whose copy in OpenLoans no longer matches the checkout
+        cursor.execute("""
+            UPDATE OpenLoans o
+            JOIN CheckOutLibraryItem c ON c.CheckoutID = o.CheckoutID
+            SET o.ItemID = c.ItemID, o.CardID = c.CardID,
+                o.BorrowDate = c.BorrowDate, o.ReturnByDate = c.ReturnByDate
+            WHERE NOT (o.ItemID <=> c.ItemID AND o.CardID <=> c.CardID
+                AND o.BorrowDate <=> c.BorrowDate AND o.ReturnByDate <=> c.ReturnByDate)
+        """)
+        changed = cursor.rowcount
+
+        if dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+    click.echo(f"OpenLoans drift: {missing} missing, {stale} already returned, {changed} out of date"
+               + (" (dry run, nothing changed)" if dry_run else ""))
+
+
+# overdue fees accrue on open loans every day, not only when an item comes back.
+# the accrue-fees job stores each open loan's fee so far in OpenLoans.AccruedFee
+# and each card's total in LibraryAccount.AccruedFees; returns move the loan's
+# fee over to OverdueFees
+OVERDUE_FEE_PER_DAY = Decimal('0.25')
+FEE_ACCRUAL_CHUNK = int(os.getenv('FEE_ACCRUAL_CHUNK', 10000))
+
+
+# split a table into primary key ranges (low, high] of at most chunk_size rows
+def key_chunks(cursor, table, key, chunk_size):
+    low = 0
+    while True:
+        cursor.execute(f"""
+            SELECT {key} FROM {table}
+            WHERE {key} > %s
+            ORDER BY {key}
+            LIMIT 1 OFFSET %s
+        """, (low, chunk_size - 1))
+        row = cursor.fetchone()
+        if row is None:
+            yield low, 2 ** 31 - 1
+            return
+        yield low, row[0]
+        low = row[0]
+
+
+# fees are recomputed from ReturnByDate rather than added to, so running the job
+# twice for the same day changes nothing. each chunk is its own transaction,
+# so circulation is never blocked behind the whole table. accounts whose fees
+# change get a new RowVersion and their cached rows are dropped, which retires
+# the old bodies and ETags, and a FEE_ACCRUED event with the change in AccruedFees
+def accrue_fees(connection, as_of, chunk_size=FEE_ACCRUAL_CHUNK):
+    cursor = connection.cursor()
+    loans = accounts = 0
+    try:
+        for low, high in key_chunks(cursor, 'OpenLoans', 'CheckoutID', chunk_size):
+            cursor.execute("""
+                UPDATE OpenLoans
+                SET AccruedFee = GREATEST(DATEDIFF(%s, ReturnByDate), 0) * %s
+                WHERE CheckoutID > %s AND CheckoutID <= %s
+            """, (as_of, OVERDUE_FEE_PER_DAY, low, high))
+            loans += cursor.rowcount
+            connection.commit()
+
+        for low, high in key_chunks(cursor, 'LibraryAccount', 'CardID', chunk_size):
+            cursor.execute("""
+                SELECT a.CardID, COALESCE(o.Accrued, 0), a.AccruedFees FROM LibraryAccount a
+                LEFT JOIN (
+                    SELECT CardID, SUM(AccruedFee) AS Accrued FROM OpenLoans
+                    WHERE CardID > %s AND CardID <= %s
+                    GROUP BY CardID
+                ) o ON o.CardID = a.CardID
+                WHERE a.CardID > %s AND a.CardID <= %s
+                  AND NOT (a.AccruedFees <=> COALESCE(o.Accrued, 0) AND a.FeesAccruedThrough <=> %s)
+                FOR UPDATE
+            """, (low, high, low, high, as_of))
+            changes = cursor.fetchall()
+            if not changes:
+                connection.commit()
+                continue
+            accrued = {card_id: new for card_id, new, _ in changes}
+
+            accrued_case, accrued_params = case_expression('CardID', accrued)
+            cursor.execute(f"""
+                UPDATE LibraryAccount
+                SET AccruedFees = {accrued_case}, FeesAccruedThrough = %s, RowVersion = RowVersion + 1
+                WHERE CardID IN ({placeholders(accrued)})
+            """, accrued_params + [as_of] + list(accrued))
+            accounts += cursor.rowcount
+            record_events(cursor, [('FEE_ACCRUED', None, card_id, None, new - old, as_of)
+                                   for card_id, new, old in changes if new != old])
+            connection.commit()
+            invalidate(*[account_key(card_id) for card_id in accrued])
+    finally:
+        cursor.close()
+    return {"loans": loans, "accounts": accounts}
+
+
+# run nightly from cron, or by hand to bring balances up to date, e.g.
+#   flask --app library_flask_app accrue-fees --as-of 2024-03-01
+@app.cli.command('accrue-fees')
+@click.option('--as-of', type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Accrue fees up to this date (default: today).")
+@click.option('--chunk-size', type=int, default=FEE_ACCRUAL_CHUNK, show_default=True)
+def accrue_fees_command(as_of, chunk_size):
+    connection = create_connection()
+    if connection is None:
+        raise click.ClickException("Failed to connect to the database")
+
+    as_of = (as_of or datetime.now()).date()
+    try:
+        result = accrue_fees(connection, as_of, chunk_size)
+    finally:
+        connection.close()
+    click.echo(f"Accrued fees through {as_of}: {result['loans']} open loans, {result['accounts']} accounts")
+
+
+@app.teardown_appcontext
+def teardown_db(exception):
+    connection = g.pop('db', None)
+    if connection is not None:
+        pool.release(connection.raw)
+
+
+# per-route request metrics for GET /metrics. the counts are per process, so under
+# gunicorn each worker reports its own and Prometheus sums them
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+# the pool metrics that only ever go up, exported as counters so rate() works on
+# them; everything else in ConnectionPool.metrics() is a gauge
+POOL_COUNTERS = {
+    "checkouts": "library_pool_checkouts_total",
+    "timeouts": "library_pool_timeouts_total",
+    "total_wait_seconds": "library_pool_wait_seconds_total",
+}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RouteMetrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._routes = {}
+        self._slow_queries = 0
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, duration, stats):
+        with self._lock:
+            entry = self._routes.get((method, route))
+            if entry is None:
+                entry = self._routes[(method, route)] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0, "statuses": {},
+                    "statements": 0, "db_time": 0.0, "rows": 0, "acquire_time": 0.0,
+                }
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += duration
+            entry["count"] += 1
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            entry["statements"] += stats.statements
+            entry["db_time"] += stats.db_time
+            entry["rows"] += stats.rows
+            entry["acquire_time"] += stats.acquire_time
+
+    def count_slow_query(self):
+        with self._lock:
+            self._slow_queries += 1
+
+    # Prometheus text exposition format
+    def render(self):
+        def labels(method, route, **extra):
+            pairs = {"method": method, "route": route, **extra}
+            return ','.join(f'{key}="{escape_label(value)}"' for key, value in pairs.items())
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+            slow_queries = self._slow_queries
+            lines = ["# HELP library_request_duration_seconds Request latency by route.",
+                     "# TYPE library_request_duration_seconds histogram"]
+            for (method, route), entry in routes:
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    lines.append(f"library_request_duration_seconds_bucket{{{labels(method, route, le=bound)}}} {count}")
+                lines.append(f"library_request_duration_seconds_bucket{{{labels(method, route, le='+Inf')}}} {entry['count']}")
+                lines.append(f"library_request_duration_seconds_sum{{{labels(method, route)}}} {entry['sum']}")
+                lines.append(f"library_request_duration_seconds_count{{{labels(method, route)}}} {entry['count']}")
+
+            lines += ["# HELP library_requests_total Responses by route and status code.",
+                      "# TYPE library_requests_total counter"]
+            for (method, route), entry in routes:
+                for status, count in sorted(entry["statuses"].items()):
+                    lines.append(f"library_requests_total{{{labels(method, route, status=status)}}} {count}")
+
+            for name, key, help_text in (
+                ("library_db_statements_total", "statements", "SQL statements issued by route."),
+                ("library_db_time_seconds_total", "db_time", "Time spent in SQL statements by route."),
+                ("library_db_rows_total", "rows", "Rows returned by SQL statements by route."),
+                ("library_db_acquire_seconds_total", "acquire_time", "Time spent waiting for a pooled connection by route."),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for (method, route), entry in routes:
+                    lines.append(f"{name}{{{labels(method, route)}}} {entry[key]}")
+
+        lines += ["# HELP library_slow_queries_total Statements slower than SLOW_QUERY_MS.",
+                  "# TYPE library_slow_queries_total counter",
+                  f"library_slow_queries_total {slow_queries}"]
+        for key, value in pool.metrics().items():
+            if key in POOL_COUNTERS:
+                lines += [f"# TYPE {POOL_COUNTERS[key]} counter", f"{POOL_COUNTERS[key]} {value}"]
+            elif isinstance(value, (int, float)):
+                lines += [f"# TYPE library_pool_{key} gauge", f"library_pool_{key} {value}"]
+        return '\n'.join(lines) + '\n'
+
+
+route_metrics = RouteMetrics(LATENCY_BUCKETS)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+# fold the request into the route metrics and report its database share in a
+# Server-Timing header, which browser dev tools show next to the request
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+
+    duration = time.perf_counter() - started
+    stats = request_stats()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    route_metrics.observe(request.method, route, response.status_code, duration, stats)
+    response.headers['Server-Timing'] = (f"db;dur={stats.db_time * 1000:.2f}, acquire;dur={stats.acquire_time * 1000:.2f}, "
+                                         f"total;dur={duration * 1000:.2f}")
+    log_event(logging.DEBUG, "request", method=request.method, route=route, status=response.status_code,
+              duration_ms=round(duration * 1000, 3), statements=stats.statements,
+              db_ms=round(stats.db_time * 1000, 3), rows=stats.rows, acquire_ms=round(stats.acquire_time * 1000, 3))
+    return response
+
+
+# cache-aside with leases: a reader that misses takes a lease on the key before
+# it reads the database, and only fills the key if the lease is still there. a
+# write deletes the key after it commits, which also cancels any lease, so a
+# read that started before the write can't put the old row back afterwards
+LEASE_PREFIX = "lease:"
+LEASE_TTL = int(os.getenv('CACHE_LEASE_TTL', 10))
+
+
+def is_lease(value):
+    return isinstance(value, str) and value.startswith(LEASE_PREFIX)
+
+
+# in-process LRU cache with a per-entry TTL
+class LRUCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None or is_lease(entry[1]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, self.ttl)
+
+    def lease(self, key):
+        with self._lock:
+            if self._live_entry(key) is not None:
+                return None
+            token = LEASE_PREFIX + secrets.token_hex(8)
+            self._store(key, token, LEASE_TTL)
+            return token
+
+    def fill(self, key, token, value):
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is not None and entry[1] == token:
+                self._store(key, value, self.ttl)
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def metrics(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+# cache shared by every worker process, kept in Redis; expiry is left to Redis.
+# values are stored as JSON written by the app's own provider, the same text the
+# routes send, so nothing read back from Redis is ever executed
+class RedisCache:
+    # set the key only while it still holds the caller's lease
+    FILL_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+        end
+        return nil
+    """
+
+    def __init__(self, url, ttl):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._fill = self.client.register_script(self.FILL_SCRIPT)
+
+    def get(self, key):
+        data = self.client.get(key)
+        value = app.json.loads(data) if data is not None else None
+        if value is None or is_lease(value):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.client.set(key, app.json.dumps(value), ex=self.ttl)
+
+    def lease(self, key):
+        token = LEASE_PREFIX + secrets.token_hex(8)
+        if self.client.set(key, app.json.dumps(token), ex=LEASE_TTL, nx=True):
+            return token
+        return None
+
+    def fill(self, key, token, value):
+        self._fill(keys=[key], args=[app.json.dumps(token), app.json.dumps(value), self.ttl])
+
+    def delete(self, *keys):
+        if keys:
+            self.invalidations += self.client.delete(*keys)
+
+    def metrics(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses,
+                "evictions": None, "invalidations": self.invalidations}
+
+
+# stands in for the cache when CACHE_BACKEND=off so callers never need to check
+class NoCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def lease(self, key):
+        return None
+
+    def fill(self, key, token, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def metrics(self):
+        return {"backend": "off"}
+
+
+# CACHE_BACKEND is memory (default), redis or off. redis falls back to the
+# in-process cache when the client library or CACHE_REDIS_URL isn't available
+def create_cache():
+    backend = os.getenv('CACHE_BACKEND', 'memory')
+    ttl = int(os.getenv('CACHE_TTL', 60))
+    if backend == 'off':
+        return NoCache()
+    if backend == 'redis':
+        if redis is not None and os.getenv('CACHE_REDIS_URL'):
+            return RedisCache(os.getenv('CACHE_REDIS_URL'), ttl)
+        log_event(logging.WARNING, "cache_fallback", requested="redis", using="memory")
+    return LRUCache(int(os.getenv('CACHE_MAX_ENTRIES', 10000)), ttl)
+
+
+# Books, Movies and LibraryAccount rows are read through this cache, and a cached
+# row's RowVersion is what conditional GETs are checked against (see versioned_get).
+# every write that bumps RowVersion deletes the key after it commits; a change made
+# behind the app's back is picked up when the entry expires after CACHE_TTL
+cache = create_cache()
+
+
+def book_key(item_id):
+    return f"book:{item_id}"
+
+
+def movie_key(item_id):
+    return f"movie:{item_id}"
+
+
+def account_key(card_id):
+    return f"account:{card_id}"
+
+
+# callers may pass no keys at all, e.g. a batch where nothing was returned; Redis
+# rejects a DELETE with no arguments, and by now the write has already committed
+def invalidate(*keys):
+    if keys:
+        cache.delete(*keys)
+
+
+# conditional GET. a single row's ETag is "v<RowVersion>". every write to the row
+# bumps RowVersion in its own transaction, so every worker hands out the same tag
+# for the same data, and a PUT can send the tag back in If-Match
+def version_etag(version):
+    return f"v{version}"
+
+
+# compressed responses carry the ETag with the encoding appended, as their bytes differ
+ENCODING_SUFFIXES = ('', '-gzip', '-br')
+
+
+def not_modified(etag):
+    if any(request.if_none_match.contains(etag + suffix) for suffix in ENCODING_SUFFIXES):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def tagged(response, etag):
+    response.set_etag(etag)
+    return response, 200
+
+
+# for joined bodies and catalog lists, which have no single RowVersion: tag the
+# body itself, which saves the transfer but not the query
+def content_tagged(response):
+    etag = hashlib.sha1(response.get_data()).hexdigest()
+    return not_modified(etag) or tagged(response, etag)
+
+
+# GET one row by a unique key with its version as the ETag. with a cache_key the
+# cached row answers both a matching If-None-Match (304) and a plain GET without
+# touching the database; on a miss the row is read once and filled under a lease
+def versioned_get(cache_key, table, keys, columns, not_found):
+    row = cache.get(cache_key) if cache_key else None
+    if row is None:
+        connection = get_db()
+        if connection is None:
+            return jsonify({"error": "Failed to connect to the database"}), 500
+
+        token = cache.lease(cache_key) if cache_key else None
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute(f"""
+                SELECT {columns} FROM {table}
+                WHERE {' AND '.join(f"{column} = %s" for column in keys)}
+            """, list(keys.values()))
+            row = cursor.fetchone()
+            cursor.close()
+        except mysql.connector.Error as err:
+            return jsonify({"error": str(err)}), 500
+        if not row:
+            return jsonify({"message": not_found}), 404
+        if token:
+            cache.fill(cache_key, token, row)
+
+    etag = version_etag(row['RowVersion'])
+    return not_modified(etag) or tagged(jsonify(row), etag)
+
+
+# optimistic concurrency for the PUT routes: every editable row carries a RowVersion,
+# the client sends back the one it read, either as If-Match with the ETag of its
+# GET ("v<RowVersion>", with any compression suffix) or as a RowVersion field in
+# the body, and the UPDATE only applies while that version is current. None when
+# neither was sent; ValueError when what was sent isn't a version
+VERSION_ETAG = re.compile(r"v(\d+)(?:-gzip|-br)?")
+
+
+def expected_version(data):
+    for tag in request.if_match.as_set():
+        match = VERSION_ETAG.fullmatch(tag)
+        if match:
+            return int(match.group(1))
+
+    version = data.get('RowVersion')
+    if version is None:
+        if 'If-Match' in request.headers:
+            raise ValueError("If-Match must be the ETag of a GET of this record")
         return None
+    if isinstance(version, bool) or not isinstance(version, (int, str)) or not str(version).isdigit():
+        raise ValueError("RowVersion must be a whole number")
+    return int(version)
+
+
+# a stale version sent as If-Match is a failed precondition (412); one sent in the
+# body is a conflict with the current state of the record (409)
+def conflict_status():
+    return 412 if any(VERSION_ETAG.fullmatch(tag) for tag in request.if_match.as_set()) else 409
+
+
+# after a compare-and-set UPDATE matched nothing: 404 if the row is gone, otherwise
+# 412/409 with the version it is at now so the client can reload and retry
+def version_conflict(connection, table, keys, not_found, not_found_status=404):
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        SELECT RowVersion FROM {table}
+        WHERE {' AND '.join(f"{column} = %s" for column in keys)}
+    """, list(keys.values()))
+    row = cursor.fetchone()
+    cursor.close()
+    if row is None:
+        return jsonify({"message": not_found}), not_found_status
+    return jsonify({"message": "This record was changed by someone else, reload it and try again", "RowVersion": row[0]}), conflict_status()
+
+
+# negotiated compression for large JSON bodies; br only when the brotli package is installed
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None:
+        return response
+    response.set_data(brotli.compress(data, quality=4) if encoding == 'br' else gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+@app.route('/cache/metrics', methods=['GET'])
+def get_cache_metrics():
+    return jsonify(cache.metrics()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(route_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/pool/metrics', methods=['GET'])
+def get_pool_metrics():
+    return jsonify(pool.metrics()), 200
+
+
+@app.route('/health/live', methods=['GET'])
+def liveness():
+    return jsonify({"status": "ok"}), 200
+
+
+# ready to take traffic only while the pool is open and MySQL answers
+@app.route('/health/ready', methods=['GET'])
+def readiness():
+    if pool.closed:
+        return jsonify({"status": "draining"}), 503
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"status": "unavailable", "error": "Failed to connect to the database"}), 503
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+        cursor.close()
+        return jsonify({"status": "ready"}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"status": "unavailable", "error": str(err)}), 503
+
+# keyset pagination: pages are requested with ?after=<last key seen>&limit=<n> and
+# the key of the last row on a page is sent back in the X-Next-After header (absent
+# on the last page). every page is an index range scan starting at `after`, so a
+# deep page costs the same as the first one
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 100))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 1000))
+
+
+def page_args():
+    after = request.args.get('after', default=0, type=int)
+    limit = request.args.get('limit', default=PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
+
+
+# the columns to return for ?fields=A,B; the key column is always included
+def selected_columns(allowed, key):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(allowed)
+    columns = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [column for column in columns if column not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return [key] + [column for column in columns if column != key]
+
+
+# fetch one page of `table` ordered by `key`. `conditions` are SQL predicates
+# using %s placeholders with their values in `params`; column names only ever
+# come from the allowlists in the routes
+def fetch_page(cursor, table, key, columns, conditions, params, after, limit):
+    where = ' AND '.join(conditions + [f"{key} > %s"])
+    cursor.execute(f"""
+        SELECT {', '.join(columns)} FROM {table}
+        WHERE {where}
+        ORDER BY {key}
+        LIMIT %s
+    """, tuple(params) + (after, limit + 1))
+    rows = cursor.fetchall()
+    next_after = rows[limit - 1][key] if len(rows) > limit else None
+    return rows[:limit], next_after
+
+
+def page_response(rows, next_after):
+    response = jsonify(rows)
+    if next_after is not None:
+        response.headers['X-Next-After'] = str(next_after)
+    return response, 200
+
 
 # DEFINE API ENDPOINTS
 
 # endpoints for CheckoutLibraryItem
 @app.route('/checkouts/person/<int:card_id>', methods=['GET'])
 def get_checked_out_items_by_person(card_id):
-    connection = create_connection()
+    after, limit = page_args()
+
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     cursor = connection.cursor(dictionary=True)
     try:
-        cursor.execute("""
-            SELECT * FROM CheckOutLibraryItem
-            WHERE CardID = %s
-        """, (card_id,))
-        
-        items = cursor.fetchall()
+        # ?open=true only lists loans that are still out, straight from OpenLoans
+        table = 'OpenLoans' if request.args.get('open') == 'true' else 'CheckOutLibraryItem'
+        items, next_after = fetch_page(cursor, table, 'CheckoutID', ['CheckoutID', 'ItemID', 'CardID', 'BorrowDate', 'ReturnByDate'],
+                                       ["CardID = %s"], [card_id], after, limit)
         cursor.close()
-        connection.close()
 
-        if not items:
+        if not items and not after:
             return jsonify({"message": f"No checked-out items found for CardID {card_id}"}), 404
 
-        return jsonify(items), 200
+        return page_response(items, next_after)
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
@@ -64,69 +1115,20 @@ def checkout_item():
     if not card_id or not item_id or not borrow_date or not return_by_date:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
     try:
-        cursor.execute("""
-            SELECT * FROM LibraryItemState
-            WHERE ItemID = %s
-        """, (item_id,))
-        item_state = cursor.fetchone()
+        status, checkout_id = call_procedure(connection, 'CheckOutItem', (item_id, card_id, borrow_date, return_by_date))
+        invalidate(account_key(card_id))
 
-        if not item_state:
+        if status == 'NOT_FOUND':
             return jsonify({"message": "Item not found"}), 404
-        if item_state[1] <= item_state[2]:
-            cursor.execute("""
-                SELECT * FROM ReserveLibraryItem
-                WHERE ItemID = %s AND CardID = %s AND PlaceInLine > 0
-            """, (item_id, card_id))
-            reservation = cursor.fetchone()
-            if not reservation:
-                return jsonify({"message": "Item is not available for checkout, please place a reservation if you wish to obtain a copy"}), 403
-            if reservation[3] > item_state[1]:
-                return jsonify({"message": "Item is not available for checkout, please place a reservation if you wish to obtain a copy"}), 403
-            
-            cursor.execute("""
-                DELETE FROM ReserveLibraryItem
-                WHERE ReservationID = %s
-            """, (reservation[0],))
-            cursor.execute("""
-            UPDATE LibraryAccount
-            SET NumReserved = NumReserved - 1
-            WHERE CardID = %s
-            """, (card_id,))
-            cursor.execute("""
-            UPDATE ReserveLibraryItem
-            SET PlaceInLine = PlaceInLine - 1
-            WHERE ItemID = %s AND PlaceInLine > %s
-            """, (reservation[1], reservation[3]))
-
-        cursor.execute("""
-            INSERT INTO CheckOutLibraryItem (ItemID, CardID, BorrowDate, ReturnByDate)
-            VALUES (%s, %s, %s, %s)
-        """, (item_id, card_id, borrow_date, return_by_date))
-
-        cursor.execute("""
-            UPDATE LibraryItemState
-            SET CopiesAvailable = CopiesAvailable - 1
-            WHERE ItemID = %s
-        """, (item_id,))
-
-        cursor.execute("""
-            UPDATE LibraryAccount
-            SET NumChecked = NumChecked + 1
-            WHERE CardID = %s
-        """, (card_id,))
-
-        connection.commit()
-        cursor.close()
-        connection.close()
+        if status == 'FORBIDDEN':
+            return jsonify({"message": "Item is not available for checkout, please place a reservation if you wish to obtain a copy"}), 403
 
-        return jsonify({"message": "Item checked out successfully"}), 201
+        return jsonify({"message": "Item checked out successfully", "CheckoutID": checkout_id}), 201
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
@@ -140,37 +1142,24 @@ def renew_item(card_id):
     if not checkout_id or not card_id or not return_by_date:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
     try:
-        cursor.execute("""
-            SELECT * FROM CheckOutLibraryItem
-            WHERE CheckoutID = %s
-        """, (checkout_id,))
-        checkout = cursor.fetchone()
-        print(checkout[3])
+        status, _ = call_procedure(connection, 'RenewItem', (checkout_id, card_id, return_by_date))
 
-        if not checkout:
-            return jsonify({"message": f"Checkout with CheckoutID {checkout} not found"}), 404
-        if checkout[2] != card_id:
+        if status == 'NOT_FOUND':
+            return jsonify({"message": f"Checkout with CheckoutID {checkout_id} not found"}), 404
+        if status == 'FORBIDDEN':
             return jsonify({"message": f"Checkout {checkout_id} was not authored by CardID {card_id}, you cannot renew this checkout"}), 403
 
-        cursor.execute("""
-            UPDATE CheckOutLibraryItem
-            SET ReturnByDate = %s
-            WHERE CheckoutID = %s
-        """, (return_by_date, checkout_id))
-
-        connection.commit()
-        cursor.close()
-        connection.close()
-
+        # the renewal can change the account's AccruedFees
+        invalidate(account_key(card_id))
         return jsonify({"message": "Checkout renewed successfully"}), 201
     except mysql.connector.Error as err:
+        if err.errno == SIGNAL_EXCEPTION:
+            return jsonify({"message": f"Checkout {checkout_id} already returned"}), 403
         return jsonify({"error": str(err)}), 500
 
 @app.route('/checkouts/<int:checkout_id>', methods=['DELETE'])
@@ -181,118 +1170,563 @@ def return_checked_out_item(checkout_id):
     if not checkout_id or not return_date:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
     try:
+        status, _, borrower_id = call_procedure(connection, 'ReturnItem', (checkout_id, return_date))
+        invalidate(account_key(borrower_id))
 
-        cursor.execute("""
-            SELECT * FROM CheckOutLibraryItem
-            WHERE CheckoutID = %s
-        """, (checkout_id,))
-        checkout = cursor.fetchone()
-
-        if not checkout:
+        if status == 'NOT_FOUND':
             return jsonify({"message": f"Checkout record with CheckoutID {checkout_id} not found"}), 404
-        
-        cursor.execute("""
-            SELECT * FROM ReturnLibraryItem
-            WHERE CheckoutID = %s
-        """, (checkout_id,))
-        checkout_return = cursor.fetchone()
-
-        if checkout_return:
+        if status == 'FORBIDDEN':
             return jsonify({"message": f"Checkout {checkout_id} already returned"}), 403
 
-        cursor.execute("""
-            INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate)
-            VALUES (%s, %s)
-        """, (checkout_id, return_date))
+        return jsonify({"message": "Item returned successfully"}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
 
-        cursor.execute("""
-            UPDATE LibraryItemState
-            SET CopiesAvailable = CopiesAvailable + 1
-            WHERE ItemID = %s
-        """, (checkout[1],))
 
-        returned_date = datetime.strptime(return_date, "%Y-%m-%d").date()
+# batch circulation for the front desk and the book drop: many items in one
+# transaction, using set-based statements and a single LibraryAccount UPDATE
+MAX_BATCH_ITEMS = int(os.getenv('MAX_BATCH_ITEMS', 100))
+
+
+def placeholders(values):
+    return ', '.join(['%s'] * len(values))
+
+
+# the IDs of a batch request as ints, so "5" and 5 lock and match the same row
+def batch_ids(values, name):
+    if not isinstance(values, list) or len(values) > MAX_BATCH_ITEMS:
+        raise ValueError(f"{name} must be a list of at most {MAX_BATCH_ITEMS} items")
+    ids = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+            raise ValueError(f"{name} must be whole numbers")
+        ids.append(int(value))
+    return ids
+
+
+# "CASE key WHEN k1 THEN v1 ... ELSE 0 END" and its parameters, for applying a
+# different amount to each row of one UPDATE
+def case_expression(key, amounts):
+    if not amounts:
+        return "0", []
+    whens = ' '.join(['WHEN %s THEN %s'] * len(amounts))
+    return f"CASE {key} {whens} ELSE 0 END", [value for pair in amounts.items() for value in pair]
+
+
+# append rows to CirculationEvents on the caller's transaction; each event is
+# (EventType, ItemID, CardID, ResultID, Amount, EventDate). call it last, just
+# before the commit, so the EventIDs aren't held open across other lock waits
+def record_events(cursor, events):
+    if events:
+        cursor.executemany("""
+            INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, Amount, EventDate)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, events)
+
+
+def checkout_batch(cursor, card_id, item_ids, borrow_date, return_by_date):
+    unique_ids = sorted(set(item_ids))
+    # lock the items in ItemID order so overlapping batches can't deadlock each other
+    cursor.execute(f"""
+        SELECT ItemID, CopiesAvailable, ReservationCount FROM LibraryItemState
+        WHERE ItemID IN ({placeholders(unique_ids)})
+        ORDER BY ItemID
+        FOR UPDATE
+    """, unique_ids)
+    states = {row['ItemID']: row for row in cursor.fetchall()}
+
+    # the patron's earliest hold on each item, and how many holds are ahead of it
+    cursor.execute(f"""
+        SELECT h.ReservationID, h.ItemID, COUNT(q.ReservationID) AS HoldsAhead
+        FROM ReserveLibraryItem h
+        LEFT JOIN ReserveLibraryItem q ON q.ItemID = h.ItemID AND q.QueueSeq < h.QueueSeq
+        WHERE h.CardID = %s AND h.ItemID IN ({placeholders(unique_ids)})
+        GROUP BY h.ReservationID, h.ItemID, h.QueueSeq
+        ORDER BY h.QueueSeq
+    """, [card_id] + unique_ids)
+    holds = {}
+    for hold in cursor.fetchall():
+        holds.setdefault(hold['ItemID'], hold)
+
+    results = []
+    taken = {}
+    fulfilled = {}
+    for item_id in item_ids:
+        state = states.get(item_id)
+        if state is None:
+            results.append({"ItemID": item_id, "status": 404, "message": "Item not found"})
+            continue
+        copies = state['CopiesAvailable'] - taken.get(item_id, 0)
+        reserved = state['ReservationCount'] - (1 if item_id in fulfilled else 0)
+        hold = holds.get(item_id)
+        if copies <= 0 or (copies <= reserved and (hold is None or item_id in fulfilled or hold['HoldsAhead'] >= copies)):
+            results.append({"ItemID": item_id, "status": 403, "message": "Item is not available for checkout, please place a reservation if you wish to obtain a copy"})
+            continue
+        if copies <= reserved:
+            fulfilled[item_id] = hold['ReservationID']
+        taken[item_id] = taken.get(item_id, 0) + 1
+        results.append({"ItemID": item_id, "status": 201, "message": "Item checked out successfully"})
+
+    checked_out = [result for result in results if result['status'] == 201]
+    if not checked_out:
+        return results
+
+    if fulfilled:
+        cursor.execute(f"""
+            DELETE FROM ReserveLibraryItem
+            WHERE ReservationID IN ({placeholders(fulfilled)})
+        """, list(fulfilled.values()))
+
+    copies_case, copies_params = case_expression('ItemID', taken)
+    holds_case, holds_params = case_expression('ItemID', {item_id: 1 for item_id in fulfilled})
+    cursor.execute(f"""
+        UPDATE LibraryItemState
+        SET CopiesAvailable = CopiesAvailable - {copies_case},
+            ReservationCount = ReservationCount - {holds_case}
+        WHERE ItemID IN ({placeholders(taken)})
+    """, copies_params + holds_params + list(taken))
+
+    # one multi-row INSERT gets consecutive CheckoutIDs starting at LAST_INSERT_ID(),
+    # in row order, the same as insert_book_batch
+    cursor.execute(f"""
+        INSERT INTO CheckOutLibraryItem (ItemID, CardID, BorrowDate, ReturnByDate)
+        VALUES {', '.join(['(%s, %s, %s, %s)'] * len(checked_out))}
+    """, [value for result in checked_out for value in (result['ItemID'], card_id, borrow_date, return_by_date)])
+    first_id = cursor.lastrowid
+    checkout_ids = list(range(first_id, first_id + len(checked_out)))
+    for result, checkout_id in zip(checked_out, checkout_ids):
+        result['CheckoutID'] = checkout_id
+
+    cursor.execute(f"""
+        INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+        SELECT CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate FROM CheckOutLibraryItem
+        WHERE CheckoutID IN ({placeholders(checkout_ids)})
+    """, checkout_ids)
+
+    cursor.executemany("""
+        INSERT INTO ItemStats (ItemID, CheckoutCount)
+        VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE CheckoutCount = CheckoutCount + VALUES(CheckoutCount)
+    """, list(taken.items()))
+
+    cursor.execute("""
+        UPDATE LibraryAccount
+        SET NumChecked = NumChecked + %s, NumReserved = NumReserved - %s, RowVersion = RowVersion + 1
+        WHERE CardID = %s
+    """, (len(checked_out), len(fulfilled), card_id))
+
+    record_events(cursor, [('HOLD_FILLED', item_id, card_id, reservation_id, None, borrow_date)
+                           for item_id, reservation_id in fulfilled.items()]
+                  + [('CHECKOUT', result['ItemID'], card_id, result['CheckoutID'], None, borrow_date)
+                     for result in checked_out])
+    return results
+
+
+def return_batch(cursor, checkout_ids, return_date):
+    unique_ids = sorted(set(checkout_ids))
+    cursor.execute(f"""
+        SELECT c.CheckoutID, c.ItemID, c.CardID, c.ReturnByDate, COALESCE(o.AccruedFee, 0) AS AccruedFee
+        FROM CheckOutLibraryItem c
+        LEFT JOIN OpenLoans o ON o.CheckoutID = c.CheckoutID
+        WHERE c.CheckoutID IN ({placeholders(unique_ids)})
+        ORDER BY c.CheckoutID
+        FOR UPDATE
+    """, unique_ids)
+    checkouts = {row['CheckoutID']: row for row in cursor.fetchall()}
+    cursor.execute(f"""
+        SELECT CheckoutID FROM ReturnLibraryItem
+        WHERE CheckoutID IN ({placeholders(unique_ids)})
+    """, unique_ids)
+    returned = {row['CheckoutID'] for row in cursor.fetchall()}
+
+    results = []
+    copies = {}
+    loans = {}
+    fees = {}
+    accrued = {}
+    for checkout_id in checkout_ids:
+        checkout = checkouts.get(checkout_id)
+        if checkout is None:
+            results.append({"CheckoutID": checkout_id, "status": 404, "message": f"Checkout record with CheckoutID {checkout_id} not found"})
+            continue
+        if checkout_id in returned:
+            results.append({"CheckoutID": checkout_id, "status": 403, "message": f"Checkout {checkout_id} already returned"})
+            continue
+        returned.add(checkout_id)
+        fee = max((return_date - checkout['ReturnByDate']).days, 0) * OVERDUE_FEE_PER_DAY
+        copies[checkout['ItemID']] = copies.get(checkout['ItemID'], 0) + 1
+        loans[checkout['CardID']] = loans.get(checkout['CardID'], 0) + 1
+        fees[checkout['CardID']] = fees.get(checkout['CardID'], 0) + fee
+        accrued[checkout['CardID']] = accrued.get(checkout['CardID'], 0) + checkout['AccruedFee']
+        results.append({"CheckoutID": checkout_id, "CardID": checkout['CardID'], "status": 200,
+                        "message": "Item returned successfully", "OverdueFee": fee})
+
+    returning = [result['CheckoutID'] for result in results if result['status'] == 200]
+    if not returning:
+        return results
+
+    cursor.executemany("""
+        INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate)
+        VALUES (%s, %s)
+    """, [(checkout_id, return_date) for checkout_id in returning])
+    cursor.execute(f"""
+        DELETE FROM OpenLoans
+        WHERE CheckoutID IN ({placeholders(returning)})
+    """, returning)
+
+    copies_case, copies_params = case_expression('ItemID', copies)
+    cursor.execute(f"""
+        UPDATE LibraryItemState
+        SET CopiesAvailable = CopiesAvailable + {copies_case}
+        WHERE ItemID IN ({placeholders(copies)})
+    """, copies_params + list(copies))
+
+    loans_case, loans_params = case_expression('CardID', loans)
+    fees_case, fees_params = case_expression('CardID', fees)
+    accrued_case, accrued_params = case_expression('CardID', accrued)
+    cursor.execute(f"""
+        UPDATE LibraryAccount
+        SET NumChecked = NumChecked - {loans_case}, OverdueFees = OverdueFees + {fees_case},
+            AccruedFees = GREATEST(AccruedFees - {accrued_case}, 0), RowVersion = RowVersion + 1
+        WHERE CardID IN ({placeholders(loans)})
+    """, loans_params + fees_params + accrued_params + list(loans))
+
+    events = []
+    for result in results:
+        if result['status'] == 200:
+            checkout = checkouts[result['CheckoutID']]
+            events.append(('RETURN', checkout['ItemID'], checkout['CardID'], checkout['CheckoutID'], None, return_date))
+            if result['OverdueFee'] > 0:
+                events.append(('FEE_CHARGED', checkout['ItemID'], checkout['CardID'], checkout['CheckoutID'],
+                               result['OverdueFee'], return_date))
+    record_events(cursor, events)
+    return results
+
+
+# POST: check out several items to one card, e.g.
+# {"CardID": 7, "ItemIDs": [1, 5, 9], "BorrowDate": "2024-01-01", "ReturnByDate": "2024-01-15"}
+@app.route('/checkouts/batch', methods=['POST'])
+def checkout_items_batch():
+    data = request.get_json()
+    card_id = data.get('CardID')
+    item_ids = data.get('ItemIDs')
+    borrow_date = data.get('BorrowDate')
+    return_by_date = data.get('ReturnByDate')
 
-        if returned_date > checkout[4]:
-            cursor.execute("""
-                UPDATE LibraryAccount
-                SET NumChecked = NumChecked - 1, OverdueFees = OverdueFees + DATEDIFF(%s, %s) * 0.25
-                WHERE CardID = %s
-            """, (returned_date, checkout[4], checkout[2],))
-        else:
-            cursor.execute("""
-                UPDATE LibraryAccount
-                SET NumChecked = NumChecked - 1
-                WHERE CardID = %s
-            """, (checkout[2],))
+    if not card_id or not item_ids or not borrow_date or not return_by_date:
+        return jsonify({"error": "Missing required fields"}), 400
+    try:
+        item_ids = batch_ids(item_ids, 'ItemIDs')
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
 
-        connection.commit()
-        cursor.close()
-        connection.close()
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
 
-        return jsonify({"message": "Item returned successfully"}), 200
+    try:
+        results = run_transaction(connection, lambda cursor: checkout_batch(cursor, card_id, item_ids, borrow_date, return_by_date),
+                                  dictionary=True)
+        invalidate(account_key(card_id))
+        return jsonify({"results": results}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# POST: return several checkouts at once, e.g. {"CheckoutIDs": [12, 13], "ReturnDate": "2024-01-20"}
+@app.route('/returns/batch', methods=['POST'])
+def return_items_batch():
+    data = request.get_json()
+    checkout_ids = data.get('CheckoutIDs')
+    return_date = data.get('ReturnDate')
+
+    if not checkout_ids or not return_date:
+        return jsonify({"error": "Missing required fields"}), 400
+    try:
+        checkout_ids = batch_ids(checkout_ids, 'CheckoutIDs')
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    try:
+        returned_date = datetime.strptime(return_date, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "ReturnDate must be formatted YYYY-MM-DD"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    try:
+        results = run_transaction(connection, lambda cursor: return_batch(cursor, checkout_ids, returned_date), dictionary=True)
+        invalidate(*[account_key(result['CardID']) for result in results if result['status'] == 200])
+        return jsonify({"results": results}), 200
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
 
 # endpoints for Books
-@app.route('/books/<int:item_id>', methods=['GET'])
-def get_book_by_id(item_id):
-    connection = create_connection()
+# GET: page through the catalog, e.g. /books?Genre=Mystery&year_from=1990&fields=Title
+BOOK_COLUMNS = ('ItemID', 'Language', 'Genre', 'Title', 'PublicationYear', 'NumCopies', 'BookType', 'PublisherID')
+MOVIE_COLUMNS = ('ItemID', 'Language', 'Title', 'PublicationYear', 'NumCopies', 'Genre', 'Director', 'MovieType')
+
+
+# ?expand=authors,publisher nests related rows into each book. every relation is
+# fetched for the whole page with one IN query, so expanding a page costs the same
+# number of statements whether it holds 1 book or 1000
+def expand_authors(cursor, books):
+    item_ids = sorted({book['ItemID'] for book in books})
+    authors = {}
+    if item_ids:
+        cursor.execute(f"""
+            SELECT ba.ItemID, a.AuthorID, a.Name, a.DOB, a.Nationality
+            FROM Book_Author ba
+            JOIN Authors a ON a.AuthorID = ba.AuthorID
+            WHERE ba.ItemID IN ({placeholders(item_ids)})
+            ORDER BY ba.ItemID, a.AuthorID
+        """, item_ids)
+        for row in cursor.fetchall():
+            authors.setdefault(row.pop('ItemID'), []).append(row)
+    for book in books:
+        book['Authors'] = authors.get(book['ItemID'], [])
+
+
+def expand_publisher(cursor, books):
+    publisher_ids = sorted({book['PublisherID'] for book in books if book['PublisherID'] is not None})
+    publishers = {}
+    if publisher_ids:
+        cursor.execute(f"""
+            SELECT * FROM Publishers
+            WHERE PublisherID IN ({placeholders(publisher_ids)})
+        """, publisher_ids)
+        publishers = {row['PublisherID']: row for row in cursor.fetchall()}
+    for book in books:
+        book['Publisher'] = publishers.get(book['PublisherID'])
+
+
+# name -> (the column the relation is looked up by, the function that attaches it)
+BOOK_EXPANSIONS = {
+    'authors': ('ItemID', expand_authors),
+    'publisher': ('PublisherID', expand_publisher),
+}
+
+
+def expand_args(expansions):
+    names = [name.strip() for name in request.args.get('expand', '').split(',') if name.strip()]
+    unknown = [name for name in names if name not in expansions]
+    if unknown:
+        raise ValueError(f"Unknown expansions: {', '.join(unknown)}")
+    return list(dict.fromkeys(names))
+
+
+# ?fields= may leave out a column an expansion needs, so add it back
+def expansion_columns(columns, expansions, names):
+    return columns + [column for column in dict.fromkeys(expansions[name][0] for name in names) if column not in columns]
+
+
+def expand_rows(cursor, rows, expansions, names):
+    for name in names:
+        expansions[name][1](cursor, rows)
+
+
+def list_catalog(table, columns, filters, expansions=None):
+    try:
+        columns = selected_columns(columns, 'ItemID')
+        expand = expand_args(expansions or {})
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    after, limit = page_args()
+
+    conditions = []
+    params = []
+    for column in filters:
+        if request.args.get(column):
+            conditions.append(f"{column} = %s")
+            params.append(request.args.get(column))
+    if request.args.get('year_from', type=int) is not None:
+        conditions.append("PublicationYear >= %s")
+        params.append(request.args.get('year_from', type=int))
+    if request.args.get('year_to', type=int) is not None:
+        conditions.append("PublicationYear <= %s")
+        params.append(request.args.get('year_to', type=int))
+
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     cursor = connection.cursor(dictionary=True)
     try:
-        cursor.execute("""
-            SELECT * FROM Books
-            WHERE ItemID = %s
-        """, (item_id,))
-        
-        book = cursor.fetchone()
+        rows, next_after = fetch_page(cursor, table, 'ItemID', expansion_columns(columns, expansions, expand),
+                                      conditions, params, after, limit)
+        expand_rows(cursor, rows, expansions, expand)
         cursor.close()
-        connection.close()
-
-        if not book:
-            return jsonify({"message": f"No book found with ItemID {item_id}"}), 404
-
-        return jsonify(book), 200
+        return page_response(rows, next_after)
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
- 
-@app.route('/books', methods=['POST'])
-def add_book():
-    data = request.get_json()
-    language = data.get('Language')
-    genre = data.get('Genre')
-    title = data.get('Title')
-    publication_year = data.get('PublicationYear')
-    num_copies = data.get('NumCopies')
-    book_type = data.get('BookType')
-    publisher_id = data.get('PublisherID')
 
-    if not language or not genre or not title or not publication_year or not num_copies or not book_type or not publisher_id:
+@app.route('/books', methods=['GET'])
+def list_books():
+    return list_catalog('Books', BOOK_COLUMNS, ('Genre', 'Language', 'BookType'), BOOK_EXPANSIONS)
+
+
+@app.route('/movies', methods=['GET'])
+def list_movies():
+    return list_catalog('Movies', MOVIE_COLUMNS, ('Genre', 'Language', 'MovieType'))
+
+
+# turn free text into a FULLTEXT boolean-mode query where each word also matches as
+# a prefix ("harr pot" finds "Harry Potter"); operator characters are dropped
+def fulltext_query(text):
+    words = re.findall(r"\w+", text)
+    return ' '.join(f"{word}*" for word in words)
+
+
+# GET: ranked word search over book and movie titles, author names and directors,
+# served from the FULLTEXT indexes. an item matching on several of those sums its scores
+@app.route('/search', methods=['GET'])
+def search_catalog():
+    terms = fulltext_query(request.args.get('q', ''))
+    if not terms:
         return jsonify({"error": "Missing required fields"}), 400
+    limit = max(1, min(request.args.get('limit', default=20, type=int), MAX_PAGE_SIZE))
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
+    cursor = connection.cursor(dictionary=True)
     try:
         cursor.execute("""
-            INSERT INTO LibraryItem (ItemType)
-            VALUES ('Book')
-        """)
+            SELECT ItemID, ItemType, Title, SUM(Score) AS Score
+            FROM (
+                SELECT ItemID, 'Book' AS ItemType, Title, MATCH(Title) AGAINST(%s IN BOOLEAN MODE) AS Score
+                FROM Books
+                WHERE MATCH(Title) AGAINST(%s IN BOOLEAN MODE)
+                UNION ALL
+                SELECT b.ItemID, 'Book', b.Title, MATCH(a.Name) AGAINST(%s IN BOOLEAN MODE)
+                FROM Authors a
+                JOIN Book_Author ba ON ba.AuthorID = a.AuthorID
+                JOIN Books b ON b.ItemID = ba.ItemID
+                WHERE MATCH(a.Name) AGAINST(%s IN BOOLEAN MODE)
+                UNION ALL
+                SELECT ItemID, 'Movie', Title, MATCH(Title, Director) AGAINST(%s IN BOOLEAN MODE)
+                FROM Movies
+                WHERE MATCH(Title, Director) AGAINST(%s IN BOOLEAN MODE)
+            ) matches
+            GROUP BY ItemID, ItemType, Title
+            ORDER BY Score DESC, ItemID
+            LIMIT %s
+        """, (terms,) * 6 + (limit,))
+
+        results = cursor.fetchall()
+        cursor.close()
+        for result in results:
+            result['Score'] = float(result['Score'])
+
+        return jsonify(results), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# the book with its relations added. authors and publishers have no RowVersion,
+# so the ETag is taken from the body
+def get_expanded_book(item_id, expand):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT * FROM Books
+            WHERE ItemID = %s
+        """, (item_id,))
+        book = cursor.fetchone()
+        if not book:
+            cursor.close()
+            return jsonify({"message": f"No book found with ItemID {item_id}"}), 404
+
+        expand_rows(cursor, [book], BOOK_EXPANSIONS, expand)
+        cursor.close()
+        return content_tagged(jsonify(book))
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route('/books/<int:item_id>', methods=['GET'])
+def get_book_by_id(item_id):
+    try:
+        expand = expand_args(BOOK_EXPANSIONS)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if expand:
+        return get_expanded_book(item_id, expand)
+
+    return versioned_get(book_key(item_id), 'Books', {'ItemID': item_id}, '*', f"No book found with ItemID {item_id}")
+
+
+# GET: page through one author's books, e.g. /authors/3/books?expand=publisher.
+# the page is read from Book_Author's AuthorID index, not by scanning Books
+@app.route('/authors/<int:author_id>/books', methods=['GET'])
+def list_books_by_author(author_id):
+    try:
+        columns = selected_columns(BOOK_COLUMNS, 'ItemID')
+        expand = expand_args(BOOK_EXPANSIONS)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    after, limit = page_args()
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT AuthorID FROM Authors
+            WHERE AuthorID = %s
+        """, (author_id,))
+        if cursor.fetchone() is None:
+            cursor.close()
+            return jsonify({"message": f"No author found with AuthorID {author_id}"}), 404
+
+        books, next_after = fetch_page(cursor, 'Books JOIN Book_Author USING (ItemID)', 'ItemID',
+                                       expansion_columns(columns, BOOK_EXPANSIONS, expand),
+                                       ["AuthorID = %s"], [author_id], after, limit)
+        expand_rows(cursor, books, BOOK_EXPANSIONS, expand)
+        cursor.close()
+        return page_response(books, next_after)
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+ 
+@app.route('/books', methods=['POST'])
+def add_book():
+    data = request.get_json()
+    language = data.get('Language')
+    genre = data.get('Genre')
+    title = data.get('Title')
+    publication_year = data.get('PublicationYear')
+    num_copies = data.get('NumCopies')
+    book_type = data.get('BookType')
+    publisher_id = data.get('PublisherID')
+
+    if not language or not genre or not title or not publication_year or not num_copies or not book_type or not publisher_id:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO LibraryItem (ItemType)
+            VALUES ('Book')
+        """)
 
         item_id = cursor.lastrowid
 
@@ -306,15 +1740,50 @@ def add_book():
             VALUES (%s, %s, 0)
         """, (item_id, num_copies))
 
-        connection.commit()
-        cursor.close()
-        connection.close()
+        count_catalog(cursor, 'Book', book_type, 1)
+        return item_id
+
+    try:
+        item_id = run_transaction(connection, work)
+        invalidate(book_key(item_id))
 
         return jsonify({"message": "Book added successfully", "ItemID": item_id}), 201
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
 
+# PUT for a Books or Movies row as one compare-and-set on RowVersion, with no read
+# first. the counters that depend on the old row are adjusted beforehand by UPDATEs
+# that join to it under the same version condition, so they see it as it was:
+# CopiesAvailable moves by the change in NumCopies instead of being overwritten,
+# which keeps the copies out on loan counted. it goes below zero if more copies are
+# out than the new NumCopies, and comes back up as they are returned.
+# returns False if the version has moved on
+def update_catalog_row(cursor, table, item_type, type_column, item_id, version, values):
+    cursor.execute(f"""
+        UPDATE LibraryItemState s
+        JOIN {table} t ON t.ItemID = s.ItemID
+        SET s.CopiesAvailable = s.CopiesAvailable + %s - t.NumCopies
+        WHERE s.ItemID = %s AND t.RowVersion = %s
+    """, (values['NumCopies'], item_id, version))
+
+    cursor.execute(f"""
+        UPDATE CatalogStats c
+        JOIN {table} t ON c.ItemType = %s AND c.Type = t.{type_column}
+        SET c.ItemCount = c.ItemCount - 1
+        WHERE t.ItemID = %s AND t.RowVersion = %s AND t.{type_column} <> %s
+    """, (item_type, item_id, version, values[type_column]))
+    if cursor.rowcount:
+        count_catalog(cursor, item_type, values[type_column], 1)
+
+    cursor.execute(f"""
+        UPDATE {table}
+        SET {', '.join(f"{column} = %s" for column in values)}, RowVersion = RowVersion + 1
+        WHERE ItemID = %s AND RowVersion = %s
+    """, list(values.values()) + [item_id, version])
+    return cursor.rowcount == 1
+
+
 @app.route('/books/<int:item_id>', methods=['PUT'])
 def update_book(item_id):
     data = request.get_json()
@@ -329,130 +1798,851 @@ def update_book(item_id):
     if not language or not genre or not title or not publication_year or not num_copies or not book_type or not publisher_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    try:
+        version = expected_version(data)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if version is None:
+        return jsonify({"error": "Missing RowVersion, send the version being updated in If-Match or the request body"}), 428
+
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
+    values = {'Language': language, 'Genre': genre, 'Title': title, 'PublicationYear': publication_year,
+              'NumCopies': num_copies, 'BookType': book_type, 'PublisherID': publisher_id}
+
+    def work(cursor):
+        return update_catalog_row(cursor, 'Books', 'Book', 'BookType', item_id, version, values)
 
     try:
+        if not run_transaction(connection, work):
+            return version_conflict(connection, 'Books', {'ItemID': item_id}, f"No book found with ItemID {item_id}")
+        invalidate(book_key(item_id))
+
+        return jsonify({"message": "Book updated successfully", "ItemID": item_id, "RowVersion": version + 1}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route('/books/<int:item_id>', methods=['DELETE'])
+def delete_book(item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    def work(cursor):
         cursor.execute("""
-            SELECT Title FROM Books
+            SELECT BookType FROM Books
             WHERE ItemID = %s
         """, (item_id,))
-
         book = cursor.fetchone()
 
         if not book:
-            return jsonify({"message": f"No book found with ItemID {item_id}"}), 404
-        
+            return 'NOT_FOUND'
+
+        if has_open_loans(cursor, item_id):
+            return 'FORBIDDEN'
+
+        # Book_Author rows go with the book, so its authors have one book fewer
         cursor.execute("""
-            UPDATE Books
-            SET Language = %s, Genre = %s, Title = %s, PublicationYear = %s, NumCopies = %s, BookType = %s, PublisherID = %s
+            UPDATE AuthorStats s
+            JOIN Book_Author ba ON ba.AuthorID = s.AuthorID
+            SET s.BooksWritten = s.BooksWritten - 1
+            WHERE ba.ItemID = %s
+        """, (item_id,))
+        count_catalog(cursor, 'Book', book[0], -1)
+
+        cursor.execute("""
+            DELETE FROM LibraryItemState
             WHERE ItemID = %s
-        """, (language, genre, title, publication_year, num_copies, book_type, publisher_id, item_id))
+        """, (item_id,))
 
         cursor.execute("""
-            UPDATE LibraryItemState
-            SET CopiesAvailable = %s
+            DELETE FROM Books
+            WHERE ItemID = %s
+        """, (item_id,))
+
+        cursor.execute("""
+            DELETE FROM LibraryItem
             WHERE ItemID = %s
-        """, (num_copies, item_id))
+        """, (item_id,))
+        return 'OK'
+
+    try:
+        status = run_transaction(connection, work)
+        if status == 'NOT_FOUND':
+            return jsonify({"message": f"No book found with ItemID {item_id}"}), 404
+        if status == 'FORBIDDEN':
+            return jsonify({"message": f"Book still has copies checked out, please make sure all copies have been returned before deleting item {item_id}"}), 403
+
+        invalidate(book_key(item_id))
+        shelf_index.invalidate()
+
+        return jsonify({"message": "Book deleted successfully", "ItemID": item_id}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# bulk catalog import
+# the CHECK constraint domains from library_mysql_script.sql, so bad rows can be
+# rejected before they reach the database and fail a whole batch
+BOOK_LANGUAGES = {'EN', 'ES', 'FR', 'KO', 'IT', 'CH', 'GR', 'RU', 'DE'}
+BOOK_GENRES = {'JFIC', 'YFIC', 'Fiction', 'Biography', 'Mystery', 'Poetry', 'Thriller', 'Romance'}
+BOOK_TYPES = {'AudioBook_Physical', 'Physical_Copy', 'AudioBook_Digital', 'Ebook'}
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', 1000))
+
+
+# check one incoming row and convert it to the column values for Books
+def validate_book_row(row, publisher_ids):
+    missing = [field for field in ('Language', 'Genre', 'Title', 'PublicationYear', 'NumCopies', 'BookType', 'PublisherID')
+               if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+    if row['Language'] not in BOOK_LANGUAGES:
+        raise ValueError(f"Invalid Language {row['Language']}")
+    if row['Genre'] not in BOOK_GENRES:
+        raise ValueError(f"Invalid Genre {row['Genre']}")
+    if row['BookType'] not in BOOK_TYPES:
+        raise ValueError(f"Invalid BookType {row['BookType']}")
+    try:
+        publication_year = int(row['PublicationYear'])
+        num_copies = int(row['NumCopies'])
+        publisher_id = int(row['PublisherID'])
+    except (TypeError, ValueError):
+        raise ValueError("PublicationYear, NumCopies and PublisherID must be integers")
+    if num_copies <= 0:
+        raise ValueError("NumCopies must be positive")
+    if publisher_id not in publisher_ids:
+        raise ValueError(f"No publisher found with PublisherID {publisher_id}")
+    if len(row['Title']) > 100:
+        raise ValueError("Title is longer than 100 characters")
+    return (row['Language'], row['Genre'], row['Title'], publication_year, num_copies, row['BookType'], publisher_id)
+
+
+# insert a batch of validated books with one statement per table
+def insert_book_batch(connection, books):
+    cursor = connection.cursor()
+    try:
+        # one multi-row INSERT is a "simple insert" to InnoDB, so its AUTO_INCREMENT
+        # values are consecutive in every lock mode and start at LAST_INSERT_ID().
+        # no lock on the rest of LibraryItem, so concurrent inserts aren't blocked
+        cursor.execute(f"INSERT INTO LibraryItem (ItemType) VALUES {', '.join(['(%s)'] * len(books))}",
+                       ['Book'] * len(books))
+        first_id = cursor.lastrowid
+        item_ids = list(range(first_id, first_id + len(books)))
+
+        cursor.executemany("""
+            INSERT INTO Books (ItemID, Language, Genre, Title, PublicationYear, NumCopies, BookType, PublisherID)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, [(item_id,) + book for item_id, book in zip(item_ids, books)])
+        cursor.executemany("""
+            INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount)
+            VALUES (%s, %s, 0)
+        """, [(item_id, book[4]) for item_id, book in zip(item_ids, books)])
+
+        book_types = {}
+        for book in books:
+            book_types[book[5]] = book_types.get(book[5], 0) + 1
+        for book_type, count in book_types.items():
+            count_catalog(cursor, 'Book', book_type, count)
 
         connection.commit()
+        return item_ids
+    except Error:
+        connection.rollback()
+        raise
+    finally:
         cursor.close()
+
+
+# import an iterable of (line number, row dict or parse error) pairs in batches.
+# rows that fail validation, or that the database rejects, are reported with
+# their line number and the rest of the import carries on
+def import_books(connection, rows):
+    cursor = connection.cursor()
+    cursor.execute("SELECT PublisherID FROM Publishers")
+    publisher_ids = {publisher_id for (publisher_id,) in cursor.fetchall()}
+    cursor.close()
+
+    result = {"inserted": 0, "errors": []}
+
+    def flush(batch):
+        try:
+            result["inserted"] += len(insert_book_batch(connection, [book for _, book in batch]))
+        except Error as err:
+            if len(batch) == 1:
+                result["errors"].append({"line": batch[0][0], "error": str(err)})
+                return
+            # find the offending rows by retrying the batch one row at a time
+            for entry in batch:
+                flush([entry])
+
+    batch = []
+    for line, row in rows:
+        try:
+            if isinstance(row, Exception):
+                raise row
+            batch.append((line, validate_book_row(row, publisher_ids)))
+        except (TypeError, ValueError) as err:
+            result["errors"].append({"line": line, "error": str(err)})
+        if len(batch) >= BULK_BATCH_SIZE:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return result
+
+
+# parse NDJSON or CSV text line by line without reading the whole feed into memory
+def read_book_rows(lines, file_format):
+    if file_format == 'csv':
+        # line_num counts physical lines, so rows after a quoted field with
+        # embedded newlines are still reported at the right line
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, text in enumerate(lines, start=1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+            if not isinstance(row, dict):
+                raise ValueError("Each line must be a JSON object")
+            yield line, row
+        except ValueError as err:
+            yield line, ValueError(f"Invalid JSON: {err}")
+
+
+# POST: stream an NDJSON (default) or CSV (Content-Type: text/csv) catalog feed
+@app.route('/books/bulk', methods=['POST'])
+def bulk_add_books():
+    file_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    try:
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        result = import_books(connection, read_book_rows(lines, file_format))
+        return jsonify(result), 201 if result["inserted"] else 400
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['ndjson', 'csv']),
+              help="Defaults to csv for .csv files and ndjson otherwise.")
+def import_books_command(path, file_format):
+    file_format = file_format or ('csv' if path.endswith('.csv') else 'ndjson')
+    connection = create_connection()
+    if connection is None:
+        raise click.ClickException("Failed to connect to the database")
+
+    try:
+        with open(path, encoding='utf-8', newline='') as lines:
+            result = import_books(connection, read_book_rows(lines, file_format))
+    finally:
         connection.close()
 
-        return jsonify({"message": "Book updated successfully", "ItemID": item_id}), 200
+    for error in result["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {result['inserted']} books, {len(result['errors'])} rows rejected")
+
+
+# endpoints for Movies
+@app.route('/movies/<int:item_id>', methods=['GET'])
+def get_movie_by_id(item_id):
+    return versioned_get(movie_key(item_id), 'Movies', {'ItemID': item_id}, '*', f"No movie found with ItemID {item_id}")
+
+
+@app.route('/movies', methods=['POST'])
+def add_movie():
+    data = request.get_json()
+    language = data.get('Language')
+    title = data.get('Title')
+    publication_year = data.get('PublicationYear')
+    num_copies = data.get('NumCopies')
+    genre = data.get('Genre')
+    director = data.get('Director')
+    movie_type = data.get('MovieType')
+
+    if not language or not title or not publication_year or not num_copies or not genre or not director or not movie_type:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO LibraryItem (ItemType)
+            VALUES ('Movie')
+        """)
+
+        item_id = cursor.lastrowid
+
+        cursor.execute("""
+            INSERT INTO Movies (ItemID, Language, Title, PublicationYear, NumCopies, Genre, Director, MovieType)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (item_id, language, title, publication_year, num_copies, genre, director, movie_type))
+
+        cursor.execute("""
+            INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount)
+            VALUES (%s, %s, 0)
+        """, (item_id, num_copies))
+
+        count_catalog(cursor, 'Movie', movie_type, 1)
+        return item_id
+
+    try:
+        item_id = run_transaction(connection, work)
+        invalidate(movie_key(item_id))
+
+        return jsonify({"message": "Movie added successfully", "ItemID": item_id}), 201
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
 
-@app.route('/books/<int:item_id>', methods=['DELETE'])
-def delete_book(item_id):
-    data = request.get_json()
-    current_date = data.get('CurrentDate')
+@app.route('/movies/<int:item_id>', methods=['PUT'])
+def update_movie(item_id):
+    data = request.get_json()
+    language = data.get('Language')
+    title = data.get('Title')
+    publication_year = data.get('PublicationYear')
+    num_copies = data.get('NumCopies')
+    genre = data.get('Genre')
+    director = data.get('Director')
+    movie_type = data.get('MovieType')
+
+    if not language or not title or not publication_year or not num_copies or not genre or not director or not movie_type:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    try:
+        version = expected_version(data)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if version is None:
+        return jsonify({"error": "Missing RowVersion, send the version being updated in If-Match or the request body"}), 428
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    values = {'Language': language, 'Title': title, 'PublicationYear': publication_year, 'NumCopies': num_copies,
+              'Genre': genre, 'Director': director, 'MovieType': movie_type}
+
+    def work(cursor):
+        return update_catalog_row(cursor, 'Movies', 'Movie', 'MovieType', item_id, version, values)
+
+    try:
+        if not run_transaction(connection, work):
+            return version_conflict(connection, 'Movies', {'ItemID': item_id}, f"No movie found with ItemID {item_id}")
+        invalidate(movie_key(item_id))
+
+        return jsonify({"message": "Movie updated successfully", "ItemID": item_id, "RowVersion": version + 1}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route('/movies/<int:item_id>', methods=['DELETE'])
+def delete_movie(item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    def work(cursor):
+        cursor.execute("""
+            SELECT MovieType FROM Movies
+            WHERE ItemID = %s
+        """, (item_id,))
+        movie = cursor.fetchone()
+
+        if not movie:
+            return 'NOT_FOUND'
+
+        if has_open_loans(cursor, item_id):
+            return 'FORBIDDEN'
+
+        count_catalog(cursor, 'Movie', movie[0], -1)
+
+        cursor.execute("""
+            DELETE FROM LibraryItemState
+            WHERE ItemID = %s
+        """, (item_id,))
+
+        cursor.execute("""
+            DELETE FROM Movies
+            WHERE ItemID = %s
+        """, (item_id,))
+
+        cursor.execute("""
+            DELETE FROM LibraryItem
+            WHERE ItemID = %s
+        """, (item_id,))
+        return 'OK'
+
+    try:
+        status = run_transaction(connection, work)
+        if status == 'NOT_FOUND':
+            return jsonify({"message": f"No movie found with ItemID {item_id}"}), 404
+        if status == 'FORBIDDEN':
+            return jsonify({"message": f"Movie still has copies checked out, please make sure all copies have been returned before deleting item {item_id}"}), 403
+
+        invalidate(movie_key(item_id))
+        shelf_index.invalidate()
+
+        return jsonify({"message": "Movie deleted successfully", "ItemID": item_id}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# endpoints for any LibraryItem, whatever its type
+ITEM_TABLES = {'Book': 'Books', 'Movie': 'Movies'}
+
+
+# look up several items of mixed types: one query for their ItemTypes, then one
+# IN query per subtype table. returns {ItemID: row} with ItemType added to each row
+def fetch_items(cursor, item_ids):
+    cursor.execute(f"""
+        SELECT ItemID, ItemType FROM LibraryItem
+        WHERE ItemID IN ({placeholders(item_ids)})
+    """, list(item_ids))
+    by_type = {}
+    for row in cursor.fetchall():
+        by_type.setdefault(row['ItemType'], []).append(row['ItemID'])
+
+    items = {}
+    for item_type, ids in by_type.items():
+        table = ITEM_TABLES.get(item_type)
+        if table is None:
+            continue
+        cursor.execute(f"""
+            SELECT * FROM {table}
+            WHERE ItemID IN ({placeholders(ids)})
+        """, ids)
+        for row in cursor.fetchall():
+            row['ItemType'] = item_type
+            items[row['ItemID']] = row
+    return items
+
+
+@app.route('/items/<int:item_id>', methods=['GET'])
+def get_item_by_id(item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        item = fetch_items(cursor, [item_id]).get(item_id)
+        cursor.close()
+
+        if not item:
+            return jsonify({"message": f"No item found with ItemID {item_id}"}), 404
+        return jsonify(item), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# GET: several items in one call, e.g. /items?ids=1,2,3; results follow the order
+# of ids and any that don't exist are listed under "missing"
+@app.route('/items', methods=['GET'])
+def get_items():
+    try:
+        item_ids = list(dict.fromkeys(int(item_id) for item_id in request.args.get('ids', '').split(',') if item_id.strip()))
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of ItemIDs"}), 400
+    if not item_ids:
+        return jsonify({"error": "Missing required fields"}), 400
+    if len(item_ids) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"At most {MAX_BATCH_ITEMS} ids can be requested at once"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        items = fetch_items(cursor, item_ids)
+        cursor.close()
+
+        return jsonify({
+            "items": [items[item_id] for item_id in item_ids if item_id in items],
+            "missing": [item_id for item_id in item_ids if item_id not in items]
+        }), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# shelf locations. Shelf and Shelf_PhysicalCopy are small and change rarely, so
+# each process keeps them in memory as shelf -> items and item -> shelves maps.
+# shelving changes made through this process drop the index at once; changes
+# from other processes show up within SHELF_INDEX_TTL seconds
+class ShelfIndex:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # _lock guards _generation, _loaded_at and _state and is only held briefly;
+        # _load_lock keeps to one reload at a time without blocking invalidate()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._generation = 0
+        self._loaded_at = None
+        # (shelves, item_shelves, shelf_items), swapped as one so readers never see half a reload
+        self._state = ({}, {}, {})
+
+    # a reload that was already reading when this was called may have read the
+    # shelves as they were before the write, so it is thrown away (see load)
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self, connection):
+        if self._fresh():
+            return
+        with self._load_lock:
+            while not self._fresh():
+                self._reload(connection)
+
+    def _reload(self, connection):
+        with self._lock:
+            generation = self._generation
+        # start a new read snapshot, or a retry after an invalidation would read
+        # the same rows again; load() is called before a route writes anything
+        connection.commit()
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT ShelfID, Floor, Section, Aisle FROM Shelf")
+            shelves = {shelf_id: {"ShelfID": shelf_id, "Floor": floor, "Section": section, "Aisle": aisle}
+                       for shelf_id, floor, section, aisle in cursor.fetchall()}
+            cursor.execute("SELECT ItemID, ShelfID FROM Shelf_PhysicalCopy ORDER BY ShelfID, ItemID")
+            placements = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        item_shelves = {}
+        shelf_items = {shelf_id: [] for shelf_id in shelves}
+        for item_id, shelf_id in placements:
+            item_shelves.setdefault(item_id, []).append(shelf_id)
+            shelf_items.setdefault(shelf_id, []).append(item_id)
+        # walking order through the building: floor, then section, then aisle
+        for shelf_ids in item_shelves.values():
+            shelf_ids.sort(key=lambda shelf_id: self._walk_order(shelves, shelf_id))
+
+        with self._lock:
+            if self._generation == generation:
+                self._state = (shelves, item_shelves, shelf_items)
+                self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _walk_order(shelves, shelf_id):
+        shelf = shelves.get(shelf_id, {})
+        return shelf.get("Floor") or 0, shelf.get("Section") or '', shelf.get("Aisle") or 0, shelf_id
+
+    def locations(self, item_id):
+        shelves, item_shelves, _ = self._state
+        return [shelves[shelf_id] for shelf_id in item_shelves.get(item_id, []) if shelf_id in shelves]
+
+    def shelf(self, shelf_id):
+        shelves, _, shelf_items = self._state
+        if shelf_id not in shelves:
+            return None
+        return dict(shelves[shelf_id], ItemIDs=shelf_items.get(shelf_id, []))
+
+    # one stop per shelf in walking order, each item picked from the first of its
+    # shelves along the route
+    def pick_list(self, item_ids):
+        shelves, item_shelves, _ = self._state
+        stops = {}
+        missing = []
+        for item_id in item_ids:
+            shelf_ids = item_shelves.get(item_id)
+            if not shelf_ids:
+                missing.append(item_id)
+                continue
+            stops.setdefault(shelf_ids[0], []).append(item_id)
+        route = sorted(stops, key=lambda shelf_id: self._walk_order(shelves, shelf_id))
+        return [dict(shelves.get(shelf_id, {"ShelfID": shelf_id}), ItemIDs=stops[shelf_id]) for shelf_id in route], missing
+
+
+shelf_index = ShelfIndex(ttl=int(os.getenv('SHELF_INDEX_TTL', 300)))
+
+
+@app.route('/items/<int:item_id>/location', methods=['GET'])
+def get_item_location(item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    try:
+        shelf_index.load(connection)
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+    locations = shelf_index.locations(item_id)
+    if not locations:
+        return jsonify({"message": f"ItemID {item_id} is not on any shelf"}), 404
+    return jsonify({"ItemID": item_id, "Locations": locations}), 200
+
+
+@app.route('/shelves/<int:shelf_id>/items', methods=['GET'])
+def get_shelf_items(shelf_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    try:
+        shelf_index.load(connection)
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+    shelf = shelf_index.shelf(shelf_id)
+    if shelf is None:
+        return jsonify({"message": f"No shelf found with ShelfID {shelf_id}"}), 404
+    return jsonify(shelf), 200
+
+
+# POST: put a physical copy on a shelf, e.g. {"ItemID": 12}
+@app.route('/shelves/<int:shelf_id>/items', methods=['POST'])
+def add_shelf_item(shelf_id):
+    data = request.get_json()
+    item_id = data.get('ItemID')
+
+    if not item_id:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            INSERT INTO Shelf_PhysicalCopy (ItemID, ShelfID)
+            VALUES (%s, %s)
+        """, (item_id, shelf_id))
+        connection.commit()
+        shelf_index.invalidate()
+        cursor.close()
+
+        return jsonify({"message": "Item shelved successfully", "ItemID": item_id, "ShelfID": shelf_id}), 201
+    except mysql.connector.Error as err:
+        connection.rollback()
+        if err.errno == DUPLICATE_ENTRY:
+            return jsonify({"message": f"ItemID {item_id} is already on shelf {shelf_id}"}), 403
+        return jsonify({"error": str(err)}), 500
+
+
+@app.route('/shelves/<int:shelf_id>/items/<int:item_id>', methods=['DELETE'])
+def delete_shelf_item(shelf_id, item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            DELETE FROM Shelf_PhysicalCopy
+            WHERE ItemID = %s AND ShelfID = %s
+        """, (item_id, shelf_id))
+        removed = cursor.rowcount
+        connection.commit()
+        shelf_index.invalidate()
+        cursor.close()
+
+        if not removed:
+            return jsonify({"message": f"ItemID {item_id} is not on shelf {shelf_id}"}), 404
+        return jsonify({"message": "Item removed from shelf", "ItemID": item_id, "ShelfID": shelf_id}), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# POST: order a batch of items for a shelver's walk, e.g. {"ItemIDs": [4, 17, 2]}
+@app.route('/shelves/pick-list', methods=['POST'])
+def create_pick_list():
+    data = request.get_json()
+    item_ids = data.get('ItemIDs')
+
+    if not item_ids:
+        return jsonify({"error": "Missing required fields"}), 400
+    if not isinstance(item_ids, list) or len(item_ids) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"ItemIDs must be a list of at most {MAX_BATCH_ITEMS} items"}), 400
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    try:
+        shelf_index.load(connection)
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+    stops, missing = shelf_index.pick_list(item_ids)
+    return jsonify({"stops": stops, "missing": missing}), 200
+
+
+# statistics, read from the ItemStats/AuthorStats/CatalogStats summary tables so
+# each lookup is a primary key read no matter how long the history is
+
+# add delta to the CatalogStats count for one item type, in the caller's transaction
+def count_catalog(cursor, item_type, type_name, delta):
+    cursor.execute("""
+        INSERT INTO CatalogStats (ItemType, Type, ItemCount)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE ItemCount = ItemCount + %s
+    """, (item_type, type_name, delta, delta))
+
+
+# recompute every counter from the base tables in one transaction, for after a
+# restore or a manual data fix
+def rebuild_stats(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("DELETE FROM ItemStats")
+        cursor.execute("""
+            INSERT INTO ItemStats (ItemID, CheckoutCount, ReservationsPlaced)
+            SELECT s.ItemID, COUNT(c.CheckoutID), s.NextQueueSeq - 1 - s.QueueSeqsMoved
+            FROM LibraryItemState s
+            LEFT JOIN CheckOutLibraryItem c ON c.ItemID = s.ItemID
+            GROUP BY s.ItemID, s.NextQueueSeq, s.QueueSeqsMoved
+        """)
+        items = cursor.rowcount
+
+        cursor.execute("DELETE FROM AuthorStats")
+        cursor.execute("""
+            INSERT INTO AuthorStats (AuthorID, BooksWritten)
+            SELECT AuthorID, COUNT(*) FROM Book_Author
+            GROUP BY AuthorID
+        """)
+        authors = cursor.rowcount
+
+        cursor.execute("DELETE FROM CatalogStats")
+        cursor.execute("""
+            INSERT INTO CatalogStats (ItemType, Type, ItemCount)
+            SELECT 'Book', BookType, COUNT(*) FROM Books GROUP BY BookType
+            UNION ALL
+            SELECT 'Movie', MovieType, COUNT(*) FROM Movies GROUP BY MovieType
+        """)
+        types = cursor.rowcount
+
+        cursor.execute("DELETE FROM ItemRatings")
+        cursor.execute("""
+            INSERT INTO ItemRatings (ItemID, RatingCount, RatingSum, Rating1, Rating2, Rating3, Rating4, Rating5)
+            SELECT ItemID, COUNT(*), SUM(Rating),
+                SUM(Rating = 1), SUM(Rating = 2), SUM(Rating = 3), SUM(Rating = 4), SUM(Rating = 5)
+            FROM Reviews
+            GROUP BY ItemID
+        """)
+        rated = cursor.rowcount
+
+        connection.commit()
+        return {"items": items, "authors": authors, "types": types, "rated": rated}
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    connection = create_connection()
+    if connection is None:
+        raise click.ClickException("Failed to connect to the database")
+
+    try:
+        result = rebuild_stats(connection)
+    finally:
+        connection.close()
+    click.echo(f"Rebuilt stats for {result['items']} items, {result['authors']} authors, {result['types']} item types "
+               f"and ratings for {result['rated']} items")
+
 
-    connection = create_connection()
+@app.route('/stats/items/<int:item_id>', methods=['GET'])
+def get_item_stats(item_id):
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
+    cursor = connection.cursor(dictionary=True)
     try:
         cursor.execute("""
-            SELECT * FROM Books
-            WHERE ItemID = %s
+            SELECT s.ItemID, s.CopiesAvailable, s.ReservationCount,
+                COALESCE(t.CheckoutCount, 0) AS CheckoutCount,
+                COALESCE(t.ReservationsPlaced, 0) AS ReservationsPlaced,
+                COALESCE(t.CheckoutCount, 0) + s.ReservationCount AS InteractionCount
+            FROM LibraryItemState s
+            LEFT JOIN ItemStats t ON t.ItemID = s.ItemID
+            WHERE s.ItemID = %s
         """, (item_id,))
-        book = cursor.fetchone()
+        stats = cursor.fetchone()
+        cursor.close()
 
-        if not book:
-            return jsonify({"message": f"No book found with ItemID {item_id}"}), 404
+        if not stats:
+            return jsonify({"message": f"No item found with ItemID {item_id}"}), 404
+        return jsonify(stats), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
 
-        cursor.execute("""
-            SELECT CheckoutID FROM CheckOutLibraryItem
-            WHERE ItemID = %s AND ReturnByDate > %s
-        """, (item_id, current_date))
-        item = cursor.fetchall()
-        if item:
-            for i in item:
-                id = i[0]
-                cursor.execute("""
-                    SELECT ReturnID FROM ReturnLibraryItem
-                    WHERE CheckoutID = %s
-                """, (id,))
-                missing = cursor.fetchone()
-                if not missing:
-                    return jsonify({"message": f"Book still has copies checked out, please make sure all copies have been returned before deleting item {item_id}"}), 403
-        
-        cursor.execute("""
-            DELETE FROM LibraryItemState
-            WHERE ItemID = %s
-        """, (item_id,))
 
-        cursor.execute("""
-            DELETE FROM Books
-            WHERE ItemID = %s
-        """, (item_id,))
+@app.route('/stats/authors/<int:author_id>', methods=['GET'])
+def get_author_stats(author_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
 
+    cursor = connection.cursor(dictionary=True)
+    try:
         cursor.execute("""
-            DELETE FROM LibraryItem
-            WHERE ItemID = %s
-        """, (item_id,))
-
-        connection.commit()
+            SELECT a.AuthorID, a.Name, COALESCE(s.BooksWritten, 0) AS BooksWritten
+            FROM Authors a
+            LEFT JOIN AuthorStats s ON s.AuthorID = a.AuthorID
+            WHERE a.AuthorID = %s
+        """, (author_id,))
+        stats = cursor.fetchone()
         cursor.close()
-        connection.close()
 
-        return jsonify({"message": "Book deleted successfully", "ItemID": item_id}), 200
+        if not stats:
+            return jsonify({"message": f"No author found with AuthorID {author_id}"}), 404
+        return jsonify(stats), 200
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
 
-# endpoints for LibraryAccounts
-@app.route('/accounts/person/<int:card_id>', methods=['GET'])
-def get_account_by_person(card_id):
-    connection = create_connection()
+@app.route('/stats/catalog', methods=['GET'])
+def get_catalog_stats():
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     cursor = connection.cursor(dictionary=True)
     try:
         cursor.execute("""
-            SELECT * FROM LibraryAccount
-            WHERE CardID = %s
-        """, (card_id,))
-        
-        account = cursor.fetchone()
+            SELECT ItemType, Type, ItemCount FROM CatalogStats
+            WHERE ItemCount > 0
+            ORDER BY ItemType, Type
+        """)
+        counts = cursor.fetchall()
         cursor.close()
-        connection.close()
-
-        if not account:
-            return jsonify({"message": f"No account found for CardID {card_id}"}), 404
 
-        return jsonify(account), 200
+        return jsonify({"counts": counts, "total": sum(row['ItemCount'] for row in counts)}), 200
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
-    
+
+
+# endpoints for LibraryAccounts
+@app.route('/accounts/person/<int:card_id>', methods=['GET'])
+def get_account_by_person(card_id):
+    return versioned_get(account_key(card_id), 'LibraryAccount', {'CardID': card_id}, '*, OverdueFees + AccruedFees AS Balance',
+                         f"No account found for CardID {card_id}")
+
 
 @app.route('/accounts', methods=['POST'])
 def create_account():
@@ -462,7 +2652,7 @@ def create_account():
     if not name:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
@@ -475,7 +2665,6 @@ def create_account():
         """, (name,))
         connection.commit()
         cursor.close()
-        connection.close()
 
         return jsonify({
             "message": "Account created successfully",
@@ -499,35 +2688,44 @@ def update_account_by_person(card_id):
         if fees != 0:
             return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
-    if connection is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
-
-    cursor = connection.cursor()
-
     try:
-        cursor.execute("""
-            SELECT Name FROM LibraryAccount
-            WHERE CardID = %s
-        """, (card_id,))
+        version = expected_version(data)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if version is None:
+        return jsonify({"error": "Missing RowVersion, send the version being updated in If-Match or the request body"}), 428
 
-        account = cursor.fetchone()
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
 
-        if not account:
-            return jsonify({"message": f"No account found for CardID {card_id}"}), 404
-        
+    def work(cursor):
+        # the UPDATE keeps the fees it overwrites in @old_fees (the assignment adds
+        # nothing to the new value), so the adjustment needs no read of its own
         cursor.execute("""
             UPDATE LibraryAccount
-            SET Name = %s, OverdueFees = %s
-            WHERE CardID = %s
-        """, (name, fees, card_id))
-        connection.commit()
-        cursor.close()
-        connection.close()
+            SET Name = %s, OverdueFees = %s + 0 * (@old_fees := OverdueFees), RowVersion = RowVersion + 1
+            WHERE CardID = %s AND RowVersion = %s
+        """, (name, fees, card_id, version))
+        if cursor.rowcount != 1:
+            return False
+        cursor.execute("""
+            INSERT INTO CirculationEvents (EventType, CardID, Amount, EventDate)
+            SELECT 'FEE_ADJUSTED', %s, %s - @old_fees, CURDATE()
+            FROM DUAL
+            WHERE %s <> @old_fees
+        """, (card_id, fees, fees))
+        return True
+
+    try:
+        if not run_transaction(connection, work):
+            return version_conflict(connection, 'LibraryAccount', {'CardID': card_id}, f"No account found for CardID {card_id}")
+        invalidate(account_key(card_id))
 
         return jsonify({
             "message": "Account updated successfully",
-            "CardID": card_id
+            "CardID": card_id,
+            "RowVersion": version + 1
         }), 200
     
     except mysql.connector.Error as err:
@@ -539,7 +2737,7 @@ def delete_account_by_person(card_id):
     if not card_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
@@ -567,8 +2765,8 @@ def delete_account_by_person(card_id):
             WHERE CardID = %s
         """, (card_id,))
         connection.commit()
+        invalidate(account_key(card_id))
         cursor.close()
-        connection.close()
 
         return jsonify({
             "message": "Account deleted successfully",
@@ -580,9 +2778,29 @@ def delete_account_by_person(card_id):
 
 
 # endpoints for Reviews
+TOP_RATED_LIMIT = 20
+
+
+def parse_rating(value):
+    try:
+        rating = int(str(value))
+    except ValueError:
+        return None
+    return rating if 1 <= rating <= 5 else None
+
+
+# move one rating into or out of an item's ItemRatings totals, in the caller's transaction
+def count_rating(cursor, item_id, rating, delta):
+    column = f"Rating{rating}"
+    cursor.execute(f"""
+        INSERT INTO ItemRatings (ItemID, RatingCount, RatingSum, {column})
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE RatingCount = RatingCount + %s, RatingSum = RatingSum + %s, {column} = {column} + %s
+    """, (item_id, delta, rating * delta, delta, delta, rating * delta, delta))
+
 @app.route('/reviews/person/<int:card_id>', methods=['GET'])
 def get_reviews_by_person(card_id):
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
@@ -595,7 +2813,6 @@ def get_reviews_by_person(card_id):
         
         reviews = cursor.fetchall()
         cursor.close()
-        connection.close()
 
         if not reviews:
             return jsonify({"message": f"No reviews found for CardID {card_id}"}), 404
@@ -605,6 +2822,35 @@ def get_reviews_by_person(card_id):
         return jsonify({"error": str(err)}), 500
     
 
+# GET: one person's review of one item, tagged with its version for a later PUT
+@app.route('/reviews/person/<int:card_id>/item/<int:item_id>', methods=['GET'])
+def get_review(card_id, item_id):
+    return versioned_get(None, 'Reviews', {'CardID': card_id, 'ItemID': item_id}, '*',
+                         f"CardID {card_id} has not written a review for ItemID {item_id}")
+
+
+@app.route('/reviews/item/<int:item_id>', methods=['GET'])
+def get_reviews_by_item(item_id):
+    after, limit = page_args()
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        reviews, next_after = fetch_page(cursor, 'Reviews', 'ReviewID', ['ReviewID', 'CardID', 'ItemID', 'Comments', 'Rating'],
+                                         ["ItemID = %s"], [item_id], after, limit)
+        cursor.close()
+
+        if not reviews and not after:
+            return jsonify({"message": f"No reviews found for ItemID {item_id}"}), 404
+
+        return page_response(reviews, next_after)
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
 @app.route('/reviews', methods=['POST'])
 def add_review():
     data = request.get_json()
@@ -616,37 +2862,36 @@ def add_review():
     if not card_id or not item_id or not comments or not rating:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    rating = parse_rating(rating)
+    if rating is None:
+        return jsonify({"error": "Rating must be a whole number from 1 to 5"}), 400
+
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     cursor = connection.cursor()
 
     try:
-        cursor.execute("""
-            SELECT ReviewID FROM Reviews
-            WHERE CardID = %s AND ItemID = %s
-        """, (card_id, item_id))
-
-        reviews = cursor.fetchone()
-
-        if reviews:
-            return jsonify({"message": f"CardID {card_id} has already written a review for ItemID {item_id}, please navigate to the update review page"}), 403
-        
+        # UNIQUE(CardID, ItemID) on Reviews turns away a second review
         cursor.execute("""
             INSERT INTO Reviews (CardID, ItemID, Comments, Rating)
             VALUES (%s, %s, %s, %s)
         """, (card_id, item_id, comments, rating))
+        review_id = cursor.lastrowid
+        count_rating(cursor, item_id, rating, 1)
         connection.commit()
         cursor.close()
-        connection.close()
 
         return jsonify({
             "message": "Review added successfully",
-            "ReviewID": cursor.lastrowid
+            "ReviewID": review_id
         }), 201
     
     except mysql.connector.Error as err:
+        connection.rollback()
+        if err.errno == DUPLICATE_ENTRY:
+            return jsonify({"message": f"CardID {card_id} has already written a review for ItemID {item_id}, please navigate to the update review page"}), 403
         return jsonify({"error": str(err)}), 500
     
 
@@ -660,35 +2905,49 @@ def update_review_by_person(card_id):
     if not card_id or not item_id or not comments or not rating:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
-    if connection is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
-
-    cursor = connection.cursor()
+    rating = parse_rating(rating)
+    if rating is None:
+        return jsonify({"error": "Rating must be a whole number from 1 to 5"}), 400
 
     try:
-        cursor.execute("""
-            SELECT ReviewID FROM Reviews
-            WHERE CardID = %s AND ItemID = %s
-        """, (card_id, item_id))
+        version = expected_version(data)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if version is None:
+        return jsonify({"error": "Missing RowVersion, send the version being updated in If-Match or the request body"}), 428
 
-        reviews = cursor.fetchone()
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
 
-        if not reviews:
-            return jsonify({"message": f"CardID {card_id} has not written a review for ItemID {item_id} yet, please navigate to the create review page"}), 403
-        
+    def work(cursor):
+        # move the item's rating counters from the old rating, read from the row
+        # as it stands before the UPDATE, to the new one
+        histogram = ', '.join(f"i.Rating{n} = i.Rating{n} - (r.Rating = {n}) + {int(rating == n)}" for n in range(1, 6))
+        cursor.execute(f"""
+            UPDATE ItemRatings i
+            JOIN Reviews r ON r.ItemID = i.ItemID
+            SET i.RatingSum = i.RatingSum - r.Rating + %s, {histogram}
+            WHERE r.CardID = %s AND r.ItemID = %s AND r.RowVersion = %s
+        """, (rating, card_id, item_id, version))
+        # LAST_INSERT_ID(ReviewID) hands the ReviewID back without reading the row
         cursor.execute("""
             UPDATE Reviews
-            SET Comments = %s, Rating = %s
-            WHERE CardID = %s AND ItemID = %s
-        """, (comments, rating, card_id, item_id))
-        connection.commit()
-        cursor.close()
-        connection.close()
+            SET Comments = %s, Rating = %s, RowVersion = RowVersion + 1, ReviewID = LAST_INSERT_ID(ReviewID)
+            WHERE CardID = %s AND ItemID = %s AND RowVersion = %s
+        """, (comments, rating, card_id, item_id, version))
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    try:
+        review_id = run_transaction(connection, work)
+        if review_id is None:
+            return version_conflict(connection, 'Reviews', {'CardID': card_id, 'ItemID': item_id},
+                                    f"CardID {card_id} has not written a review for ItemID {item_id} yet, please navigate to the create review page", 403)
 
         return jsonify({
             "message": "Review updated successfully",
-            "ReviewID": reviews[0]
+            "ReviewID": review_id,
+            "RowVersion": version + 1
         }), 200
     
     except mysql.connector.Error as err:
@@ -703,7 +2962,7 @@ def delete_review_by_person(card_id):
     if not card_id or not item_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
@@ -711,22 +2970,24 @@ def delete_review_by_person(card_id):
 
     try:
         cursor.execute("""
-            SELECT ReviewID FROM Reviews
+            SELECT ReviewID, Rating FROM Reviews
             WHERE CardID = %s AND ItemID = %s
+            FOR UPDATE
         """, (card_id, item_id))
 
         reviews = cursor.fetchone()
 
         if not reviews:
+            connection.rollback()
             return jsonify({"message": f"No review found for ItemID {item_id} by CardID {card_id}"}), 404
         
         cursor.execute("""
             DELETE FROM Reviews
             WHERE CardID = %s AND ItemID = %s
         """, (card_id, item_id))
+        count_rating(cursor, item_id, reviews[1], -1)
         connection.commit()
         cursor.close()
-        connection.close()
 
         return jsonify({
             "message": "Review deleted successfully",
@@ -737,25 +2998,96 @@ def delete_review_by_person(card_id):
         return jsonify({"error": str(err)}), 500
 
 
+# GET: an item's rating summary from its ItemRatings totals
+@app.route('/items/<int:item_id>/rating', methods=['GET'])
+def get_item_rating(item_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT i.ItemID, r.RatingCount, r.AverageRating, r.Rating1, r.Rating2, r.Rating3, r.Rating4, r.Rating5
+            FROM LibraryItem i
+            LEFT JOIN ItemRatings r ON r.ItemID = i.ItemID
+            WHERE i.ItemID = %s
+        """, (item_id,))
+        row = cursor.fetchone()
+        cursor.close()
+
+        if not row:
+            return jsonify({"message": f"No item found with ItemID {item_id}"}), 404
+
+        return jsonify({
+            "ItemID": item_id,
+            "RatingCount": row['RatingCount'] or 0,
+            "AverageRating": row['AverageRating'],
+            "Histogram": {str(rating): row[f"Rating{rating}"] or 0 for rating in range(1, 6)}
+        }), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
+# GET: highest rated books and movies, optionally within one genre, e.g. /items/top-rated?genre=Mystery&limit=10
+@app.route('/items/top-rated', methods=['GET'])
+def get_top_rated_items():
+    genre = request.args.get('genre')
+    limit = request.args.get('limit', TOP_RATED_LIMIT, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    conditions = ["r.RatingCount > 0"]
+    params = []
+    if genre:
+        conditions.append("(b.Genre = %s OR m.Genre = %s)")
+        params += [genre, genre]
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(f"""
+            SELECT r.ItemID, COALESCE(b.Title, m.Title) AS Title, COALESCE(b.Genre, m.Genre) AS Genre,
+                r.AverageRating, r.RatingCount
+            FROM ItemRatings r
+            LEFT JOIN Books b ON b.ItemID = r.ItemID
+            LEFT JOIN Movies m ON m.ItemID = r.ItemID
+            WHERE {' AND '.join(conditions)}
+            ORDER BY r.AverageRating DESC, r.RatingCount DESC
+            LIMIT %s
+        """, params + [limit])
+        items = cursor.fetchall()
+        cursor.close()
+
+        return jsonify(items), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
 # enpoints for ReserveLibraryItem
 # GET: select all reservations from a person
 @app.route('/reservations/person/<int:card_id>', methods=['GET'])
 def get_reservations_by_person(card_id):
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     cursor = connection.cursor(dictionary=True)
     try:
-        # Select reservations for a specific person (CardID)
+        # Select reservations for a specific person (CardID); place in line is
+        # counted off the (ItemID, QueueSeq) index instead of being stored
         cursor.execute("""
-            SELECT * FROM ReserveLibraryItem
-            WHERE CardID = %s
+            SELECT r.ReservationID, r.ItemID, r.CardID, r.RowVersion,
+                (SELECT COUNT(*) FROM ReserveLibraryItem q
+                 WHERE q.ItemID = r.ItemID AND q.QueueSeq <= r.QueueSeq) AS PlaceInLine
+            FROM ReserveLibraryItem r
+            WHERE r.CardID = %s
         """, (card_id,))
         
         reservations = cursor.fetchall()
         cursor.close()
-        connection.close()
 
         if not reservations:
             return jsonify({"message": f"No reservations found for CardID {card_id}"}), 404
@@ -765,6 +3097,42 @@ def get_reservations_by_person(card_id):
         return jsonify({"error": str(err)}), 500
 
 
+# GET: a single reservation, tagged with its version for a later PUT. its place
+# in line moves without a write to the row, so it is served by /position instead
+@app.route('/reservations/<int:reservation_id>', methods=['GET'])
+def get_reservation(reservation_id):
+    return versioned_get(None, 'ReserveLibraryItem', {'ReservationID': reservation_id}, 'ReservationID, ItemID, CardID, RowVersion',
+                         f"No reservation found for ReservationID {reservation_id}")
+
+
+# GET: where a single reservation currently is in its item's queue
+@app.route('/reservations/<int:reservation_id>/position', methods=['GET'])
+def get_reservation_position(reservation_id):
+    connection = get_db()
+    if connection is None:
+        return jsonify({"error": "Failed to connect to the database"}), 500
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT r.ReservationID, r.ItemID, r.RowVersion,
+                (SELECT COUNT(*) FROM ReserveLibraryItem q
+                 WHERE q.ItemID = r.ItemID AND q.QueueSeq <= r.QueueSeq) AS PlaceInLine
+            FROM ReserveLibraryItem r
+            WHERE r.ReservationID = %s
+        """, (reservation_id,))
+
+        reservation = cursor.fetchone()
+        cursor.close()
+
+        if not reservation:
+            return jsonify({"message": f"No reservation found for ReservationID {reservation_id}"}), 404
+
+        return jsonify(reservation), 200
+    except mysql.connector.Error as err:
+        return jsonify({"error": str(err)}), 500
+
+
 # POST: insert a new reservation into the table
 # use this to test my post request in command line
 # Invoke-WebRequest -Uri "http://127.0.0.1:5000/reservations" -Method Post -Headers @{"Content-Type"="application/json"} -Body '{"ItemID": 30, "CardID": 7}'
@@ -777,45 +3145,21 @@ def add_reservation():
     if not item_id or not card_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
-    cursor = connection.cursor()
-
     try:
         # Insert the new reservation into the database
-        cursor.execute("""
-            SELECT ReservationCount FROM LibraryItemState
-            WHERE ItemID = %s
-        """, (item_id,))
-
-        place_in_line = cursor.fetchone()[0] + 1
-
-        cursor.execute("""
-            INSERT INTO ReserveLibraryItem (ItemID, CardID, PlaceInLine)
-            VALUES (%s, %s, %s)
-        """, (item_id, card_id, place_in_line))
-
-        cursor.execute("""
-            UPDATE LibraryItemState
-            SET ReservationCount = %s
-            WHERE ItemID = %s
-        """, (place_in_line, item_id))
-
-        cursor.execute("""
-            UPDATE LibraryAccount
-            SET NumReserved = NumReserved + 1
-            WHERE CardID = %s
-        """, (card_id,))
+        status, reservation_id = call_procedure(connection, 'ReserveItem', (item_id, card_id))
+        invalidate(account_key(card_id))
 
-        connection.commit()
-        cursor.close()
-        connection.close()
+        if status == 'NOT_FOUND':
+            return jsonify({"message": "Item not found"}), 404
 
         return jsonify({
             "message": "Reservation added successfully",
-            "ReservationID": cursor.lastrowid
+            "ReservationID": reservation_id
         }), 201
     
     except mysql.connector.Error as err:
@@ -833,22 +3177,26 @@ def update_reservation(reservation_id):
     if not item_id or not card_id or not place_in_line:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    try:
+        version = expected_version(data)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if version is None:
+        return jsonify({"error": "Missing RowVersion, send the version being updated in If-Match or the request body"}), 428
+
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
 
     try:
-        cursor = connection.cursor()
-        update_query = """
-        UPDATE ReserveLibraryItem
-        SET ItemID = %s, CardID = %s, PlaceInLine = %s
-        WHERE ReservationID = %s
-        """
-        cursor.execute(update_query, (item_id, card_id, place_in_line, reservation_id))
-        connection.commit()
-        cursor.close()
-        connection.close()
-        return jsonify({"message": "Reservation updated successfully"}), 200
+        status, result, previous_card_id = call_procedure(connection, 'MoveReservation',
+                                                          (reservation_id, item_id, card_id, place_in_line, version))
+        if status == 'NOT_FOUND':
+            return jsonify({"message": f"No reservation found for ReservationID {reservation_id}"}), 404
+        if status == 'CONFLICT':
+            return jsonify({"message": "This record was changed by someone else, reload it and try again", "RowVersion": result}), conflict_status()
+        invalidate(account_key(card_id), account_key(previous_card_id))
+        return jsonify({"message": "Reservation updated successfully", "RowVersion": version + 1}), 200
     except Error as e:
         return jsonify({"error": str(e)}), 500
     
@@ -862,43 +3210,159 @@ def delete_reservation(card_id):
     if not reservation_id or not card_id:
         return jsonify({"error": "Missing required fields"}), 400
 
-    connection = create_connection()
+    connection = get_db()
     if connection is None:
         return jsonify({"error": "Failed to connect to the database"}), 500
     try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT * FROM ReserveLibraryItem
-            WHERE ReservationID = %s
-        """, (reservation_id,))
-
-        reservation = cursor.fetchone()
+        status, _ = call_procedure(connection, 'CancelReservation', (reservation_id, card_id))
+        invalidate(account_key(card_id))
 
-        if not reservation:
+        if status == 'NOT_FOUND':
             return jsonify({"message": f"No reservation found for ReservationID {reservation_id}"}), 404
-        if reservation[2] != card_id:
+        if status == 'FORBIDDEN':
             return jsonify({"message": f"Reservation {reservation_id} was not authored by CardID {card_id}, you cannot delete this reservation"}), 403
-        
-        delete_query = "DELETE FROM ReserveLibraryItem WHERE ReservationID = %s"
-        cursor.execute(delete_query, (reservation_id,))
-        cursor.execute("""
-            UPDATE LibraryAccount
-            SET NumReserved = NumReserved - 1
-            WHERE CardID = %s
-        """, (card_id,))
-        cursor.execute("""
-            UPDATE ReserveLibraryItem
-            SET PlaceInLine = PlaceInLine - 1
-            WHERE ItemID = %s AND PlaceInLine > %s
-        """, (reservation[1], reservation[3]))
-        connection.commit()
-        cursor.close()
-        connection.close()
+
         return jsonify({"message": "Reservation deleted successfully"}), 200
     except Error as e:
         return jsonify({"error": str(e)}), 500
 
 
-# Run the app
+# endpoints for CirculationEvents
+# consumers read the log in EventID order and resume from the last EventID they
+# processed. EventIDs are handed out at INSERT but become visible at COMMIT, so a
+# reader can see event 12 before event 11 commits; a page stops at the first
+# missing EventID for as long as it may still commit. a missing EventID belongs
+# to a transaction that took it before the next event was inserted, so the gap is
+# settled once no transaction that has written rows and started no later than the
+# next event's CreatedAt is still running: the owner has committed (and the event
+# is visible) or rolled back (and it never will be). nothing is skipped on a
+# timer, so a slow transaction delays the stream instead of losing its events.
+# reading INNODB_TRX needs the PROCESS privilege
+EVENTS_PAGE_SIZE = int(os.getenv('EVENTS_PAGE_SIZE', 100))
+EVENTS_MAX_WAIT = float(os.getenv('EVENTS_MAX_WAIT', 25))
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 0.5))
+EVENTS_STREAM_SECONDS = float(os.getenv('EVENTS_STREAM_SECONDS', 300))
+# a long poll or stream holds a server thread for as long as it waits, so only
+# this many may wait at once per worker and the rest are told to retry. the ASGI
+# mode (library_async_app) serves /events without holding threads
+EVENTS_MAX_LISTENERS = int(os.getenv('EVENTS_MAX_LISTENERS', 4))
+EVENTS_QUERY = """
+    SELECT EventID, EventType, ItemID, CardID, ResultID, Amount, EventDate, CreatedAt,
+           NOT EXISTS (
+               SELECT 1 FROM information_schema.INNODB_TRX t
+               WHERE t.trx_rows_modified > 0 AND t.trx_started <= e.CreatedAt
+           ) AS Settled
+    FROM CirculationEvents e
+    WHERE EventID > %s
+    ORDER BY EventID
+    LIMIT %s
+"""
+
+event_listeners = threading.BoundedSemaphore(EVENTS_MAX_LISTENERS)
+
+
+def events_args(after, limit):
+    return (after, limit)
+
+
+# the rows of EVENTS_QUERY up to the first gap that may still be filled in
+def contiguous_events(rows, after):
+    events = []
+    for row in rows:
+        settled = row.pop('Settled')
+        if row['EventID'] != after + 1 and not settled:
+            break
+        events.append(row)
+        after = row['EventID']
+    return events
+
+
+def fetch_events(connection, after, limit):
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute(EVENTS_QUERY, events_args(after, limit))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        # end the read snapshot so the next poll sees events committed since
+        connection.commit()
+    return contiguous_events(rows, after)
+
+
+# poll until there is something after `after` or `wait` seconds have passed. the
+# connection goes back to the pool between polls so idle listeners don't hold one
+def poll_events(after, limit, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        with pool.connection() as connection:
+            events = fetch_events(connection, after, limit)
+        if events or time.monotonic() >= deadline:
+            return events
+        time.sleep(min(EVENTS_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+
+
+def event_stream(after, limit):
+    deadline = time.monotonic() + EVENTS_STREAM_SECONDS
+    yield f"retry: {int(EVENTS_POLL_INTERVAL * 1000)}\n\n"
+    while time.monotonic() < deadline:
+        try:
+            events = poll_events(after, limit, min(EVENTS_MAX_WAIT, deadline - time.monotonic()))
+        except (Error, PoolTimeout) as e:
+            # the client reconnects with Last-Event-ID and carries on from there
+            log_event(logging.WARNING, "event_stream_failed", error=str(e), after=after)
+            return
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for event in events:
+            yield f"id: {event['EventID']}\nevent: {event['EventType']}\ndata: {app.json.dumps(event)}\n\n"
+        after = events[-1]['EventID']
+
+
+def too_many_listeners():
+    response = jsonify({"error": "Too many event listeners, retry shortly or poll without wait"})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+
+# GET: events after ?after=<EventID>, e.g. /events?after=1200&limit=500&wait=25.
+# with wait > 0 the request is held open until an event arrives (long poll).
+# with Accept: text/event-stream the events are pushed as server-sent events
+# instead, resuming from the Last-Event-ID header on reconnect
+@app.route('/events', methods=['GET'])
+def get_events():
+    after = request.args.get('after', default=0, type=int)
+    limit = max(1, min(request.args.get('limit', default=EVENTS_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        after = request.headers.get('Last-Event-ID', default=after, type=int)
+        if not event_listeners.acquire(blocking=False):
+            return too_many_listeners()
+        response = app.response_class(event_stream(after, limit), mimetype='text/event-stream',
+                                      headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        response.call_on_close(event_listeners.release)
+        return response
+
+    wait = max(0.0, min(request.args.get('wait', default=0, type=float), EVENTS_MAX_WAIT))
+    # a poll that returns straight away doesn't need a listener slot
+    if wait and not event_listeners.acquire(blocking=False):
+        return too_many_listeners()
+    try:
+        events = poll_events(after, limit, wait)
+    except PoolTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except Error as e:
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if wait:
+            event_listeners.release()
+
+    next_after = events[-1]['EventID'] if events else after
+    response = jsonify({"events": events, "next_after": next_after})
+    response.headers['X-Next-After'] = str(next_after)
+    return response, 200
+
+
+# Run the app with the development server
 if __name__ == '__main__':
     app.run(debug=True)
@@ -12,7 +12,13 @@ CREATE TABLE LibraryAccount (
     Name VARCHAR(30),
     NumChecked INT CHECK (NumChecked >= 0),
     NumReserved INT CHECK (NumReserved >= 0),
-    OverdueFees NUMERIC(5,2) CHECK (OverdueFees >= 0)
+    OverdueFees NUMERIC(5,2) CHECK (OverdueFees >= 0),
+    -- fees run up so far by loans that are still out, kept by the accrue-fees job
+    AccruedFees NUMERIC(9,2) NOT NULL DEFAULT 0,
+    FeesAccruedThrough DATE,
+    -- bumped by every write to the row. GET responses carry it as the ETag "v<RowVersion>",
+    -- and a PUT only applies if the RowVersion it was read at is still current
+    RowVersion INT NOT NULL DEFAULT 1
 );
 
 CREATE TABLE Publishers (
@@ -35,9 +41,18 @@ CREATE TABLE Books (
     NumCopies INT,
     BookType VARCHAR(20), 
     PublisherID INT,
+    RowVersion INT NOT NULL DEFAULT 1,
     CONSTRAINT CHK_Language CHECK (Language IN ('EN', 'ES', 'FR', 'KO', 'IT', 'CH', 'GR', 'RU', 'DE')),
     CONSTRAINT CHK_Genre CHECK (Genre IN ('JFIC', 'YFIC', 'Fiction', 'Biography', 'Mystery', 'Poetry', 'Thriller', 'Romance')),
     CONSTRAINT CHK_BookType CHECK (BookType IN ('AudioBook_Physical', 'Physical_Copy', 'AudioBook_Digital', 'Ebook')),
+    -- catalog filters; InnoDB appends the ItemID primary key to each secondary index,
+    -- so an equality filter can walk its index in ItemID order for keyset pages
+    INDEX IDX_Books_Genre (Genre),
+    INDEX IDX_Books_Language (Language),
+    INDEX IDX_Books_BookType (BookType),
+    INDEX IDX_Books_Year (PublicationYear),
+    -- word search for GET /search
+    FULLTEXT INDEX FT_Books_Title (Title),
     FOREIGN KEY (PublisherID) REFERENCES Publishers(PublisherID),
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
 );
@@ -46,7 +61,8 @@ CREATE TABLE Authors (
     AuthorID INT AUTO_INCREMENT PRIMARY KEY,
     Name VARCHAR(30),
     DOB VARCHAR(10),
-    Nationality VARCHAR(100)
+    Nationality VARCHAR(100),
+    FULLTEXT INDEX FT_Authors_Name (Name)
 );
 
 CREATE TABLE Book_Author (
@@ -66,8 +82,14 @@ CREATE TABLE Movies (
     Genre VARCHAR(20), 
     Director VARCHAR(30),
     MovieType VARCHAR(20) CHECK (MovieType IN ('Physical', 'Digital')),
+    RowVersion INT NOT NULL DEFAULT 1,
     CONSTRAINT CHK_LanguageM CHECK (Language IN ('EN', 'ES', 'FR', 'KO', 'IT', 'CH')),
     CONSTRAINT CHK_GenreM CHECK (Genre IN ('Comedy', 'Biography', 'Mystery', 'Thriller', 'Romance', 'Documentary', 'Horror', 'Action', 'Sci-Fi', 'Adventure', 'Drama', 'Crime', 'Animation', 'History', 'Fantasy')),
+    INDEX IDX_Movies_Genre (Genre),
+    INDEX IDX_Movies_Language (Language),
+    INDEX IDX_Movies_MovieType (MovieType),
+    INDEX IDX_Movies_Year (PublicationYear),
+    FULLTEXT INDEX FT_Movies_Title_Director (Title, Director),
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
 );
 
@@ -77,6 +99,11 @@ CREATE TABLE Reviews (
     ItemID INT,
     Comments VARCHAR(200),
     Rating INT CHECK (Rating > 0 AND Rating < 6),
+    RowVersion INT NOT NULL DEFAULT 1,
+    -- a person's reviews; each person may review an item only once
+    UNIQUE INDEX IDX_Reviews_Card_Item (CardID, ItemID),
+    -- an item's reviews in ReviewID order
+    INDEX IDX_Reviews_Item (ItemID),
     FOREIGN KEY (CardID) REFERENCES LibraryAccount(CardID),
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
 );
@@ -102,6 +129,9 @@ CREATE TABLE CheckOutLibraryItem (
     CardID INT,
     BorrowDate DATE,
     ReturnByDate DATE,
+    -- loans by person, and loans of an item that are due after a given date
+    INDEX IDX_Checkout_Card (CardID),
+    INDEX IDX_Checkout_Item_ReturnBy (ItemID, ReturnByDate),
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE,
     FOREIGN KEY (CardID) REFERENCES LibraryAccount(CardID)
 );
@@ -110,6 +140,8 @@ CREATE TABLE ReturnLibraryItem (
     ReturnID INT AUTO_INCREMENT PRIMARY KEY,
     CheckoutID INT,
     ReturnDate DATE,
+    -- a checkout can only be returned once
+    UNIQUE INDEX IDX_Return_Checkout (CheckoutID),
     FOREIGN KEY (CheckoutID) REFERENCES CheckOutLibraryItem(CheckoutID) ON DELETE CASCADE
 );
 
@@ -117,19 +149,102 @@ CREATE TABLE ReserveLibraryItem (
     ReservationID INT AUTO_INCREMENT PRIMARY KEY,
     ItemID INT,
     CardID INT,
-    PlaceInLine INT,
+    -- position in the item's hold queue is the number of holds with a QueueSeq <= this one,
+    -- so taking a hold off the queue never renumbers the holds behind it
+    QueueSeq INT NOT NULL,
+    RowVersion INT NOT NULL DEFAULT 1,
+    INDEX IDX_Reserve_Item_Seq (ItemID, QueueSeq),
+    -- a person's holds, and their earliest hold on an item at checkout
+    INDEX IDX_Reserve_Card (CardID),
+    INDEX IDX_Reserve_Item_Card_Seq (ItemID, CardID, QueueSeq),
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE,
     FOREIGN KEY (CardID) REFERENCES LibraryAccount(CardID)
 );
 
+-- loans that have not been returned yet, kept in step with CheckOutLibraryItem and
+-- ReturnLibraryItem by the circulation procedures so "what is out right now" never
+-- has to scan the whole loan history. rebuilt with `flask reconcile-open-loans`
+CREATE TABLE OpenLoans (
+    CheckoutID INT PRIMARY KEY,
+    ItemID INT NOT NULL,
+    CardID INT NOT NULL,
+    BorrowDate DATE,
+    ReturnByDate DATE,
+    AccruedFee NUMERIC(7,2) NOT NULL DEFAULT 0,
+    INDEX IDX_OpenLoans_Card (CardID),
+    INDEX IDX_OpenLoans_Item (ItemID),
+    FOREIGN KEY (CheckoutID) REFERENCES CheckOutLibraryItem(CheckoutID) ON DELETE CASCADE
+);
+
 CREATE TABLE LibraryItemState (
     ItemID INT PRIMARY KEY,
     CopiesAvailable INT,
     ReservationCount INT,
+    NextQueueSeq INT NOT NULL DEFAULT 1,
+    -- queue positions MoveReservation took from NextQueueSeq for holds that were
+    -- already placed, so NextQueueSeq - 1 - QueueSeqsMoved is the number of
+    -- reservations ever placed on the item
+    QueueSeqsMoved INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
+);
+
+-- summary counters behind the /stats endpoints. the circulation procedures and the
+-- catalog routes keep them current in the same transaction as the change they
+-- count; `flask rebuild-stats` recomputes them from the base tables
+CREATE TABLE ItemStats (
+    ItemID INT PRIMARY KEY,
+    CheckoutCount INT NOT NULL DEFAULT 0,
+    ReservationsPlaced INT NOT NULL DEFAULT 0,
     FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
 );
 
-INSERT INTO LibraryAccount VALUES
+CREATE TABLE AuthorStats (
+    AuthorID INT PRIMARY KEY,
+    BooksWritten INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (AuthorID) REFERENCES Authors(AuthorID) ON DELETE CASCADE
+);
+
+-- running rating totals per item, kept by the review routes so an average is
+-- never computed by scanning an item's reviews
+CREATE TABLE ItemRatings (
+    ItemID INT PRIMARY KEY,
+    RatingCount INT NOT NULL DEFAULT 0,
+    RatingSum INT NOT NULL DEFAULT 0,
+    Rating1 INT NOT NULL DEFAULT 0,
+    Rating2 INT NOT NULL DEFAULT 0,
+    Rating3 INT NOT NULL DEFAULT 0,
+    Rating4 INT NOT NULL DEFAULT 0,
+    Rating5 INT NOT NULL DEFAULT 0,
+    AverageRating DECIMAL(3,2) AS (IF(RatingCount = 0, NULL, RatingSum / RatingCount)) STORED,
+    INDEX IDX_ItemRatings_Average (AverageRating, RatingCount),
+    FOREIGN KEY (ItemID) REFERENCES LibraryItem(ItemID) ON DELETE CASCADE
+);
+
+-- append-only history of circulation changes, written in the same transaction as
+-- the change itself and read in EventID order by GET /events. the events are always
+-- the last statements before COMMIT, so no lock wait can sit between taking an
+-- EventID and committing it and CreatedAt stays within a commit of being visible.
+-- no foreign keys, so the history outlives the rows it mentions
+CREATE TABLE CirculationEvents (
+    EventID BIGINT AUTO_INCREMENT PRIMARY KEY,
+    EventType VARCHAR(20) NOT NULL,
+    ItemID INT,
+    CardID INT,
+    -- the CheckoutID or ReservationID the event is about
+    ResultID INT,
+    Amount NUMERIC(9,2),
+    EventDate DATE,
+    CreatedAt TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+);
+
+CREATE TABLE CatalogStats (
+    ItemType VARCHAR(10),
+    Type VARCHAR(20),
+    ItemCount INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (ItemType, Type)
+);
+
+INSERT INTO LibraryAccount (CardID, Name, NumChecked, NumReserved, OverdueFees) VALUES
     (1, 'June Lee', 0, 1, 0),
     (2, 'Mark Taylor', 2, 3, 0),
     (3, 'Anna Johnson', 1, 2, 0),
@@ -380,7 +495,7 @@ INSERT INTO Movies (ItemID, Language, Title, PublicationYear, NumCopies, Genre,
     (140, 'EN', 'Inside Out', 2015, 7, 'Animation', 'Pete Docter', 'Digital');
 
 
-INSERT INTO Reviews VALUES
+INSERT INTO Reviews (ReviewID, CardID, ItemID, Comments, Rating) VALUES
     (1, 3, 1, 'An exciting continuation of the Harry Potter series! I loved it.', 5),
     (2, 7, 2, 'A timeless classic. The world-building is phenomenal.', 5),
     (3, 12, 3, 'Great start to an epic series, but a bit slow in parts.', 4),
@@ -585,7 +700,7 @@ INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate) VALUES
     (32, '2023-10-17'),
     (33, '2023-10-18');
 
-INSERT INTO ReserveLibraryItem (ItemID, CardID, PlaceInLine) VALUES
+INSERT INTO ReserveLibraryItem (ItemID, CardID, QueueSeq) VALUES
     (1, 2, 1),
     (1, 3, 2),
     (1, 4, 3),
@@ -704,6 +819,571 @@ INSERT INTO LibraryItemState (ItemID, CopiesAvailable, ReservationCount) VALUES
     (139, 6, 0),
     (140, 7, 0);
 
+UPDATE LibraryItemState
+SET NextQueueSeq = ReservationCount + 1;
+
+INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+SELECT c.CheckoutID, c.ItemID, c.CardID, c.BorrowDate, c.ReturnByDate
+FROM CheckOutLibraryItem c
+WHERE NOT EXISTS (SELECT 1 FROM ReturnLibraryItem r WHERE r.CheckoutID = c.CheckoutID);
+
+INSERT INTO ItemStats (ItemID, CheckoutCount, ReservationsPlaced)
+SELECT s.ItemID, COUNT(c.CheckoutID), s.NextQueueSeq - 1 - s.QueueSeqsMoved
+FROM LibraryItemState s
+LEFT JOIN CheckOutLibraryItem c ON c.ItemID = s.ItemID
+GROUP BY s.ItemID, s.NextQueueSeq, s.QueueSeqsMoved;
+
+INSERT INTO AuthorStats (AuthorID, BooksWritten)
+SELECT AuthorID, COUNT(*) FROM Book_Author
+GROUP BY AuthorID;
+
+INSERT INTO CatalogStats (ItemType, Type, ItemCount)
+SELECT 'Book', BookType, COUNT(*) FROM Books GROUP BY BookType
+UNION ALL
+SELECT 'Movie', MovieType, COUNT(*) FROM Movies GROUP BY MovieType;
+
+INSERT INTO ItemRatings (ItemID, RatingCount, RatingSum, Rating1, Rating2, Rating3, Rating4, Rating5)
+SELECT ItemID, COUNT(*), SUM(Rating),
+    SUM(Rating = 1), SUM(Rating = 2), SUM(Rating = 3), SUM(Rating = 4), SUM(Rating = 5)
+FROM Reviews
+GROUP BY ItemID;
+
+-- stored procedures for circulation: each one runs a whole state transition as a
+-- single server-side transaction so the API only needs one CALL per request.
+-- every procedure ends with a one-row result set (Status, ResultID) where Status is
+-- 'OK', 'NOT_FOUND' or 'FORBIDDEN'. ReturnItem and MoveReservation also return the
+-- CardID whose account they changed, which the caller can't otherwise know
+DELIMITER $$
+
+-- check out an item; if the free copies are all held for the reservation queue,
+-- the patron needs a reservation that is within reach of the available copies.
+-- the item's LibraryItemState row is locked for the rest of the transaction, so
+-- concurrent checkouts of the same item queue up while other items are unaffected
+CREATE PROCEDURE CheckOutItem(
+    IN p_ItemID INT,
+    IN p_CardID INT,
+    IN p_BorrowDate DATE,
+    IN p_ReturnByDate DATE
+)
+proc: BEGIN
+    DECLARE v_CopiesAvailable INT;
+    DECLARE v_ReservationCount INT;
+    DECLARE v_ReservationID INT;
+    DECLARE v_QueueSeq INT;
+    DECLARE v_HoldsAhead INT;
+    DECLARE v_CheckoutID INT;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    SELECT CopiesAvailable, ReservationCount INTO v_CopiesAvailable, v_ReservationCount
+    FROM LibraryItemState
+    WHERE ItemID = p_ItemID
+    FOR UPDATE;
+
+    IF v_CopiesAvailable IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    IF v_CopiesAvailable <= 0 THEN
+        ROLLBACK;
+        SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    IF v_CopiesAvailable <= v_ReservationCount THEN
+        SELECT ReservationID, QueueSeq INTO v_ReservationID, v_QueueSeq
+        FROM ReserveLibraryItem
+        WHERE ItemID = p_ItemID AND CardID = p_CardID
+        ORDER BY QueueSeq
+        LIMIT 1;
+
+        IF v_ReservationID IS NULL THEN
+            ROLLBACK;
+            SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+            LEAVE proc;
+        END IF;
+
+        -- only count far enough to know whether the hold is within reach of the free copies
+        SELECT COUNT(*) INTO v_HoldsAhead
+        FROM (
+            SELECT 1 FROM ReserveLibraryItem
+            WHERE ItemID = p_ItemID AND QueueSeq < v_QueueSeq
+            LIMIT v_CopiesAvailable
+        ) ahead;
+
+        IF v_HoldsAhead >= v_CopiesAvailable THEN
+            ROLLBACK;
+            SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+            LEAVE proc;
+        END IF;
+
+        DELETE FROM ReserveLibraryItem
+        WHERE ReservationID = v_ReservationID;
+
+        UPDATE LibraryAccount
+        SET NumReserved = NumReserved - 1, RowVersion = RowVersion + 1
+        WHERE CardID = p_CardID;
+
+        UPDATE LibraryItemState
+        SET ReservationCount = ReservationCount - 1
+        WHERE ItemID = p_ItemID;
+    END IF;
+
+    -- guarded decrement: never takes the count below zero even if the row lock is bypassed
+    UPDATE LibraryItemState
+    SET CopiesAvailable = CopiesAvailable - 1
+    WHERE ItemID = p_ItemID AND CopiesAvailable > 0;
+
+    IF ROW_COUNT() = 0 THEN
+        ROLLBACK;
+        SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    INSERT INTO CheckOutLibraryItem (ItemID, CardID, BorrowDate, ReturnByDate)
+    VALUES (p_ItemID, p_CardID, p_BorrowDate, p_ReturnByDate);
+    SET v_CheckoutID = LAST_INSERT_ID();
+
+    INSERT INTO OpenLoans (CheckoutID, ItemID, CardID, BorrowDate, ReturnByDate)
+    VALUES (v_CheckoutID, p_ItemID, p_CardID, p_BorrowDate, p_ReturnByDate);
+
+    INSERT INTO ItemStats (ItemID, CheckoutCount)
+    VALUES (p_ItemID, 1)
+    ON DUPLICATE KEY UPDATE CheckoutCount = CheckoutCount + 1;
+
+    UPDATE LibraryAccount
+    SET NumChecked = NumChecked + 1, RowVersion = RowVersion + 1
+    WHERE CardID = p_CardID;
+
+    -- v_ReservationID is only set when the checkout filled this patron's hold
+    IF v_ReservationID IS NOT NULL THEN
+        INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, EventDate)
+        VALUES ('HOLD_FILLED', p_ItemID, p_CardID, v_ReservationID, p_BorrowDate);
+    END IF;
+
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, EventDate)
+    VALUES ('CHECKOUT', p_ItemID, p_CardID, v_CheckoutID, p_BorrowDate);
+
+    COMMIT;
+    SELECT 'OK' AS Status, v_CheckoutID AS ResultID;
+END $$
+
+-- return a checked out item, charging $0.25 for each day past the ReturnByDate
+CREATE PROCEDURE ReturnItem(
+    IN p_CheckoutID INT,
+    IN p_ReturnDate DATE
+)
+proc: BEGIN
+    DECLARE v_ItemID INT;
+    DECLARE v_CardID INT;
+    DECLARE v_ReturnByDate DATE;
+    DECLARE v_ReturnID INT;
+    DECLARE v_AccruedFee NUMERIC(7,2) DEFAULT 0;
+    DECLARE v_Fee NUMERIC(9,2);
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    -- lock the checkout so two returns of the same loan can't both succeed
+    SELECT ItemID, CardID, ReturnByDate INTO v_ItemID, v_CardID, v_ReturnByDate
+    FROM CheckOutLibraryItem
+    WHERE CheckoutID = p_CheckoutID
+    FOR UPDATE;
+
+    IF v_ItemID IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID, NULL AS CardID;
+        LEAVE proc;
+    END IF;
+
+    SELECT ReturnID INTO v_ReturnID
+    FROM ReturnLibraryItem
+    WHERE CheckoutID = p_CheckoutID
+    LIMIT 1;
+
+    IF v_ReturnID IS NOT NULL THEN
+        ROLLBACK;
+        SELECT 'FORBIDDEN' AS Status, NULL AS ResultID, NULL AS CardID;
+        LEAVE proc;
+    END IF;
+
+    INSERT INTO ReturnLibraryItem (CheckoutID, ReturnDate)
+    VALUES (p_CheckoutID, p_ReturnDate);
+    SET v_ReturnID = LAST_INSERT_ID();
+
+    -- the loan's fee is charged in full below, so it stops counting as accrued
+    SELECT AccruedFee INTO v_AccruedFee
+    FROM OpenLoans
+    WHERE CheckoutID = p_CheckoutID;
+
+    DELETE FROM OpenLoans
+    WHERE CheckoutID = p_CheckoutID;
+
+    UPDATE LibraryItemState
+    SET CopiesAvailable = CopiesAvailable + 1
+    WHERE ItemID = v_ItemID;
+
+    SET v_Fee = GREATEST(DATEDIFF(p_ReturnDate, v_ReturnByDate), 0) * 0.25;
+
+    UPDATE LibraryAccount
+    SET NumChecked = NumChecked - 1,
+        OverdueFees = OverdueFees + v_Fee,
+        AccruedFees = GREATEST(AccruedFees - COALESCE(v_AccruedFee, 0), 0),
+        RowVersion = RowVersion + 1
+    WHERE CardID = v_CardID;
+
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, EventDate)
+    VALUES ('RETURN', v_ItemID, v_CardID, p_CheckoutID, p_ReturnDate);
+
+    IF v_Fee > 0 THEN
+        INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, Amount, EventDate)
+        VALUES ('FEE_CHARGED', v_ItemID, v_CardID, p_CheckoutID, v_Fee, p_ReturnDate);
+    END IF;
+
+    COMMIT;
+    SELECT 'OK' AS Status, v_ReturnID AS ResultID, v_CardID AS CardID;
+END $$
+
+-- move the ReturnByDate of an open checkout owned by the given card. the loan's
+-- AccruedFee is recomputed for the new date as of the account's last accrual, so
+-- the account's AccruedFees stays the sum over its open loans
+CREATE PROCEDURE RenewItem(
+    IN p_CheckoutID INT,
+    IN p_CardID INT,
+    IN p_ReturnByDate DATE
+)
+proc: BEGIN
+    DECLARE v_ItemID INT;
+    DECLARE v_CardID INT;
+    DECLARE v_AccruedThrough DATE;
+    DECLARE v_OldFee NUMERIC(7,2) DEFAULT 0;
+    DECLARE v_NewFee NUMERIC(7,2);
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    -- lock the checkout so a return can't land between the check below and the UPDATEs
+    SELECT ItemID, CardID INTO v_ItemID, v_CardID
+    FROM CheckOutLibraryItem
+    WHERE CheckoutID = p_CheckoutID
+    FOR UPDATE;
+
+    IF v_CardID IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    IF v_CardID <> p_CardID THEN
+        ROLLBACK;
+        SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM ReturnLibraryItem WHERE CheckoutID = p_CheckoutID) THEN
+        SIGNAL SQLSTATE '45000'
+            SET MESSAGE_TEXT = 'Checkout has already been returned and cannot be renewed';
+    END IF;
+
+    SELECT AccruedFee INTO v_OldFee
+    FROM OpenLoans
+    WHERE CheckoutID = p_CheckoutID
+    FOR UPDATE;
+
+    SELECT FeesAccruedThrough INTO v_AccruedThrough
+    FROM LibraryAccount
+    WHERE CardID = v_CardID
+    FOR UPDATE;
+
+    SET v_NewFee = GREATEST(DATEDIFF(COALESCE(v_AccruedThrough, CURDATE()), p_ReturnByDate), 0) * 0.25;
+
+    UPDATE CheckOutLibraryItem
+    SET ReturnByDate = p_ReturnByDate
+    WHERE CheckoutID = p_CheckoutID;
+
+    UPDATE OpenLoans
+    SET ReturnByDate = p_ReturnByDate, AccruedFee = v_NewFee
+    WHERE CheckoutID = p_CheckoutID;
+
+    IF v_NewFee <> COALESCE(v_OldFee, 0) THEN
+        UPDATE LibraryAccount
+        SET AccruedFees = GREATEST(AccruedFees + v_NewFee - COALESCE(v_OldFee, 0), 0),
+            RowVersion = RowVersion + 1
+        WHERE CardID = v_CardID;
+
+        INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, Amount, EventDate)
+        VALUES ('FEE_ACCRUED', v_ItemID, v_CardID, p_CheckoutID, v_NewFee - COALESCE(v_OldFee, 0), CURDATE());
+    END IF;
+
+    -- the event is dated when the renewal happened, not with the new due date
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID, EventDate)
+    VALUES ('RENEW', v_ItemID, v_CardID, p_CheckoutID, CURDATE());
+
+    COMMIT;
+    SELECT 'OK' AS Status, p_CheckoutID AS ResultID;
+END $$
+
+-- put a card at the back of an item's reservation queue
+CREATE PROCEDURE ReserveItem(
+    IN p_ItemID INT,
+    IN p_CardID INT
+)
+proc: BEGIN
+    DECLARE v_QueueSeq INT;
+    DECLARE v_ReservationID INT;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    SELECT NextQueueSeq INTO v_QueueSeq
+    FROM LibraryItemState
+    WHERE ItemID = p_ItemID
+    FOR UPDATE;
+
+    IF v_QueueSeq IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    INSERT INTO ReserveLibraryItem (ItemID, CardID, QueueSeq)
+    VALUES (p_ItemID, p_CardID, v_QueueSeq);
+    SET v_ReservationID = LAST_INSERT_ID();
+
+    UPDATE LibraryItemState
+    SET ReservationCount = ReservationCount + 1, NextQueueSeq = NextQueueSeq + 1
+    WHERE ItemID = p_ItemID;
+
+    INSERT INTO ItemStats (ItemID, ReservationsPlaced)
+    VALUES (p_ItemID, 1)
+    ON DUPLICATE KEY UPDATE ReservationsPlaced = ReservationsPlaced + 1;
+
+    UPDATE LibraryAccount
+    SET NumReserved = NumReserved + 1, RowVersion = RowVersion + 1
+    WHERE CardID = p_CardID;
+
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID)
+    VALUES ('RESERVE', p_ItemID, p_CardID, v_ReservationID);
+
+    COMMIT;
+    SELECT 'OK' AS Status, v_ReservationID AS ResultID;
+END $$
+
+-- cancel a reservation owned by the given card; the holds behind it move up
+-- implicitly because positions are computed from QueueSeq on read
+CREATE PROCEDURE CancelReservation(
+    IN p_ReservationID INT,
+    IN p_CardID INT
+)
+proc: BEGIN
+    DECLARE v_ItemID INT;
+    DECLARE v_CardID INT;
+    DECLARE v_ItemState INT;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    SELECT ItemID, CardID INTO v_ItemID, v_CardID
+    FROM ReserveLibraryItem
+    WHERE ReservationID = p_ReservationID;
+
+    IF v_ItemID IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    IF v_CardID <> p_CardID THEN
+        ROLLBACK;
+        SELECT 'FORBIDDEN' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    -- lock the item's queue in the same order as CheckOutItem and ReserveItem do
+    SELECT ItemID INTO v_ItemState
+    FROM LibraryItemState
+    WHERE ItemID = v_ItemID
+    FOR UPDATE;
+
+    DELETE FROM ReserveLibraryItem
+    WHERE ReservationID = p_ReservationID;
+
+    -- a concurrent checkout fulfilled the hold before we got the lock
+    IF ROW_COUNT() = 0 THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID;
+        LEAVE proc;
+    END IF;
+
+    UPDATE LibraryAccount
+    SET NumReserved = NumReserved - 1, RowVersion = RowVersion + 1
+    WHERE CardID = p_CardID;
+
+    UPDATE LibraryItemState
+    SET ReservationCount = ReservationCount - 1
+    WHERE ItemID = v_ItemID;
+
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID)
+    VALUES ('CANCEL', v_ItemID, p_CardID, p_ReservationID);
+
+    COMMIT;
+    SELECT 'OK' AS Status, p_ReservationID AS ResultID;
+END $$
+
+-- move a reservation to a given place in an item's queue (staff reordering). this is
+-- the one operation that shifts the QueueSeq of the holds behind the new position;
+-- the everyday reserve/checkout/cancel paths never do. p_RowVersion is the version
+-- the caller read the reservation at; if it has moved since, nothing changes and
+-- the current version comes back with a CONFLICT status
+CREATE PROCEDURE MoveReservation(
+    IN p_ReservationID INT,
+    IN p_ItemID INT,
+    IN p_CardID INT,
+    IN p_PlaceInLine INT,
+    IN p_RowVersion INT
+)
+proc: BEGIN
+    DECLARE v_OldItemID INT;
+    DECLARE v_OldCardID INT;
+    DECLARE v_RowVersion INT;
+    DECLARE v_NextQueueSeq INT;
+    DECLARE v_TargetSeq INT;
+    DECLARE v_ItemState INT;
+    DECLARE v_HoldsAhead INT DEFAULT GREATEST(p_PlaceInLine - 1, 0);
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    -- the source item is only known from the reservation, so read it unlocked to
+    -- find out which queues to lock, and check it again once they are held
+    SELECT ItemID INTO v_OldItemID
+    FROM ReserveLibraryItem
+    WHERE ReservationID = p_ReservationID;
+
+    IF v_OldItemID IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID, NULL AS CardID;
+        LEAVE proc;
+    END IF;
+
+    -- lock both items' queues, lower ItemID first like the batch checkout, so a
+    -- CheckOutItem on the source item can't fill or delete the hold mid-move
+    IF v_OldItemID < p_ItemID THEN
+        SELECT ItemID INTO v_ItemState
+        FROM LibraryItemState
+        WHERE ItemID = v_OldItemID
+        FOR UPDATE;
+    END IF;
+
+    SELECT NextQueueSeq INTO v_NextQueueSeq
+    FROM LibraryItemState
+    WHERE ItemID = p_ItemID
+    FOR UPDATE;
+
+    IF v_OldItemID > p_ItemID THEN
+        SELECT ItemID INTO v_ItemState
+        FROM LibraryItemState
+        WHERE ItemID = v_OldItemID
+        FOR UPDATE;
+    END IF;
+
+    -- every change to ItemID bumps RowVersion, so if the version still matches
+    -- below, the source item is the one whose queue is now locked
+    SET v_OldItemID = NULL;
+    SELECT ItemID, CardID, RowVersion INTO v_OldItemID, v_OldCardID, v_RowVersion
+    FROM ReserveLibraryItem
+    WHERE ReservationID = p_ReservationID
+    FOR UPDATE;
+
+    IF v_NextQueueSeq IS NULL OR v_OldItemID IS NULL THEN
+        ROLLBACK;
+        SELECT 'NOT_FOUND' AS Status, NULL AS ResultID, NULL AS CardID;
+        LEAVE proc;
+    END IF;
+
+    IF v_RowVersion <> p_RowVersion THEN
+        ROLLBACK;
+        SELECT 'CONFLICT' AS Status, v_RowVersion AS ResultID, NULL AS CardID;
+        LEAVE proc;
+    END IF;
+
+    SELECT QueueSeq INTO v_TargetSeq
+    FROM ReserveLibraryItem
+    WHERE ItemID = p_ItemID AND ReservationID <> p_ReservationID
+    ORDER BY QueueSeq
+    LIMIT v_HoldsAhead, 1;
+
+    IF v_TargetSeq IS NULL THEN
+        SET v_TargetSeq = v_NextQueueSeq;
+    ELSE
+        UPDATE ReserveLibraryItem
+        SET QueueSeq = QueueSeq + 1
+        WHERE ItemID = p_ItemID AND QueueSeq >= v_TargetSeq;
+    END IF;
+
+    UPDATE LibraryItemState
+    SET NextQueueSeq = NextQueueSeq + 1,
+        QueueSeqsMoved = QueueSeqsMoved + 1,
+        ReservationCount = ReservationCount + (v_OldItemID <> p_ItemID)
+    WHERE ItemID = p_ItemID;
+
+    UPDATE ReserveLibraryItem
+    SET ItemID = p_ItemID, CardID = p_CardID, QueueSeq = v_TargetSeq, RowVersion = RowVersion + 1
+    WHERE ReservationID = p_ReservationID;
+
+    IF v_OldItemID <> p_ItemID THEN
+        UPDATE LibraryItemState
+        SET ReservationCount = ReservationCount - 1
+        WHERE ItemID = v_OldItemID;
+    END IF;
+
+    IF v_OldCardID <> p_CardID THEN
+        UPDATE LibraryAccount
+        SET NumReserved = NumReserved - 1, RowVersion = RowVersion + 1
+        WHERE CardID = v_OldCardID;
+
+        UPDATE LibraryAccount
+        SET NumReserved = NumReserved + 1, RowVersion = RowVersion + 1
+        WHERE CardID = p_CardID;
+    END IF;
+
+    INSERT INTO CirculationEvents (EventType, ItemID, CardID, ResultID)
+    VALUES ('MOVE', p_ItemID, p_CardID, p_ReservationID);
+
+    COMMIT;
+    SELECT 'OK' AS Status, p_ReservationID AS ResultID, v_OldCardID AS CardID;
+END $$
+
+DELIMITER ;
+
+
 
 -- Total number of books and movies available (Aggregate)
 SELECT ItemType, SUM(CopiesAvailable) AS TotalAvailable